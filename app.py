@@ -6,14 +6,23 @@ import random
 import logging
 import socket
 import webbrowser
-from flask import Flask, render_template, request, jsonify, send_from_directory, send_file, session, Blueprint
+import click
+import threading
+import queue
+import atexit
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, send_file, session, Blueprint, stream_with_context
 from flask_session import Session
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from dotenv import load_dotenv
+import groq
 from groq import Groq
 import psycopg2
-from psycopg2 import Error as PsycopgError, sql
+from psycopg2 import Error as PsycopgError, sql, pool
+from psycopg2.extras import execute_values, wait_select
 import httpx
 import bleach
 from gtts import gTTS
@@ -21,8 +30,22 @@ import io
 import retrying
 import re
 import uuid
+import collections
+import itertools
+import hashlib
+import hmac
+import sqlite3
+import unicodedata
+import base64
+from datetime import datetime
+import gzip
 from cachetools import TTLCache
-from pydantic import BaseModel, ValidationError
+import numpy as np
+try:
+    import brotli  # Opcional: variante br de los payloads precomputados
+except ImportError:
+    brotli = None
+from pydantic import BaseModel, Field, ValidationError
 from typing import Annotated, List, Optional
 from pydantic.types import StringConstraints
 
@@ -51,6 +74,7 @@ app = Flask(__name__, static_folder='static', template_folder='templates')
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'tu_clave_secreta')
 app.config['SESSION_TYPE'] = 'filesystem'
 app.config['SESSION_PERMANENT'] = True  # Persistir sesión tras reinicios
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 64 * 1024))  # 413 para cuerpos mayores
 Session(app)
 
 # Configurar rate limiting
@@ -61,35 +85,73 @@ limiter = Limiter(
     storage_uri="memory://"
 )
 
-# Configurar caché en memoria
-cache = TTLCache(maxsize=100, ttl=72 * 60 * 60)  # 72 horas para TTS y temas
-
 # Configurar timeouts desde .env
 GROQ_RETRY_ATTEMPTS = int(os.getenv('GROQ_RETRY_ATTEMPTS', 3))
 GROQ_RETRY_WAIT = int(os.getenv('GROQ_RETRY_WAIT', 5000))
 GTTS_TIMEOUT = int(os.getenv('GTTS_TIMEOUT', 10))
 
-# Inicializar Groq client
-client = Groq(api_key=os.getenv('GROQ_API_KEY'))
+GROQ_TIMEOUT = float(os.getenv('GROQ_TIMEOUT', 60))
+GROQ_MAX_CONEXIONES = int(os.getenv('GROQ_MAX_CONEXIONES', 200))
+
+# Inicializar Groq client sobre un pool HTTP compartido por el worker (keep-alive hacia la API)
+groq_http = httpx.Client(
+    limits=httpx.Limits(max_connections=GROQ_MAX_CONEXIONES, max_keepalive_connections=max(1, GROQ_MAX_CONEXIONES // 4)),
+    timeout=httpx.Timeout(GROQ_TIMEOUT, connect=10.0)
+)
+# Sin reintentos internos del SDK: los hace el planificador de llamadas
+client = Groq(api_key=os.getenv('GROQ_API_KEY'), http_client=groq_http, max_retries=0)
+
+def modo_gevent():
+    """True si el proceso corre en un worker gevent de gunicorn (sockets parcheados)."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+# En modo gevent cada petición es un greenlet: psycopg2 debe ceder el control mientras espera a Postgres
+if modo_gevent():
+    psycopg2.extensions.set_wait_callback(wait_select)
+
+# Mensaje con el que arranca toda conversación
+SALUDO_INICIAL = "Hola, soy YELIA 👋. ¿En qué tema de Programación Avanzada quieres que te ayude hoy?"
+
+# Respuestas fijas del chat (también se pre-sintetizan en la caché TTS)
+RESPUESTA_SALUDO = "Hola, ¿cómo puedo ayudarte con Programación Avanzada hoy?"
+RESPUESTA_PRESENTACION = (
+    "Soy YELIA, un tutor de Programación Avanzada para Ingeniería en Telemática. "
+    "Puedo explicarte temas como POO, UML, patrones de diseño, y más. ¿Qué quieres aprender?"
+)
+PLANTILLA_AYUDA = (
+    "Puedo explicarte temas de Programación Avanzada, generar quizzes, recomendar temas y convertir texto a voz. "
+    "Prueba con una pregunta sobre {tema} o pide un quiz."
+)
+PLANTILLA_FALLBACK = "No encontré respuesta directa, pero podemos revisar el tema '{tema}' o resolver un ejercicio juntos."
 
 # --- Modelos de Validación con Pydantic ---
+# El historial del prompt se lee de la tabla messages; el campo del cliente sólo se acepta
+# (acotado) por compatibilidad con clientes antiguos y se ignora.
+HISTORIAL_CLIENTE_MAX = 10
+
 class BuscarRespuestaInput(BaseModel):
     pregunta: Annotated[str, StringConstraints(max_length=500)]
-    historial: List = []
+    historial: Annotated[List, Field(max_length=HISTORIAL_CLIENTE_MAX)] = []
     nivel_explicacion: Annotated[str, StringConstraints(max_length=20)] = 'basica'
     conv_id: Optional[int] = None
     usuario: Optional[Annotated[str, StringConstraints(max_length=50)]] = None
+    client_id: Optional[Annotated[str, StringConstraints(max_length=64)]] = None
 
 class QuizInput(BaseModel):
     usuario: Annotated[str, StringConstraints(max_length=50)] = 'anonimo'
-    historial: List = []
+    historial: Annotated[List, Field(max_length=HISTORIAL_CLIENTE_MAX)] = []
     nivel: Annotated[str, StringConstraints(max_length=20)] = 'basica'
     tema: Optional[Annotated[str, StringConstraints(max_length=100)]] = None
 
 class ResponderQuizInput(BaseModel):
     pregunta: Annotated[str, StringConstraints(max_length=200)]
     respuesta: Annotated[str, StringConstraints(max_length=100)]
-    respuesta_correcta: Annotated[str, StringConstraints(max_length=100)]
+    respuesta_correcta: Optional[Annotated[str, StringConstraints(max_length=100)]] = None
+    quiz_id: Optional[int] = None
     tema: Annotated[str, StringConstraints(max_length=50)] = 'General'
     usuario: Optional[Annotated[str, StringConstraints(max_length=50)]] = None
 
@@ -98,8 +160,8 @@ class TTSInput(BaseModel):
     usuario: Optional[Annotated[str, StringConstraints(max_length=50)]] = None
 
 class RecommendInput(BaseModel):
-    usuario: Annotated[str, StringConstraints(max_length=50)] = 'anonimo'
-    historial: List = []
+    usuario: Optional[Annotated[str, StringConstraints(max_length=50)]] = None
+    historial: Annotated[List, Field(max_length=HISTORIAL_CLIENTE_MAX)] = []
 
 class ConversationInput(BaseModel):
     nombre: Annotated[str, StringConstraints(max_length=100)] = 'Nuevo Chat'
@@ -110,19 +172,225 @@ class MessageInput(BaseModel):
     content: str
     tema: Optional[str] = None
     usuario: Optional[Annotated[str, StringConstraints(max_length=50)]] = None
+    # Id generado por el cliente: reintentar el mismo mensaje no crea filas duplicadas
+    client_id: Optional[Annotated[str, StringConstraints(max_length=64)]] = None
+
+MENSAJES_LOTE_MAX = 100
+
+class MessageBatchInput(BaseModel):
+    messages: Annotated[List[MessageInput], Field(min_length=1, max_length=MENSAJES_LOTE_MAX)]
+    usuario: Optional[Annotated[str, StringConstraints(max_length=50)]] = None
+
+# --- Pool de Conexiones a la Base de Datos ---
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))  # segundos esperando una conexión libre
+DB_POOL_CHECK_INTERVAL = float(os.getenv('DB_POOL_CHECK_INTERVAL', 30))  # segundos de inactividad antes de verificar
+
+class ConexionPreparada(psycopg2.extensions.connection):
+    """Conexión que recuerda qué sentencias preparadas ya declaró en su sesión del servidor."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+
+class PoolConexionesDB:
+    """Pool de conexiones PostgreSQL seguro entre hilos y tras el fork de los workers de gunicorn."""
+
+    def __init__(self, dsn, minconn, maxconn, timeout, check_interval):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._heredadas = []
+        self._reiniciar_estado()
+
+    def _reiniciar_estado(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._libres = []  # [(conn, ultimo_uso)]
+        self._en_uso = 0
+        self._precalentado = False
+        self._stats = {
+            "creadas": 0, "reutilizadas": 0, "descartadas": 0,
+            "timeouts": 0, "checkouts": 0, "espera_total_ms": 0.0,
+        }
+
+    def tras_fork(self):
+        """Descarta el estado heredado del proceso padre sin cerrar sus sockets."""
+        # Cerrar las conexiones heredadas enviaría Terminate sobre sockets que siguen
+        # siendo del proceso padre; se conservan referenciadas para que el GC no las cierre.
+        self._heredadas.extend(conn for conn, _ in self._libres)
+        self._reiniciar_estado()
+
+    @retrying.retry(wait_fixed=GROQ_RETRY_WAIT, stop_max_attempt_number=GROQ_RETRY_ATTEMPTS)
+    def _nueva_conexion(self):
+        try:
+            conn = psycopg2.connect(self.dsn, connection_factory=ConexionPreparada)
+            conn.set_session(autocommit=False)
+            with self._lock:
+                self._stats["creadas"] += 1
+            logger.info("Conexión a la base de datos establecida", pid=self._pid)
+            return conn
+        except Exception as e:
+            logger.error("Error al conectar con la base de datos", error=str(e))
+            raise
+
+    def _precalentar(self):
+        with self._lock:
+            if self._precalentado:
+                return
+            self._precalentado = True
+            faltantes = self.minconn - len(self._libres)
+        for _ in range(max(faltantes, 0)):
+            conn = self._nueva_conexion()
+            with self._lock:
+                self._libres.append((conn, time.monotonic()))
+
+    def _esta_sana(self, conn):
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except PsycopgError:
+            return False
+
+    def getconn(self):
+        """Obtiene una conexión verificada del pool, esperando como máximo `timeout` segundos."""
+        if not self._precalentado:
+            self._precalentar()
+        inicio = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            logger.error("Pool de conexiones agotado", max=self.maxconn, timeout=self.timeout)
+            raise pool.PoolError(f"No hay conexiones libres tras {self.timeout}s (max={self.maxconn})")
+        try:
+            while True:
+                with self._lock:
+                    conn, ultimo_uso = self._libres.pop() if self._libres else (None, None)
+                if conn is None:
+                    conn = self._nueva_conexion()
+                    break
+                if conn.closed or (time.monotonic() - ultimo_uso > self.check_interval and not self._esta_sana(conn)):
+                    self._cerrar(conn)
+                    continue
+                with self._lock:
+                    self._stats["reutilizadas"] += 1
+                break
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._en_uso += 1
+            self._stats["checkouts"] += 1
+            self._stats["espera_total_ms"] += (time.monotonic() - inicio) * 1000
+        return conn
+
+    def putconn(self, conn, descartar=False):
+        """Devuelve una conexión al pool; las rotas o en transacción fallida se descartan."""
+        try:
+            if not descartar and not conn.closed:
+                try:
+                    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except PsycopgError:
+                    descartar = True
+            if descartar or conn.closed:
+                self._cerrar(conn)
+            else:
+                with self._lock:
+                    self._libres.append((conn, time.monotonic()))
+        finally:
+            with self._lock:
+                self._en_uso -= 1
+            self._slots.release()
+
+    def _cerrar(self, conn):
+        with self._lock:
+            self._stats["descartadas"] += 1
+        try:
+            conn.close()
+        except PsycopgError:
+            pass
+
+    def closeall(self):
+        """Cierra todas las conexiones libres del pool."""
+        with self._lock:
+            libres, self._libres = self._libres, []
+            self._precalentado = False
+        for conn, _ in libres:
+            try:
+                conn.close()
+            except PsycopgError:
+                pass
+
+    def stats(self):
+        """Devuelve los contadores del pool."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(pid=self._pid, libres=len(self._libres), en_uso=self._en_uso,
+                         min=self.minconn, max=self.maxconn)
+        stats["espera_media_ms"] = round(stats["espera_total_ms"] / stats["checkouts"], 3) if stats["checkouts"] else 0.0
+        return stats
+
+db_pool = PoolConexionesDB(
+    os.getenv("DATABASE_URL"), DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_INTERVAL
+)
+os.register_at_fork(after_in_child=db_pool.tras_fork)
 
 # --- Funciones de Lógica de Base de Datos ---
-@retrying.retry(wait_fixed=GROQ_RETRY_WAIT, stop_max_attempt_number=GROQ_RETRY_ATTEMPTS)
+@contextmanager
 def get_db_connection():
-    """Establece una conexión a la base de datos PostgreSQL."""
+    """Presta una conexión del pool y la devuelve al salir del bloque."""
+    conn = db_pool.getconn()
+    descartar = False
     try:
-        conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-        conn.set_session(autocommit=False)
-        logger.info("Conexión a la base de datos establecida")
-        return conn
-    except Exception as e:
-        logger.error("Error al conectar con la base de datos", error=str(e))
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        descartar = True
         raise
+    finally:
+        db_pool.putconn(conn, descartar=descartar)
+
+# Consultas calientes de /buscar_respuesta, preparadas una vez por conexión del pool
+SENTENCIAS_PREPARADAS = {
+    # Propiedad de la conversación, últimos mensajes, resumen, mensajes sin resumir y, si el turno es un
+    # reintento ($4 = client_id), la respuesta ya guardada, en una sola ida y vuelta
+    "turno_contexto": ("(integer, text, integer, text)", """
+        WITH conv AS (
+            SELECT id, resumen, COALESCE(resumen_hasta_id, 0) AS hasta
+            FROM conversations WHERE id = $1 AND usuario = $2
+        )
+        SELECT EXISTS (SELECT 1 FROM conv),
+               (SELECT json_agg(json_build_array(r.role, r.content) ORDER BY r.created_at DESC, r.id DESC)
+                FROM (SELECT m.id, m.role, m.content, m.created_at FROM messages m JOIN conv ON m.conv_id = conv.id
+                      ORDER BY m.created_at DESC, m.id DESC LIMIT $3) r),
+               (SELECT resumen FROM conv),
+               (SELECT COUNT(*) FROM messages m JOIN conv ON m.conv_id = conv.id WHERE m.id > conv.hasta),
+               (SELECT json_build_array(m.content, m.tema) FROM messages m JOIN conv ON m.conv_id = conv.id
+                WHERE m.client_id = $4 || ':bot')
+    """),
+    # Par pregunta/respuesta en un único INSERT multi-fila; con client_id un reintento no duplica el turno
+    "turno_insertar": ("(integer, text, text, text, text)", """
+        INSERT INTO messages (conv_id, role, content, tema, created_at, client_id)
+        VALUES ($1, 'user', $2, $4, clock_timestamp(), $5),
+               ($1, 'bot', $3, $4, clock_timestamp(), $5 || ':bot')
+        ON CONFLICT (conv_id, client_id) WHERE client_id IS NOT NULL DO NOTHING
+    """),
+}
+
+def ejecutar_preparada(cursor, nombre, params):
+    """Ejecuta una sentencia preparada en el servidor, declarándola la primera vez en la conexión."""
+    conn = cursor.connection
+    if nombre not in conn.preparadas:
+        tipos, consulta = SENTENCIAS_PREPARADAS[nombre]
+        cursor.execute(f"PREPARE {nombre} {tipos} AS {consulta}")
+        conn.preparadas.add(nombre)
+    cursor.execute(f"EXECUTE {nombre} ({', '.join(['%s'] * len(params))})", params)
 
 def _col_exists(cursor, table, column):
     """Verifica si una columna existe en una tabla."""
@@ -149,107 +417,351 @@ def _ensure_created_at(cursor, table):
         )
         logger.info(f"[migración] Añadido created_at en {table}")
 
+INIT_DB_LOCK_ID = 7240102
+
 def init_db():
     """Inicializa la base de datos creando tablas, migrando y añadiendo índices."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-
-        # Crear tablas
-        c.execute('''CREATE TABLE IF NOT EXISTS progreso
-                     (usuario TEXT PRIMARY KEY,
-                      puntos INTEGER DEFAULT 0,
-                      temas_aprendidos TEXT DEFAULT '',
-                      avatar_id TEXT DEFAULT 'default',
-                      temas_recomendados TEXT DEFAULT '')''')
-
-        if not _col_exists(c, 'progreso', 'temas_recomendados'):
-            c.execute("ALTER TABLE progreso ADD COLUMN temas_recomendados TEXT DEFAULT ''")
-            logger.info("[migración] Añadido temas_recomendados en progreso")
-
-        c.execute('''CREATE TABLE IF NOT EXISTS logs
-                     (id SERIAL PRIMARY KEY,
-                      usuario TEXT,
-                      pregunta TEXT,
-                      respuesta TEXT,
-                      nivel_explicacion TEXT,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS avatars
-                     (avatar_id TEXT PRIMARY KEY,
-                      nombre TEXT,
-                      url TEXT,
-                      animation_url TEXT)''')
-
-        c.execute("""INSERT INTO avatars (avatar_id, nombre, url, animation_url)
-                     VALUES (%s, %s, %s, %s)
-                     ON CONFLICT (avatar_id) DO NOTHING""",
-                  ("default", "Avatar Predeterminado", "/static/favicon.ico", ""))
-
-        c.execute('''CREATE TABLE IF NOT EXISTS quiz_logs
-                     (id SERIAL PRIMARY KEY,
-                      usuario TEXT NOT NULL,
-                      pregunta TEXT NOT NULL,
-                      respuesta TEXT NOT NULL,
-                      es_correcta BOOLEAN NOT NULL,
-                      puntos INTEGER NOT NULL,
-                      tema TEXT NOT NULL,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS conversations
-                     (id SERIAL PRIMARY KEY,
-                      usuario TEXT NOT NULL,
-                      nombre TEXT DEFAULT 'Nuevo Chat',
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS messages
-                     (id SERIAL PRIMARY KEY,
-                      conv_id INTEGER REFERENCES conversations(id) ON DELETE CASCADE,
-                      role TEXT NOT NULL,
-                      content TEXT NOT NULL,
-                      tema TEXT,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-        # Migrar tablas antiguas
-        for table in ["logs", "quiz_logs", "conversations", "messages"]:
-            _ensure_created_at(c, table)
-
-        # Añadir campo tema si no existe
-        if not _col_exists(c, 'messages', 'tema'):
-            c.execute("ALTER TABLE messages ADD COLUMN tema TEXT")
-            logger.info("[migración] Añadido campo tema en messages")
-
-        # Índices existentes
-        c.execute('CREATE INDEX IF NOT EXISTS idx_usuario_progreso ON progreso(usuario)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_usuario_logs ON logs(usuario, created_at)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_usuario_quiz_logs ON quiz_logs(usuario, created_at)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_usuario_conversations ON conversations(usuario, created_at)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_conv_messages ON messages(conv_id, created_at)')
-
-        # Índice adicional para búsquedas en messages.content
-        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_content ON messages(content text_pattern_ops)')
+    with get_db_connection() as conn:
+        try:
+            c = conn.cursor()
+            # Varios workers arrancan a la vez: la inicialización se serializa dentro de la transacción
+            c.execute("SELECT pg_advisory_xact_lock(%s)", (INIT_DB_LOCK_ID,))
+
+            # Crear tablas
+            c.execute('''CREATE TABLE IF NOT EXISTS progreso
+                         (usuario TEXT PRIMARY KEY,
+                          puntos INTEGER DEFAULT 0,
+                          temas_aprendidos TEXT DEFAULT '',
+                          avatar_id TEXT DEFAULT 'default',
+                          temas_recomendados TEXT DEFAULT '')''')
+
+            if not _col_exists(c, 'progreso', 'temas_recomendados'):
+                c.execute("ALTER TABLE progreso ADD COLUMN temas_recomendados TEXT DEFAULT ''")
+                logger.info("[migración] Añadido temas_recomendados en progreso")
+
+            c.execute('''CREATE TABLE IF NOT EXISTS logs
+                         (id SERIAL PRIMARY KEY,
+                          usuario TEXT,
+                          pregunta TEXT,
+                          respuesta TEXT,
+                          nivel_explicacion TEXT,
+                          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+            c.execute('''CREATE TABLE IF NOT EXISTS avatars
+                         (avatar_id TEXT PRIMARY KEY,
+                          nombre TEXT,
+                          url TEXT,
+                          animation_url TEXT)''')
+
+            c.execute("""INSERT INTO avatars (avatar_id, nombre, url, animation_url)
+                         VALUES (%s, %s, %s, %s)
+                         ON CONFLICT (avatar_id) DO NOTHING""",
+                      ("default", "Avatar Predeterminado", "/static/favicon.ico", ""))
+
+            c.execute('''CREATE TABLE IF NOT EXISTS quiz_logs
+                         (id SERIAL PRIMARY KEY,
+                          usuario TEXT NOT NULL,
+                          pregunta TEXT NOT NULL,
+                          respuesta TEXT NOT NULL,
+                          es_correcta BOOLEAN NOT NULL,
+                          puntos INTEGER NOT NULL,
+                          tema TEXT NOT NULL,
+                          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+            # Nivel L2 de las cachés: UNLOGGED porque su contenido es regenerable
+            c.execute('''CREATE UNLOGGED TABLE IF NOT EXISTS cache_l2
+                         (espacio TEXT NOT NULL,
+                          clave TEXT NOT NULL,
+                          valor BYTEA NOT NULL,
+                          expira TIMESTAMP NOT NULL,
+                          PRIMARY KEY (espacio, clave))''')
+            c.execute("DELETE FROM cache_l2 WHERE expira < NOW()")
+
+            # Cálculos (Groq, gTTS) en curso en algún worker, para no repetirlos en paralelo
+            c.execute('''CREATE UNLOGGED TABLE IF NOT EXISTS vuelos_en_curso
+                         (clave TEXT PRIMARY KEY,
+                          expira TIMESTAMPTZ NOT NULL)''')
+            c.execute("DELETE FROM vuelos_en_curso WHERE expira < NOW()")
+            c.execute("DROP TABLE IF EXISTS respuestas_cache")  # reemplazada por cache_l2
+
+            c.execute('''CREATE TABLE IF NOT EXISTS quiz_banco
+                         (id SERIAL PRIMARY KEY,
+                          tema TEXT NOT NULL,
+                          nivel TEXT NOT NULL,
+                          pregunta TEXT NOT NULL,
+                          opciones JSONB NOT NULL,
+                          respuesta_correcta TEXT NOT NULL,
+                          explicaciones JSONB NOT NULL DEFAULT '{}'::jsonb,
+                          huella TEXT NOT NULL,
+                          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                          UNIQUE (tema, nivel, huella))''')
+
+            c.execute('''CREATE TABLE IF NOT EXISTS conversations
+                         (id SERIAL PRIMARY KEY,
+                          usuario TEXT NOT NULL,
+                          nombre TEXT DEFAULT 'Nuevo Chat',
+                          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+            c.execute('''CREATE TABLE IF NOT EXISTS messages
+                         (id SERIAL PRIMARY KEY,
+                          conv_id INTEGER REFERENCES conversations(id) ON DELETE CASCADE,
+                          role TEXT NOT NULL,
+                          content TEXT NOT NULL,
+                          tema TEXT,
+                          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+            # Migrar tablas antiguas
+            for table in ["logs", "quiz_logs", "conversations", "messages"]:
+                _ensure_created_at(c, table)
+
+            # Añadir campo tema si no existe
+            if not _col_exists(c, 'messages', 'tema'):
+                c.execute("ALTER TABLE messages ADD COLUMN tema TEXT")
+                logger.info("[migración] Añadido campo tema en messages")
+
+            if not _col_exists(c, 'messages', 'client_id'):
+                c.execute("ALTER TABLE messages ADD COLUMN client_id TEXT")
+                logger.info("[migración] Añadido campo client_id en messages")
+            c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_id
+                         ON messages(conv_id, client_id) WHERE client_id IS NOT NULL''')
+
+            if not _col_exists(c, 'conversations', 'resumen'):
+                c.execute("ALTER TABLE conversations ADD COLUMN resumen TEXT, ADD COLUMN resumen_hasta_id INTEGER")
+                logger.info("[migración] Añadidos campos resumen y resumen_hasta_id en conversations")
+
+            if not _col_exists(c, 'quiz_banco', 'explicaciones'):
+                c.execute("ALTER TABLE quiz_banco ADD COLUMN explicaciones JSONB NOT NULL DEFAULT '{}'::jsonb")
+                logger.info("[migración] Añadido campo explicaciones en quiz_banco")
+
+            # Índices existentes
+            c.execute('CREATE INDEX IF NOT EXISTS idx_usuario_progreso ON progreso(usuario)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_usuario_logs ON logs(usuario, created_at)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_usuario_quiz_logs ON quiz_logs(usuario, created_at)')
+            # Índices de paginación keyset sobre (created_at, id); sustituyen a los de (x, created_at)
+            c.execute('CREATE INDEX IF NOT EXISTS idx_usuario_conversations_keyset ON conversations(usuario, created_at, id)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_conv_messages_keyset ON messages(conv_id, created_at, id)')
+            c.execute('DROP INDEX IF EXISTS idx_usuario_conversations')
+            c.execute('DROP INDEX IF EXISTS idx_conv_messages')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_quiz_logs_usuario_pregunta ON quiz_logs(usuario, pregunta)')
+
+            # Búsqueda de texto completo en el historial; sustituye al B-tree sobre content completo
+            c.execute('DROP INDEX IF EXISTS idx_messages_content')
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_messages_fts ON messages USING GIN ({TSVECTOR_MENSAJES})")
 
-        conn.commit()
-        logger.info("Base de datos inicializada correctamente (tablas + migraciones + índices)")
-        return True
-    except PsycopgError as e:
-        logger.error("Error al inicializar la base de datos", error=str(e))
-        if conn:
+            conn.commit()
+            logger.info("Base de datos inicializada correctamente (tablas + migraciones + índices)")
+            return True
+        except PsycopgError as e:
+            logger.error("Error al inicializar la base de datos", error=str(e))
             conn.rollback()
-        raise
-    finally:
-        if conn:
-            conn.close()
+            raise
+
+# --- Escritura Diferida (write-behind) ---
+# Opcional: los INSERT de mensajes, quiz_logs y progreso se encolan y un hilo los escribe por lotes.
+ESCRITURA_DIFERIDA = os.getenv('ESCRITURA_DIFERIDA', 'false').lower() == 'true'
+ESCRITURA_COLA_MAX = int(os.getenv('ESCRITURA_COLA_MAX', 2000))
+ESCRITURA_LOTE = int(os.getenv('ESCRITURA_LOTE', 200))  # filas por commit
+ESCRITURA_INTERVALO_MS = int(os.getenv('ESCRITURA_INTERVALO_MS', 100))  # espera máxima antes de hacer commit
+ESCRITURA_ESPERA_COLA = float(os.getenv('ESCRITURA_ESPERA_COLA', 0.5))  # segundos bloqueado con la cola llena
+ESCRITURA_ESPERA_LECTURA = float(os.getenv('ESCRITURA_ESPERA_LECTURA', 2))  # read-your-writes en /messages
+
+# tipo -> (INSERT con VALUES %s para execute_values, plantilla de fila)
+OPERACIONES_DIFERIDAS = {
+    'mensajes': (
+        """INSERT INTO messages (conv_id, role, content, tema, client_id, created_at) VALUES %s
+           ON CONFLICT (conv_id, client_id) WHERE client_id IS NOT NULL DO NOTHING""",
+        "(%s, %s, %s, %s, %s, clock_timestamp())"
+    ),
+    'quiz_logs': (
+        "INSERT INTO quiz_logs (usuario, pregunta, respuesta, es_correcta, tema, puntos) VALUES %s",
+        "(%s, %s, %s, %s, %s, %s)"
+    ),
+    'progreso': (
+        """INSERT INTO progreso (usuario, puntos, temas_aprendidos, avatar_id) VALUES %s
+           ON CONFLICT (usuario) DO UPDATE SET puntos = EXCLUDED.puntos,
+               temas_aprendidos = EXCLUDED.temas_aprendidos, avatar_id = EXCLUDED.avatar_id""",
+        "(%s, %s, %s, %s)"
+    ),
+    'temas_recomendados': (
+        """INSERT INTO progreso (usuario, temas_recomendados) VALUES %s
+           ON CONFLICT (usuario) DO UPDATE SET temas_recomendados = EXCLUDED.temas_recomendados""",
+        "(%s, %s)"
+    ),
+}
+
+def escribir_operaciones(c, operaciones):
+    """Ejecuta una lista de (tipo, fila) agrupada en un INSERT multi-fila por tipo, en orden de llegada."""
+    por_tipo = {}
+    for tipo, fila in operaciones:
+        por_tipo.setdefault(tipo, []).append(fila)
+    for tipo in ('progreso', 'temas_recomendados'):
+        if tipo in por_tipo:
+            # Un upsert multi-fila no puede tocar dos veces al mismo usuario: gana el último
+            por_tipo[tipo] = list({fila[0]: fila for fila in por_tipo[tipo]}.values())
+    for tipo, filas in por_tipo.items():
+        consulta, plantilla = OPERACIONES_DIFERIDAS[tipo]
+        execute_values(c, consulta, filas, template=plantilla, page_size=ESCRITURA_LOTE)
+
+class EscritorDiferido:
+    """Cola acotada drenada por un hilo que agrupa las escrituras y hace commit cada N filas o M ms.
+
+    Cada elemento de la cola es una unidad (llave, [(tipo, fila), ...]) que se escribe en la misma
+    transacción. La llave es el conv_id, o ('progreso', usuario) para el progreso; se lleva la cuenta
+    de unidades pendientes por llave para que una lectura posterior pueda esperar a que estén en la
+    base de datos. La garantía es por proceso: cada worker de gunicorn tiene su propia cola.
+    """
+
+    def __init__(self, activo, max_cola, lote, intervalo_ms):
+        self.activo = activo
+        self.lote = lote
+        self.intervalo = intervalo_ms / 1000
+        self._cola = queue.Queue(maxsize=max_cola)
+        self._pid = None
+        self._hilo = None
+        self._parar = threading.Event()
+        self._pendientes = collections.Counter()
+        self._cond = threading.Condition()
+        self._arranque = threading.Lock()
+        self.contadores = collections.Counter()
+
+    def _asegurar_hilo(self):
+        """Arranca el hilo una vez por proceso; devuelve False si murió (se pasa a escritura síncrona)."""
+        if self._pid == os.getpid():
+            return self._hilo.is_alive()
+        with self._arranque:
+            if self._pid != os.getpid():
+                self._cola = queue.Queue(maxsize=self._cola.maxsize)  # lo heredado del padre no es de este proceso
+                self._pendientes.clear()
+                self._parar.clear()
+                self._hilo = threading.Thread(target=self._bucle, name="escritor-diferido", daemon=True)
+                self._hilo.start()
+                self._pid = os.getpid()
+        return self._hilo.is_alive()
+
+    def encolar(self, llave, operaciones):
+        """Encola una unidad de escritura; False si el modo está desactivado o hay que escribir en línea."""
+        if not self.activo or self._parar.is_set():
+            return False
+        if not self._asegurar_hilo():
+            self.contadores['sincronas'] += 1
+            self._drenar_sincrono()
+            return False
+        with self._cond:
+            self._pendientes[llave] += 1
+        try:
+            # Contrapresión: con la cola llena la petición espera; si sigue llena escribe ella misma
+            self._cola.put((llave, operaciones), timeout=ESCRITURA_ESPERA_COLA)
+        except queue.Full:
+            self._terminar([(llave, operaciones)])
+            self.contadores['cola_llena'] += 1
+            self.esperar(llave)  # conserva el orden respecto a lo ya encolado con la misma llave
+            return False
+        self.contadores['encoladas'] += 1
+        return True
+
+    def esperar(self, llave, timeout=ESCRITURA_ESPERA_LECTURA):
+        """Bloquea hasta que no queden escrituras pendientes de la llave (o se agote el tiempo)."""
+        if not self.activo:
+            return True
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pendientes[llave] <= 0, timeout=timeout)
+
+    def _terminar(self, unidades):
+        with self._cond:
+            for llave, _ in unidades:
+                self._pendientes[llave] -= 1
+                if self._pendientes[llave] <= 0:
+                    del self._pendientes[llave]
+            self._cond.notify_all()
+
+    def _bucle(self):
+        while not (self._parar.is_set() and self._cola.empty()):
+            try:
+                unidades = [self._cola.get(timeout=self.intervalo)]
+            except queue.Empty:
+                continue
+            # Junta unidades hasta completar el lote o agotar el intervalo
+            limite = time.monotonic() + self.intervalo
+            filas = len(unidades[0][1])
+            while filas < self.lote:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    unidad = self._cola.get(timeout=restante)
+                except queue.Empty:
+                    break
+                unidades.append(unidad)
+                filas += len(unidad[1])
+            self._escribir(unidades)
+
+    def _escribir(self, unidades):
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                try:
+                    escribir_operaciones(c, [op for _, ops in unidades for op in ops])
+                    conn.commit()
+                    self.contadores['lotes'] += 1
+                    self.contadores['filas'] += sum(len(ops) for _, ops in unidades)
+                except PsycopgError as e:
+                    conn.rollback()
+                    logger.warning("Lote diferido rechazado, reintentando por unidad", error=str(e), unidades=len(unidades))
+                    # Una fila inválida no debe tirar el lote entero
+                    for llave, ops in unidades:
+                        try:
+                            escribir_operaciones(c, ops)
+                            conn.commit()
+                            self.contadores['filas'] += len(ops)
+                        except PsycopgError as e:
+                            conn.rollback()
+                            self.contadores['fallidas'] += 1
+                            logger.error("Escritura diferida descartada", error=str(e), llave=str(llave))
+        except Exception as e:
+            self.contadores['fallidas'] += len(unidades)
+            logger.error("Error en escritor diferido", error=str(e), unidades=len(unidades))
+        finally:
+            self._terminar(unidades)
+
+    def _drenar_sincrono(self):
+        """Escribe en la petición actual lo que quedó en la cola de un escritor que ya no corre."""
+        unidades = []
+        while True:
+            try:
+                unidades.append(self._cola.get_nowait())
+            except queue.Empty:
+                break
+        if unidades:
+            logger.warning("Escritor diferido detenido, escribiendo cola pendiente en línea", unidades=len(unidades))
+            self._escribir(unidades)
+
+    def detener(self, timeout=10):
+        """Vacía la cola antes de salir del proceso."""
+        self._parar.set()
+        if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+            self._hilo.join(timeout)
+        if self._pid == os.getpid():
+            self._drenar_sincrono()
+
+    def stats(self):
+        return {
+            "activo": self.activo,
+            "en_cola": self._cola.qsize(),
+            "hilo_vivo": bool(self._pid == os.getpid() and self._hilo and self._hilo.is_alive()),
+            **self.contadores
+        }
+
+escritor_diferido = EscritorDiferido(ESCRITURA_DIFERIDA, ESCRITURA_COLA_MAX, ESCRITURA_LOTE, ESCRITURA_INTERVALO_MS)
+atexit.register(escritor_diferido.detener)
 
 def cargar_progreso(usuario):
     """Carga el progreso de un usuario desde la base de datos."""
+    escritor_diferido.esperar(('progreso', usuario))
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT puntos, temas_aprendidos, avatar_id FROM progreso WHERE usuario = %s", (usuario,))
-        row = c.fetchone()
-        conn.close()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT puntos, temas_aprendidos, avatar_id FROM progreso WHERE usuario = %s", (usuario,))
+            row = c.fetchone()
         if row:
             return {"puntos": row[0], "temas_aprendidos": row[1], "avatar_id": row[2]}
         return {"puntos": 0, "temas_aprendidos": "", "avatar_id": "default"}
@@ -259,39 +771,233 @@ def cargar_progreso(usuario):
 
 def guardar_progreso(usuario, puntos, temas_aprendidos, avatar_id="default"):
     """Guarda o actualiza el progreso de un usuario en la base de datos."""
+    if escritor_diferido.encolar(('progreso', usuario), [('progreso', (usuario, puntos, temas_aprendidos, avatar_id))]):
+        return
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO progreso (usuario, puntos, temas_aprendidos, avatar_id) VALUES (%s, %s, %s, %s) "
-                  "ON CONFLICT (usuario) DO UPDATE SET puntos = %s, temas_aprendidos = %s, avatar_id = %s",
-                  (usuario, puntos, temas_aprendidos, avatar_id, puntos, temas_aprendidos, avatar_id))
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO progreso (usuario, puntos, temas_aprendidos, avatar_id) VALUES (%s, %s, %s, %s) "
+                      "ON CONFLICT (usuario) DO UPDATE SET puntos = %s, temas_aprendidos = %s, avatar_id = %s",
+                      (usuario, puntos, temas_aprendidos, avatar_id, puntos, temas_aprendidos, avatar_id))
+            conn.commit()
         logger.info(f"Progreso guardado", usuario=usuario, puntos=puntos, temas=temas_aprendidos)
     except PsycopgError as e:
         logger.error("Error al guardar progreso", error=str(e))
 
+def guardar_temas_recomendados(usuario, temas_recomendados):
+    """Guarda los últimos temas recomendados a un usuario."""
+    temas = ",".join(temas_recomendados)
+    if escritor_diferido.encolar(('progreso', usuario), [('temas_recomendados', (usuario, temas))]):
+        return
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO progreso (usuario, temas_recomendados) VALUES (%s, %s) "
+                      "ON CONFLICT (usuario) DO UPDATE SET temas_recomendados = EXCLUDED.temas_recomendados",
+                      (usuario, temas))
+            conn.commit()
+    except PsycopgError as e:
+        logger.error("Error al guardar temas recomendados", error=str(e), usuario=usuario)
+
 def guardar_mensaje(usuario, conv_id, role, content, tema=None):
     """Guarda un mensaje en la base de datos."""
+    if escritor_diferido.encolar(conv_id, [('mensajes', (conv_id, role, content, tema, None))]):
+        return
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO messages (conv_id, role, content, tema) VALUES (%s, %s, %s, %s)", 
-                  (conv_id, role, content, tema))
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO messages (conv_id, role, content, tema) VALUES (%s, %s, %s, %s)",
+                      (conv_id, role, content, tema))
+            conn.commit()
         logger.info(f"Mensaje guardado", usuario=usuario, conv_id=conv_id, role=role, tema=tema)
     except PsycopgError as e:
         logger.error("Error al guardar mensaje", error=str(e))
 
+def cargar_estado_turno(usuario, conv_id, client_id=None):
+    """Devuelve (pertenece_al_usuario, mensajes_recientes, resumen, mensajes_sin_resumir, guardada) en una
+    sola consulta; los mensajes son pares [role, content] del más reciente al más antiguo y `guardada` es
+    [respuesta, tema] si el turno con ese client_id ya se guardó (un reintento), o None."""
+    escritor_diferido.esperar(conv_id)  # el turno anterior puede seguir en la cola de escritura
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            ejecutar_preparada(c, "turno_contexto", (conv_id, usuario, HISTORIAL_MAX_MENSAJES, client_id))
+            valida, recientes, resumen, sin_resumir, guardada = c.fetchone()
+            conn.commit()
+        return valida, recientes or [], resumen, sin_resumir or 0, guardada
+    except PsycopgError as e:
+        logger.error("Error al cargar estado del turno", error=str(e), conv_id=conv_id)
+        return False, [], None, 0, None
+
+# --- Historial de Conversación para Prompts ---
+HISTORIAL_MAX_MENSAJES = int(os.getenv('HISTORIAL_MAX_MENSAJES', 12))
+# Presupuesto aproximado de tokens de historial por nivel (los niveles más detallados necesitan más contexto)
+HISTORIAL_TOKENS = {
+    'basica': int(os.getenv('HISTORIAL_TOKENS_BASICA', 300)),
+    'ejemplos': int(os.getenv('HISTORIAL_TOKENS_EJEMPLOS', 600)),
+    'intermedio': int(os.getenv('HISTORIAL_TOKENS_INTERMEDIO', 600)),
+    'avanzada': int(os.getenv('HISTORIAL_TOKENS_AVANZADA', 900)),
+}
+
+def estimar_tokens(texto):
+    """Aproximación barata de tokens (~4 caracteres por token en español)."""
+    return len(texto) // 4 + 1
+
+def contexto_historial(mensajes, nivel):
+    """Arma el bloque de historial con los mensajes más recientes que quepan en el presupuesto del nivel."""
+    return historial_en_presupuesto(mensajes, nivel)[0]
+
+def historial_en_presupuesto(mensajes, nivel):
+    """Como contexto_historial, pero devuelve además cuántos mensajes entraron en el presupuesto."""
+    presupuesto = HISTORIAL_TOKENS.get(nivel, HISTORIAL_TOKENS['basica'])
+    lineas = []
+    for role, content in mensajes:  # del más reciente al más antiguo
+        linea = f"- {'Estudiante' if role == 'user' else 'YELIA'}: {' '.join(content.split())}"
+        costo = estimar_tokens(linea)
+        if costo > presupuesto:
+            if not lineas:
+                lineas.append(linea[:presupuesto * 4] + "…")  # al menos el último mensaje, recortado
+            break
+        presupuesto -= costo
+        lineas.append(linea)
+    texto = "\nHistorial reciente:\n" + "\n".join(reversed(lineas)) if lineas else ""
+    return texto, len(lineas)
+
+def cargar_contexto_historial(conv_id, nivel):
+    """Lee los últimos mensajes de la conversación y devuelve el bloque de historial para el prompt."""
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT role, content FROM messages
+                WHERE conv_id = %s
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            """, (conv_id, HISTORIAL_MAX_MENSAJES))
+            mensajes = c.fetchall()
+            conn.commit()
+    except PsycopgError as e:
+        logger.error("Error al cargar historial", error=str(e), conv_id=conv_id)
+        return ""
+    return contexto_historial(mensajes, nivel)
+
+# --- Resúmenes Incrementales de Conversación ---
+# Lo que queda fuera de la ventana de historial se condensa en conversations.resumen con un modelo barato.
+RESUMEN_CADA = int(os.getenv('RESUMEN_CADA', 8))  # mensajes del historial que se adelantan al resumen en cada actualización
+RESUMEN_MODELO = os.getenv('RESUMEN_MODELO', 'llama3-8b-8192')
+RESUMEN_MAX_TOKENS = int(os.getenv('RESUMEN_MAX_TOKENS', 200))
+
+resumen_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="resumen")
+_resumenes_en_curso = set()
+_resumenes_lock = threading.Lock()
+
+def mensajes_a_conservar(sin_resumir, en_prompt):
+    """Cuántos mensajes recientes deja fuera del resumen, o None si todavía no hace falta resumir.
+
+    en_prompt es lo que realmente entró en el presupuesto de tokens del historial. Se resume en cuanto
+    el historial deja fuera (o está por dejar fuera) un mensaje sin resumir, y se adelantan RESUMEN_CADA
+    mensajes que aún van en el prompt para no llamar al modelo en cada turno. Así ningún mensaje queda
+    fuera del resumen y del historial a la vez.
+    """
+    conservar = max(0, en_prompt - RESUMEN_CADA)
+    if sin_resumir > en_prompt or (sin_resumir == en_prompt and sin_resumir - conservar >= RESUMEN_CADA):
+        return conservar
+    return None
+
+def programar_resumen(conv_id, conservar):
+    """Encola la actualización del resumen de una conversación (una a la vez por conversación)."""
+    with _resumenes_lock:
+        if conv_id in _resumenes_en_curso:
+            return
+        _resumenes_en_curso.add(conv_id)
+    resumen_executor.submit(_actualizar_resumen_seguro, conv_id, conservar)
+
+def _actualizar_resumen_seguro(conv_id, conservar):
+    try:
+        actualizar_resumen(conv_id, conservar)
+    except Exception as e:
+        logger.error("Error al actualizar resumen de conversación", error=str(e), conv_id=conv_id)
+    finally:
+        with _resumenes_lock:
+            _resumenes_en_curso.discard(conv_id)
+
+def actualizar_resumen(conv_id, conservar):
+    """Incorpora al resumen los mensajes sin resumir, salvo los `conservar` más recientes."""
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT resumen, COALESCE(resumen_hasta_id, 0) FROM conversations WHERE id = %s", (conv_id,))
+        row = c.fetchone()
+        if not row:
+            conn.commit()
+            return False
+        resumen_previo, hasta = row
+        # Mensajes sin resumir, excepto los más recientes que siguen entrando en el historial del prompt
+        c.execute("""
+            SELECT id, role, content FROM (
+                SELECT id, role, content, created_at FROM messages
+                WHERE conv_id = %s AND id > %s
+                ORDER BY created_at DESC, id DESC
+                OFFSET %s
+            ) viejos
+            ORDER BY created_at ASC, id ASC
+        """, (conv_id, hasta, conservar))
+        viejos = c.fetchall()
+        conn.commit()
+    if not viejos:
+        return False
+
+    transcripcion = "\n".join(
+        f"{'Estudiante' if role == 'user' else 'YELIA'}: {' '.join(content.split())[:600]}" for _, role, content in viejos
+    )
+    prompt = (
+        "Resume en español, en máximo 120 palabras y en texto plano, una tutoría de Programación Avanzada. "
+        "Conserva los temas tratados, dudas del estudiante, ejemplos mencionados y acuerdos; omite saludos. "
+        f"Resumen previo: {resumen_previo or '(ninguno)'}\n"
+        f"Mensajes nuevos a incorporar:\n{transcripcion}"
+    )
+    completion = call_groq_api(
+        messages=[{"role": "system", "content": prompt}],
+        model=RESUMEN_MODELO,
+        max_tokens=RESUMEN_MAX_TOKENS,
+        temperature=0.2,
+        prioridad=PRIORIDAD_FONDO
+    )
+    resumen = completion.choices[0].message.content.strip()
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        # Sólo si nadie más (otro worker) lo actualizó mientras tanto
+        c.execute("""
+            UPDATE conversations SET resumen = %s, resumen_hasta_id = %s
+            WHERE id = %s AND COALESCE(resumen_hasta_id, 0) = %s
+        """, (resumen, viejos[-1][0], conv_id, hasta))
+        actualizado = c.rowcount == 1
+        conn.commit()
+    logger.info("Resumen de conversación actualizado", conv_id=conv_id, mensajes=len(viejos), aplicado=actualizado)
+    return actualizado
+
+def guardar_turno(usuario, conv_id, pregunta, respuesta, tema=None, client_id=None):
+    """Guarda la pregunta del usuario y la respuesta del bot en un solo INSERT y commit."""
+    if escritor_diferido.encolar(conv_id, [
+        ('mensajes', (conv_id, 'user', pregunta, tema, client_id)),
+        ('mensajes', (conv_id, 'bot', respuesta, tema, client_id and f"{client_id}:bot"))
+    ]):
+        return
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            ejecutar_preparada(c, "turno_insertar", (conv_id, pregunta, respuesta, tema, client_id))
+            conn.commit()
+        logger.info("Turno guardado", usuario=usuario, conv_id=conv_id, tema=tema)
+    except PsycopgError as e:
+        logger.error("Error al guardar turno", error=str(e), conv_id=conv_id)
+
 def validar_conversacion(usuario, conv_id):
     """Valida si una conversación pertenece al usuario y existe."""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT id FROM conversations WHERE id = %s AND usuario = %s", (conv_id, usuario))
-        result = c.fetchone()
-        conn.close()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT id FROM conversations WHERE id = %s AND usuario = %s", (conv_id, usuario))
+            result = c.fetchone()
         return result is not None
     except PsycopgError as e:
         logger.error("Error al validar conversación", error=str(e))
@@ -300,31 +1006,235 @@ def validar_conversacion(usuario, conv_id):
 def crear_nueva_conversacion(usuario, nombre="Nuevo Chat"):
     """Crea una nueva conversación y devuelve su ID."""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("INSERT INTO conversations (usuario, nombre) VALUES (%s, %s) RETURNING id", (usuario, nombre))
-        conv_id = c.fetchone()[0]
-        saludo_inicial = "Hola, soy YELIA 👋. ¿En qué tema de Programación Avanzada quieres que te ayude hoy?"
-        c.execute("INSERT INTO messages (conv_id, role, content, tema) VALUES (%s, %s, %s, %s)",
-                  (conv_id, 'bot', saludo_inicial, TEMAS_DISPONIBLES[0] if TEMAS_DISPONIBLES else 'General'))
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO conversations (usuario, nombre) VALUES (%s, %s) RETURNING id", (usuario, nombre))
+            conv_id = c.fetchone()[0]
+            c.execute("INSERT INTO messages (conv_id, role, content, tema) VALUES (%s, %s, %s, %s)",
+                      (conv_id, 'bot', SALUDO_INICIAL, TEMAS_DISPONIBLES[0] if TEMAS_DISPONIBLES else 'General'))
+            conn.commit()
         logger.info("Nueva conversación creada", conv_id=conv_id, usuario=usuario, nombre=nombre)
         return conv_id
     except PsycopgError as e:
         logger.error("Error al crear nueva conversación", error=str(e))
         raise
 
+# --- Planificador de Llamadas a Groq ---
+# Toda llamada al LLM pasa por aquí: concurrencia global y por modelo, cubetas de peticiones y tokens
+# por minuto según el plan de Groq, y prioridad del chat sobre las tareas de fondo.
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_FONDO = 10
+LLM_CONCURRENCIA_GLOBAL = int(os.getenv('LLM_CONCURRENCIA_GLOBAL', 16))
+LLM_CONCURRENCIA_MODELO = int(os.getenv('LLM_CONCURRENCIA_MODELO', 8))
+LLM_ESPERA_MAX = float(os.getenv('LLM_ESPERA_MAX', 30))  # segundos en cola antes de rendirse
+LLM_BACKOFF_BASE_MS = int(os.getenv('LLM_BACKOFF_BASE_MS', 500))
+LLM_BACKOFF_MAX_MS = int(os.getenv('LLM_BACKOFF_MAX_MS', 10000))
+# (peticiones, tokens) por minuto de cada modelo; se pueden ajustar con GROQ_LIMITES='{"modelo": [rpm, tpm]}'
+LIMITES_GROQ = {
+    'llama3-70b-8192': (30, 6000),
+    'llama3-8b-8192': (30, 30000),
+    **{modelo: tuple(v) for modelo, v in json.loads(os.getenv('GROQ_LIMITES', '{}')).items()}
+}
+LIMITE_GROQ_DEFECTO = (30, 6000)
+# Las cubetas viven en cada proceso: el límite del plan se reparte entre los workers de gunicorn
+# (gunicorn.conf.py exporta WEB_CONCURRENCY con el número real de workers)
+LLM_PROCESOS = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+# Sólo estos fallos pueden salir bien al reintentar (APITimeoutError hereda de APIConnectionError);
+# un 400, 401 o 404 se devuelve al momento.
+ERRORES_REINTENTABLES = (groq.RateLimitError, groq.APIConnectionError, groq.InternalServerError)
+
+class LLMSaturado(Exception):
+    """No hubo turno en el planificador dentro de LLM_ESPERA_MAX."""
+
+class _Cubeta:
+    """Cubeta de tokens con capacidad `por_minuto` que se rellena de forma continua."""
+
+    def __init__(self, por_minuto):
+        self.capacidad = float(por_minuto)
+        self.nivel = float(por_minuto)
+        self._t = time.monotonic()
+
+    def espera(self, cantidad, ahora):
+        """Segundos que faltan para poder consumir `cantidad` (0 si ya se puede)."""
+        self.nivel = min(self.capacidad, self.nivel + (ahora - self._t) * self.capacidad / 60)
+        self._t = ahora
+        falta = min(cantidad, self.capacidad) - self.nivel
+        return max(0.0, falta * 60 / self.capacidad)
+
+    def ajustar(self, delta):
+        self.nivel = min(self.capacidad, self.nivel + delta)
+
+def tokens_estimados(messages, max_tokens):
+    """Tokens que una llamada puede gastar del presupuesto por minuto: prompt estimado + salida máxima."""
+    return sum(estimar_tokens(m.get("content") or "") for m in messages) + max_tokens
+
+def _retry_after(error):
+    """Segundos indicados por la cabecera Retry-After de un error de Groq, si la trae."""
+    respuesta = getattr(error, "response", None)
+    try:
+        return float(respuesta.headers.get("retry-after")) if respuesta is not None else None
+    except (TypeError, ValueError):
+        return None
+
+class PlanificadorLLM:
+    """Reparte turnos de llamada a Groq por orden de (prioridad, llegada).
+
+    Un turno se concede cuando hay hueco global y del modelo, y las cubetas de peticiones y tokens
+    del modelo alcanzan; mientras una petición de mayor prioridad espere por un modelo, las de menor
+    prioridad para ese mismo modelo no la adelantan.
+    """
+
+    def __init__(self, concurrencia_global, concurrencia_modelo, limites, procesos=1):
+        self.concurrencia_global = concurrencia_global
+        self.concurrencia_modelo = concurrencia_modelo
+        self.limites = limites
+        self.procesos = procesos  # workers que comparten el mismo límite de Groq
+        self._cond = threading.Condition()
+        self._cola = []  # (prioridad, orden, modelo, tokens)
+        self._orden = itertools.count()
+        self._en_curso = collections.Counter()
+        self._cubetas = {}
+        self._pausa_hasta = {}  # modelo -> instante hasta el que Groq pidió esperar (429)
+        self._esperas = collections.defaultdict(lambda: [0, 0.0, 0.0])  # prioridad -> [n, total_ms, max_ms]
+        self.contadores = collections.Counter()
+
+    def _cubetas_de(self, modelo):
+        if modelo not in self._cubetas:
+            rpm, tpm = self.limites.get(modelo, LIMITE_GROQ_DEFECTO)
+            self._cubetas[modelo] = (_Cubeta(rpm / self.procesos), _Cubeta(tpm / self.procesos))
+        return self._cubetas[modelo]
+
+    def _espera_necesaria(self, modelo, tokens, ahora):
+        """0 si puede salir ya, segundos si depende del reloj, None si espera a que otro termine."""
+        if sum(self._en_curso.values()) >= self.concurrencia_global or self._en_curso[modelo] >= self.concurrencia_modelo:
+            return None
+        pausa = self._pausa_hasta.get(modelo, 0) - ahora
+        if pausa > 0:
+            return pausa
+        peticiones, tokens_min = self._cubetas_de(modelo)
+        return max(peticiones.espera(1, ahora), tokens_min.espera(tokens, ahora))
+
+    def adquirir(self, modelo, tokens, prioridad=PRIORIDAD_INTERACTIVA):
+        """Bloquea hasta obtener turno; lanza LLMSaturado si se supera LLM_ESPERA_MAX."""
+        entrada = (prioridad, next(self._orden), modelo, tokens)
+        inicio = time.monotonic()
+        with self._cond:
+            self._cola.append(entrada)
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    elegida, proxima, bloqueados = None, None, set()
+                    for candidata in sorted(self._cola):
+                        if candidata[2] in bloqueados:
+                            continue
+                        espera = self._espera_necesaria(candidata[2], candidata[3], ahora)
+                        if espera == 0:
+                            elegida = candidata
+                            break
+                        bloqueados.add(candidata[2])
+                        if espera is not None:
+                            proxima = espera if proxima is None else min(proxima, espera)
+                    if elegida is entrada:
+                        break
+                    if elegida is not None:
+                        self._cond.notify_all()  # le toca a otra petición que está esperando
+                    restante = inicio + LLM_ESPERA_MAX - ahora
+                    if restante <= 0:
+                        self.contadores['saturado'] += 1
+                        raise LLMSaturado(f"Sin turno para {modelo} tras {LLM_ESPERA_MAX}s")
+                    self._cond.wait(min(restante, proxima) if proxima else restante)
+            finally:
+                self._cola.remove(entrada)
+            peticiones, tokens_min = self._cubetas_de(modelo)
+            peticiones.ajustar(-1)
+            tokens_min.ajustar(-min(tokens, tokens_min.capacidad))
+            self._en_curso[modelo] += 1
+            espera_ms = (time.monotonic() - inicio) * 1000
+            estadistica = self._esperas[prioridad]
+            estadistica[0] += 1
+            estadistica[1] += espera_ms
+            estadistica[2] = max(estadistica[2], espera_ms)
+
+    def liberar(self, modelo, tokens, tokens_reales=None):
+        """Devuelve el turno; con el uso real se corrige lo descontado de la cubeta de tokens."""
+        with self._cond:
+            self._en_curso[modelo] -= 1
+            if tokens_reales is not None:
+                self._cubetas_de(modelo)[1].ajustar(min(tokens, self._cubetas_de(modelo)[1].capacidad) - tokens_reales)
+            self._cond.notify_all()
+
+    def pausar(self, modelo, segundos):
+        """Detiene las llamadas a un modelo tras un 429 durante lo que indique Retry-After."""
+        with self._cond:
+            self._pausa_hasta[modelo] = max(self._pausa_hasta.get(modelo, 0), time.monotonic() + segundos)
+
+    def ejecutar(self, modelo, tokens, prioridad, llamada, retener=False):
+        """Ejecuta `llamada()` con turno, reintentando sólo errores transitorios con backoff y jitter.
+
+        Con `retener=True` el turno sigue ocupado al volver (streams) y el llamador debe liberarlo.
+        """
+        for intento in range(1, GROQ_RETRY_ATTEMPTS + 1):
+            self.adquirir(modelo, tokens, prioridad)
+            self.contadores['llamadas'] += 1
+            try:
+                respuesta = llamada()
+            except ERRORES_REINTENTABLES as e:
+                self.liberar(modelo, tokens)
+                self.contadores['errores_reintentables'] += 1
+                if intento == GROQ_RETRY_ATTEMPTS:
+                    raise
+                techo = min(LLM_BACKOFF_MAX_MS, LLM_BACKOFF_BASE_MS * 2 ** (intento - 1)) / 1000
+                espera = techo / 2 + random.uniform(0, techo / 2)
+                retry_after = _retry_after(e)
+                logger.warning("Reintentando llamada a Groq", modelo=modelo, intento=intento,
+                               espera=round(max(espera, retry_after or 0), 2), error=str(e))
+                self.contadores['reintentos'] += 1
+                if isinstance(e, groq.RateLimitError):
+                    self.contadores['rate_limit'] += 1
+                    self.pausar(modelo, max(espera, retry_after or 0))  # afecta también a las demás peticiones
+                else:
+                    time.sleep(espera)
+                continue
+            except Exception:
+                self.liberar(modelo, tokens)
+                self.contadores['errores'] += 1
+                raise
+            if not retener:
+                uso = getattr(respuesta, "usage", None)
+                self.liberar(modelo, tokens, getattr(uso, "total_tokens", None))
+            return respuesta
+
+    def stats(self):
+        with self._cond:
+            ahora = time.monotonic()
+            return {
+                "en_cola": len(self._cola),
+                "en_cola_por_prioridad": dict(collections.Counter(e[0] for e in self._cola)),
+                "en_curso": {m: n for m, n in self._en_curso.items() if n},
+                "espera_ms": {
+                    prioridad: {"n": n, "media": round(total / n, 1) if n else 0.0, "max": round(maximo, 1)}
+                    for prioridad, (n, total, maximo) in self._esperas.items()
+                },
+                "pausado_s": {m: round(t - ahora, 1) for m, t in self._pausa_hasta.items() if t > ahora},
+                "cubetas": {m: {"peticiones": round(p.nivel, 1), "tokens": round(t.nivel)} for m, (p, t) in self._cubetas.items()},
+                **self.contadores
+            }
+
+planificador_llm = PlanificadorLLM(LLM_CONCURRENCIA_GLOBAL, LLM_CONCURRENCIA_MODELO, LIMITES_GROQ, LLM_PROCESOS)
+
 # --- Funciones Auxiliares ---
-@retrying.retry(wait_fixed=GROQ_RETRY_WAIT, stop_max_attempt_number=GROQ_RETRY_ATTEMPTS)
-def call_groq_api(messages, model, max_tokens, temperature):
-    """Llama a la API de Groq con reintentos."""
+def call_groq_api(messages, model, max_tokens, temperature, prioridad=PRIORIDAD_INTERACTIVA, **kwargs):
+    """Llama a la API de Groq a través del planificador; kwargs extra (p. ej. response_format) se pasan tal cual."""
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature
+        response = planificador_llm.ejecutar(
+            model, tokens_estimados(messages, max_tokens), prioridad,
+            lambda: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **kwargs
+            )
         )
         if not response.choices or not response.choices[0].message.content:
             raise ValueError("Respuesta de Groq vacía o inválida")
@@ -335,43 +1245,715 @@ def call_groq_api(messages, model, max_tokens, temperature):
             raise Exception("Groq API unavailable (503). Check https://groqstatus.com/")
         raise
 
+# --- Cachés por Espacio de Nombres ---
+# Cada espacio tiene su propio TTL y presupuesto en bytes, así una ráfaga en uno no desaloja a los demás.
+CACHE_L2 = os.getenv('CACHE_L2', 'postgres').lower()  # 'postgres', 'disco' o '' (sólo memoria)
+CACHE_DIR = os.getenv('CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache_l2'))
+RESPUESTAS_CACHE_TTL = int(os.getenv('RESPUESTAS_CACHE_TTL', 7 * 24 * 60 * 60))
+RESPUESTAS_CACHE_MAX_BYTES = int(os.getenv('RESPUESTAS_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+RESPUESTAS_CACHE_L2_MAX_BYTES = int(os.getenv('RESPUESTAS_CACHE_L2_MAX_BYTES', 64 * 1024 * 1024))
+CACHE_L2_PODA_SEG = int(os.getenv('CACHE_L2_PODA_SEG', 60))  # cada cuánto un proceso poda L2 tras escribir
+RECURSOS_CACHE_TTL = int(os.getenv('RECURSOS_CACHE_TTL', 72 * 60 * 60))
+RECURSOS_CACHE_MAX_BYTES = int(os.getenv('RECURSOS_CACHE_MAX_BYTES', 1024 * 1024))
+BOOTSTRAP_MENSAJES = int(os.getenv('BOOTSTRAP_MENSAJES', 50))  # mensajes de la conversación actual al cargar
+
+class _TTLCacheContada(TTLCache):
+    """TTLCache que cuenta los desalojos por falta de espacio."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.desalojos = 0
+
+    def popitem(self):
+        self.desalojos += 1
+        return super().popitem()
+
+class L2Postgres:
+    """Nivel compartido entre workers en la tabla UNLOGGED cache_l2 (no pasa por el WAL)."""
+
+    def get(self, espacio, clave):
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT valor FROM cache_l2 WHERE espacio = %s AND clave = %s AND expira > NOW()",
+                (espacio, clave)
+            )
+            row = c.fetchone()
+            conn.commit()
+        return bytes(row[0]) if row else None
+
+    def set(self, espacio, clave, valor, ttl):
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO cache_l2 (espacio, clave, valor, expira)
+                VALUES (%s, %s, %s, NOW() + make_interval(secs => %s))
+                ON CONFLICT (espacio, clave) DO UPDATE SET valor = EXCLUDED.valor, expira = EXCLUDED.expira
+            """, (espacio, clave, psycopg2.Binary(valor), ttl))
+            conn.commit()
+
+    def delete(self, espacio, clave):
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM cache_l2 WHERE espacio = %s AND clave = %s", (espacio, clave))
+            conn.commit()
+
+    def podar(self, espacio, max_bytes, ttl):
+        """Borra lo caducado del espacio y, si aún excede `max_bytes`, las entradas más próximas a caducar."""
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("DELETE FROM cache_l2 WHERE espacio = %s AND expira < NOW()", (espacio,))
+            caducadas = c.rowcount
+            c.execute("""
+                DELETE FROM cache_l2 WHERE espacio = %s AND clave IN (
+                    SELECT clave FROM (
+                        SELECT clave, SUM(octet_length(valor)) OVER (ORDER BY expira DESC, clave) AS acumulado
+                        FROM cache_l2 WHERE espacio = %s
+                    ) t WHERE acumulado > %s
+                )
+            """, (espacio, espacio, max_bytes))
+            desalojadas = c.rowcount
+            conn.commit()
+        return caducadas, desalojadas
+
+class L2Disco:
+    """Nivel compartido entre workers en disco local; la caducidad se toma del mtime del archivo."""
+
+    def __init__(self, directorio):
+        self.directorio = directorio
+
+    def _ruta(self, espacio, clave):
+        return os.path.join(self.directorio, espacio, hashlib.sha256(clave.encode('utf-8')).hexdigest())
+
+    def get(self, espacio, clave, ttl=None):
+        ruta = self._ruta(espacio, clave)
+        try:
+            if ttl is not None and time.time() - os.path.getmtime(ruta) > ttl:
+                os.remove(ruta)
+                return None
+            with open(ruta, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, espacio, clave, valor, ttl):
+        ruta = self._ruta(espacio, clave)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, 'wb') as f:
+            f.write(valor)
+        os.replace(temporal, ruta)
+
+    def delete(self, espacio, clave):
+        try:
+            os.remove(self._ruta(espacio, clave))
+        except FileNotFoundError:
+            pass
+
+    def podar(self, espacio, max_bytes, ttl):
+        """Borra lo caducado del espacio y, si aún excede `max_bytes`, los archivos más antiguos."""
+        ahora = time.time()
+        vigentes, caducadas, desalojadas = [], 0, 0
+        try:
+            entradas = list(os.scandir(os.path.join(self.directorio, espacio)))
+        except FileNotFoundError:
+            return 0, 0
+        for entrada in entradas:
+            try:
+                info = entrada.stat()
+                if ahora - info.st_mtime > ttl:
+                    os.remove(entrada.path)
+                    caducadas += 1
+                elif not entrada.name.endswith('.tmp'):  # un .tmp vigente lo está escribiendo otro proceso
+                    vigentes.append((info.st_mtime, info.st_size, entrada.path))
+            except FileNotFoundError:
+                pass
+        acumulado = 0
+        for _, tamano, ruta in sorted(vigentes, reverse=True):
+            acumulado += tamano
+            if acumulado > max_bytes:
+                try:
+                    os.remove(ruta)
+                    desalojadas += 1
+                except FileNotFoundError:
+                    pass
+        return caducadas, desalojadas
+
+class CacheNamespace:
+    """Caché de bytes de un espacio de nombres: L1 en proceso (LRU + TTL por bytes) y L2 compartida opcional.
+
+    L2 tiene su propio presupuesto en bytes (`max_bytes_l2`); tras escribir, cada proceso poda el espacio
+    como mucho una vez cada CACHE_L2_PODA_SEG segundos, así que puede excederlo brevemente.
+    """
+
+    def __init__(self, nombre, ttl, max_bytes, l2=None, max_bytes_l2=None):
+        self.nombre = nombre
+        self.ttl = ttl
+        self.l2 = l2
+        self.max_bytes_l2 = max_bytes_l2 if max_bytes_l2 is not None else max_bytes
+        self._memoria = _TTLCacheContada(maxsize=max_bytes, ttl=ttl, getsizeof=len)
+        self._lock = threading.Lock()
+        self._proxima_poda = 0.0
+        self._stats = {"hits_l1": 0, "hits_l2": 0, "misses": 0, "escrituras": 0, "errores_l2": 0,
+                       "caducadas_l2": 0, "desalojos_l2": 0}
+
+    def _contar(self, campo):
+        with self._lock:
+            self._stats[campo] += 1
+
+    def _guardar_en_memoria(self, clave, valor):
+        with self._lock:
+            try:
+                self._memoria[clave] = valor
+            except ValueError:
+                pass  # Valor mayor que todo el presupuesto de memoria
+
+    def _l2(self, operacion, *args):
+        try:
+            if isinstance(self.l2, L2Disco) and operacion == 'get':
+                return self.l2.get(*args, ttl=self.ttl)
+            return getattr(self.l2, operacion)(*args)
+        except (PsycopgError, pool.PoolError, OSError) as e:
+            self._contar("errores_l2")
+            logger.error("Error en caché L2", espacio=self.nombre, operacion=operacion, error=str(e))
+            return None
+
+    def get(self, clave):
+        """Devuelve los bytes cacheados o None, consultando L1 y luego L2."""
+        with self._lock:
+            valor = self._memoria.get(clave)
+        if valor is not None:
+            self._contar("hits_l1")
+            return valor
+        if self.l2 is not None:
+            valor = self._l2('get', self.nombre, clave)
+            if valor is not None:
+                self._guardar_en_memoria(clave, valor)
+                self._contar("hits_l2")
+                return valor
+        self._contar("misses")
+        return None
+
+    def set(self, clave, valor):
+        """Guarda bytes en L1 y, si hay, en L2."""
+        self._guardar_en_memoria(clave, valor)
+        if self.l2 is not None:
+            self._l2('set', self.nombre, clave, valor, self.ttl)
+            self._podar_l2_si_toca()
+        self._contar("escrituras")
+
+    def _podar_l2_si_toca(self):
+        with self._lock:
+            ahora = time.monotonic()
+            if ahora < self._proxima_poda:
+                return
+            self._proxima_poda = ahora + CACHE_L2_PODA_SEG
+        podadas = self._l2('podar', self.nombre, self.max_bytes_l2, self.ttl)
+        if podadas:
+            with self._lock:
+                self._stats["caducadas_l2"] += podadas[0]
+                self._stats["desalojos_l2"] += podadas[1]
+
+    def get_texto(self, clave):
+        valor = self.get(clave)
+        return valor.decode('utf-8') if valor is not None else None
+
+    def set_texto(self, clave, texto):
+        self.set(clave, texto.encode('utf-8'))
+
+    def delete(self, clave):
+        with self._lock:
+            self._memoria.pop(clave, None)
+        if self.l2 is not None:
+            self._l2('delete', self.nombre, clave)
+
+    def stats(self):
+        """Devuelve contadores de aciertos, fallos y desalojos del espacio."""
+        with self._lock:
+            stats = dict(self._stats, entradas_l1=len(self._memoria), bytes_l1=self._memoria.currsize,
+                         max_bytes_l1=self._memoria.maxsize, desalojos_l1=self._memoria.desalojos,
+                         l2=type(self.l2).__name__ if self.l2 else None,
+                         max_bytes_l2=self.max_bytes_l2 if self.l2 else None)
+        consultas = stats["hits_l1"] + stats["hits_l2"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["hits_l1"] + stats["hits_l2"]) / consultas, 3) if consultas else 0.0
+        return stats
+
+caches = {}
+
+def crear_cache(nombre, ttl, max_bytes, l2=None, max_bytes_l2=None):
+    """Crea y registra un espacio de caché (sus contadores salen en /metrics)."""
+    caches[nombre] = CacheNamespace(nombre, ttl, max_bytes, l2, max_bytes_l2)
+    return caches[nombre]
+
+cache_l2 = {'postgres': L2Postgres, 'disco': lambda: L2Disco(CACHE_DIR)}.get(CACHE_L2, lambda: None)()
+
+def normalizar_pregunta(texto):
+    """Normaliza una pregunta para compararla: minúsculas, sin tildes, sin signos y espacios simples."""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    texto = ''.join(ch for ch in texto if not unicodedata.combining(ch))
+    texto = re.sub(r"[¿?¡!.,;:\"'()]+", " ", texto)
+    return " ".join(texto.split())
+
+def clave_respuesta(pregunta, nivel_explicacion, tema, contexto):
+    """Construye la clave de caché de una respuesta a partir de la pregunta y su contexto."""
+    contexto_hash = hashlib.sha256(contexto.encode('utf-8')).hexdigest()[:16] if contexto else ''
+    base = "|".join([normalizar_pregunta(pregunta), nivel_explicacion, tema, contexto_hash])
+    return hashlib.sha256(base.encode('utf-8')).hexdigest()
+
+respuestas_cache = crear_cache('respuestas', RESPUESTAS_CACHE_TTL, RESPUESTAS_CACHE_MAX_BYTES,
+                               l2=cache_l2, max_bytes_l2=RESPUESTAS_CACHE_L2_MAX_BYTES)
+recursos_cache = crear_cache('recursos', RECURSOS_CACHE_TTL, RECURSOS_CACHE_MAX_BYTES)  # temas.json, /temas, /avatars
+
+# --- Coalescencia de Peticiones Idénticas ---
+# Cuando llegan a la vez muchas peticiones con la misma clave de caché, sólo una calcula (llama a Groq
+# o a gTTS) y las demás esperan su resultado. Dentro del worker se espera a un Event; entre workers,
+# una fila en vuelos_en_curso marca quién calcula y los demás sondean la caché compartida.
+VUELO_ESPERA_MAX = float(os.getenv('VUELO_ESPERA_MAX', 45))
+VUELO_SONDEO_MS = int(os.getenv('VUELO_SONDEO_MS', 150))
+VUELO_TTL = int(os.getenv('VUELO_TTL', 120))  # una marca más vieja se da por abandonada
+
+class _Vuelo:
+    def __init__(self):
+        self.listo = threading.Event()
+        self.resultado = None
+
+    def publicar(self, valor):
+        self.resultado = valor
+
+class VuelosEnCurso:
+    """Single-flight por clave: un cálculo por clave a la vez en todo el despliegue."""
+
+    def __init__(self):
+        self._vuelos = {}
+        self._lock = threading.Lock()
+        self.contadores = collections.Counter()
+
+    @contextmanager
+    def coordinar(self, espacio, clave, consultar):
+        """Produce un vuelo cuyo `resultado` es el de un cálculo idéntico ya en curso, o None.
+
+        Con None le toca calcular a quien llama, que debe dejarlo con `vuelo.publicar(valor)` para las
+        peticiones que esperan. `consultar()` lee la caché compartida (la rellena quien calcula en otro
+        worker). Si la espera se agota o el otro cálculo falla, el resultado es None y se calcula aquí.
+        """
+        completa = f"{espacio}:{clave}"
+        with self._lock:
+            vuelo = self._vuelos.get(completa)
+            propio = vuelo is None
+            if propio:
+                vuelo = self._vuelos[completa] = _Vuelo()
+        if not propio:
+            vuelo.listo.wait(VUELO_ESPERA_MAX)
+            compartido = _Vuelo()
+            compartido.resultado = vuelo.resultado
+            self.contadores['compartidos_local' if vuelo.resultado is not None else 'esperas_fallidas'] += 1
+            yield compartido
+            return
+
+        marcado = False
+        try:
+            marcado = self.marcar(completa)
+            if marcado:
+                self.contadores['calculos'] += 1
+            else:
+                vuelo.resultado = self._sondear(completa, consultar)
+                self.contadores['compartidos_remoto' if vuelo.resultado is not None else 'esperas_fallidas'] += 1
+            yield vuelo
+        except BaseException:
+            vuelo.resultado = None  # quienes esperan calculan por su cuenta
+            raise
+        finally:
+            if marcado:
+                self.desmarcar(completa)
+            with self._lock:
+                self._vuelos.pop(completa, None)
+            vuelo.listo.set()
+
+    def marcar(self, completa, ttl=VUELO_TTL):
+        """Reclama un cálculo entre workers durante `ttl` segundos; sin base de datos se calcula igualmente."""
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("""
+                    INSERT INTO vuelos_en_curso (clave, expira) VALUES (%s, NOW() + make_interval(secs => %s))
+                    ON CONFLICT (clave) DO UPDATE SET expira = EXCLUDED.expira
+                    WHERE vuelos_en_curso.expira < NOW()
+                    RETURNING 1
+                """, (completa, ttl))
+                marcado = c.fetchone() is not None
+                conn.commit()
+            return marcado
+        except PsycopgError as e:
+            logger.warning("No se pudo marcar vuelo en curso", error=str(e))
+            return True
+
+    def desmarcar(self, completa):
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("DELETE FROM vuelos_en_curso WHERE clave = %s", (completa,))
+                conn.commit()
+        except PsycopgError as e:
+            logger.warning("No se pudo desmarcar vuelo en curso", error=str(e))
+
+    def _marca_viva(self, completa):
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT 1 FROM vuelos_en_curso WHERE clave = %s AND expira > NOW()", (completa,))
+                viva = c.fetchone() is not None
+                conn.commit()
+            return viva
+        except PsycopgError:
+            return False
+
+    def _sondear(self, completa, consultar):
+        """Espera a que otro worker deje el resultado en la caché compartida."""
+        limite = time.monotonic() + VUELO_ESPERA_MAX
+        sondeos = 0
+        while time.monotonic() < limite:
+            time.sleep(VUELO_SONDEO_MS / 1000)
+            resultado = consultar()
+            if resultado is not None:
+                return resultado
+            sondeos += 1
+            # De vez en cuando se comprueba que el otro worker sigue calculando
+            if sondeos % 5 == 0 and not self._marca_viva(completa):
+                return consultar()
+        return None
+
+    def stats(self):
+        with self._lock:
+            en_curso = len(self._vuelos)
+        return {"en_curso": en_curso, **self.contadores}
+
+vuelos = VuelosEnCurso()
+
+# --- Payloads JSON Precomputados ---
+# Se serializan y comprimen una vez por versión de contenido; el ETag es un hash del contenido.
+CODIFICACIONES_PAYLOAD = (('br', '.br'), ('gzip', '.gz'))
+
+def guardar_payload(clave, datos):
+    """Serializa datos a JSON, guarda sus variantes gzip/brotli y devuelve el ETag."""
+    payload = json.dumps(datos, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    etag = hashlib.sha256(payload).hexdigest()[:32]
+    recursos_cache.set(clave, payload)
+    recursos_cache.set(f"{clave}.gz", gzip.compress(payload, compresslevel=9, mtime=0))
+    if brotli is not None:
+        recursos_cache.set(f"{clave}.br", brotli.compress(payload, quality=11))
+    recursos_cache.set_texto(f"{clave}.etag", etag)
+    return etag
+
+def borrar_payload(clave):
+    """Invalida un payload precomputado y todas sus variantes."""
+    for sufijo in ('', '.gz', '.br', '.etag'):
+        recursos_cache.delete(f"{clave}{sufijo}")
+
+def responder_payload(clave, construir, max_age):
+    """Sirve un payload precomputado con ETag, 304 y la mejor codificación aceptada por el cliente."""
+    etag = recursos_cache.get_texto(f"{clave}.etag")
+    if etag is None:
+        etag = guardar_payload(clave, construir())
+    headers = {
+        'ETag': f'"{etag}"',
+        # private: la respuesta puede llevar la cookie de sesión de Flask-Session
+        'Cache-Control': f'private, max-age={max_age}, must-revalidate',
+        'Vary': 'Accept-Encoding'
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    for codificacion, sufijo in CODIFICACIONES_PAYLOAD:
+        if request.accept_encodings[codificacion]:
+            cuerpo = recursos_cache.get(f"{clave}{sufijo}")
+            if cuerpo is not None:
+                return Response(cuerpo, mimetype='application/json', headers=dict(headers, **{'Content-Encoding': codificacion}))
+    cuerpo = recursos_cache.get(clave)
+    if cuerpo is None:
+        # Variante desalojada por separado: se reconstruye todo el juego
+        guardar_payload(clave, construir())
+        cuerpo = recursos_cache.get(clave)
+    return Response(cuerpo, mimetype='application/json', headers=headers)
+
+def stream_groq_api(messages, model, max_tokens, temperature, prioridad=PRIORIDAD_INTERACTIVA):
+    """Llama a la API de Groq en modo stream y produce los fragmentos de texto según llegan."""
+    tokens = tokens_estimados(messages, max_tokens)
+    try:
+        # El turno del planificador se mantiene mientras dura el stream
+        stream = planificador_llm.ejecutar(model, tokens, prioridad, lambda: client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        ), retener=True)
+    except Exception as e:
+        logger.error("Error en Groq API (stream)", error=str(e))
+        if '503' in str(e):
+            raise Exception("Groq API unavailable (503). Check https://groqstatus.com/")
+        raise
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        planificador_llm.liberar(model, tokens)
+
+# --- Índice de Temas ---
+# Alias y sinónimos por tema; se comparan normalizados (minúsculas, sin tildes ni signos)
+ALIAS_TEMAS = {
+    'Introducción a la POO': ['POO', 'programación orientada a objetos', 'orientación a objetos'],
+    'Clases y Objetos': ['clase', 'clases', 'objeto', 'objetos', 'instancia', 'constructor'],
+    'Encapsulamiento': ['encapsulación', 'getters y setters', 'modificadores de acceso'],
+    'Herencia': ['herencia múltiple', 'heredar', 'extends', 'subclase', 'superclase'],
+    'Polimorfismo': ['sobrecarga', 'sobreescritura', 'sobrescritura', 'override'],
+    'Clases Abstractas e Interfaces': ['clase abstracta', 'clases abstractas', 'interfaz', 'interfaces'],
+    'Lenguaje de Modelado Unificado (UML)': ['UML', 'lenguaje de modelado unificado'],
+    'Diagramas UML': ['diagrama UML', 'diagrama de clases', 'diagramas de clases', 'diagrama de secuencia'],
+    'Patrones de Diseño en POO': ['patrón de diseño', 'patrones de diseño', 'singleton'],
+    'Patrón MVC': ['MVC', 'modelo vista controlador'],
+    'Acceso a Archivos': ['archivos', 'ficheros', 'FileReader', 'FileWriter'],
+    'Bases de Datos y ORM': ['ORM', 'JDBC', 'base de datos', 'bases de datos'],
+    'Pruebas y Buenas Prácticas': ['pruebas unitarias', 'JUnit', 'TDD', 'buenas prácticas'],
+    'Programación Concurrente y Distribuida': ['concurrencia', 'hilos', 'threads', 'programación concurrente'],
+    'Patrón Observer': ['observer', 'observador'],
+    'Patrón Strategy': ['strategy', 'patrón estrategia'],
+    'Patrón Factory': ['factory', 'patrón fábrica'],
+    'Principios SOLID': ['SOLID'],
+    'MVC vs MVP vs MVVM': ['MVP', 'MVVM'],
+    'Clean Architecture': ['arquitectura limpia'],
+    'Ciclo de Vida de una Activity': ['activity', 'ciclo de vida'],
+    'Fragments y ViewModel': ['fragment', 'fragments', 'ViewModel'],
+    'Room ORM': ['Room'],
+    'Consumo de APIs REST con Retrofit': ['Retrofit', 'API REST', 'APIs REST'],
+}
+
+class IndiceTemas:
+    """Índice de temas construido una vez: búsqueda por regex compilada y diccionarios O(1)."""
+
+    def __init__(self, temas_json):
+        self.nombres = []
+        self._detalles = {}
+        self._unidades = {}
+        terminos = {}
+        for unidad in temas_json.get("Unidades", []):
+            for tema in unidad.get("temas", []):
+                if 'nombre' not in tema:
+                    continue
+                nombre = tema['nombre']
+                clave = normalizar_pregunta(nombre)
+                self.nombres.append(nombre)
+                self._detalles[clave] = tema
+                self._unidades[clave] = unidad.get("nombre")
+                terminos.setdefault(clave, nombre)
+        self._canonicos = {normalizar_pregunta(n): n for n in self.nombres}
+        for nombre, alias in ALIAS_TEMAS.items():
+            if normalizar_pregunta(nombre) not in self._canonicos:
+                continue
+            for a in alias:
+                terminos.setdefault(normalizar_pregunta(a), nombre)
+        self._terminos = terminos
+        # Alternativas más largas primero: en cada posición gana el término más específico
+        alternativas = sorted(terminos, key=len, reverse=True)
+        self._patron = re.compile(
+            r"(?<!\w)(" + "|".join(re.escape(t) for t in alternativas) + r")(?!\w)"
+        ) if alternativas else None
+
+    def buscar(self, texto):
+        """Devuelve el tema más específico mencionado en el texto, o None."""
+        if not self._patron:
+            return None
+        coincidencias = [m.group(1) for m in self._patron.finditer(normalizar_pregunta(texto))]
+        if not coincidencias:
+            return None
+        return self._terminos[max(coincidencias, key=len)]
+
+    def resolver(self, nombre):
+        """Devuelve el nombre canónico de un tema (acepta alias), o None."""
+        if not nombre:
+            return None
+        return self._terminos.get(normalizar_pregunta(nombre))
+
+    def detalle(self, nombre):
+        """Devuelve el registro de temas.json del tema."""
+        return self._detalles.get(normalizar_pregunta(nombre)) if nombre else None
+
+    def unidad(self, nombre):
+        """Devuelve el nombre de la unidad a la que pertenece el tema."""
+        return self._unidades.get(normalizar_pregunta(nombre)) if nombre else None
+
+    def __contains__(self, nombre):
+        return bool(nombre) and normalizar_pregunta(nombre) in self._canonicos
+
+# --- Recuperación de Pasajes de temas.json ---
+RECUPERACION_TOP_K = int(os.getenv('RECUPERACION_TOP_K', 3))
+RECUPERACION_RECARGA_SEG = float(os.getenv('RECUPERACION_RECARGA_SEG', 5))  # cada cuánto se mira el mtime de temas.json
+
+STOPWORDS_ES = frozenset("""
+    a al algo algun alguna algunas alguno algunos ante antes aqui asi como con contra cual cuales cuando
+    de del desde donde dos el ella ellas ellos en entre era eres es esa esas ese eso esos esta estas este
+    esto estos fue ha hay la las le les lo los mas me mi mis mucho muy ni no nos o otra otro para pero
+    poco por porque puedes que quien se sea ser si sin sobre son su sus tambien te tiene todo tu tus un
+    una uno unos y ya yo explica explicame dime hablame quiero saber ayudame favor
+""".split())
+
+def _raiz_es(token):
+    """Stemming ligero para español: quita plurales para que 'clases' y 'clase' coincidan."""
+    if len(token) > 5 and token.endswith('es'):
+        return token[:-2]
+    if len(token) > 4 and token.endswith('s'):
+        return token[:-1]
+    return token
+
+def tokenizar_es(texto):
+    """Tokeniza texto en español: normaliza, descarta stopwords y aplica stemming ligero."""
+    return [_raiz_es(t) for t in re.findall(r"[a-z0-9]+", normalizar_pregunta(texto))
+            if len(t) > 1 and t not in STOPWORDS_ES]
+
+class MotorRecuperacion:
+    """Índice BM25 vectorizado con NumPy sobre definiciones, ventajas y ejemplos de temas.json."""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._tokens_cache = {}
+        self._indice = ([], {}, np.zeros((0, 0), dtype=np.float32), np.array([], dtype=object))
+
+    @staticmethod
+    def _extraer_pasajes(temas_json):
+        pasajes = []
+        for unidad in temas_json.get("Unidades", []):
+            for tema in unidad.get("temas", []):
+                nombre = tema.get('nombre')
+                if not nombre:
+                    continue
+                if tema.get("definición"):
+                    pasajes.append({"tema": nombre, "campo": "definición", "texto": tema["definición"],
+                                    "indexado": f"{nombre} definicion {tema['definición']}"})
+                if tema.get("ventajas"):
+                    ventajas = ", ".join(tema["ventajas"])
+                    pasajes.append({"tema": nombre, "campo": "ventajas", "texto": ventajas,
+                                    "indexado": f"{nombre} ventajas beneficios {ventajas}"})
+                if tema.get("ejemplo"):
+                    pasajes.append({"tema": nombre, "campo": "ejemplo", "texto": tema["ejemplo"],
+                                    "indexado": f"{nombre} ejemplo codigo java {tema['ejemplo']}"})
+        return pasajes
+
+    def construir(self, temas_json):
+        """(Re)construye el índice reutilizando la tokenización de los pasajes que no cambiaron."""
+        pasajes = self._extraer_pasajes(temas_json)
+        tokens_cache, conteos, reutilizados = {}, [], 0
+        for pasaje in pasajes:
+            clave = hashlib.sha1(pasaje["indexado"].encode('utf-8')).hexdigest()
+            conteo = self._tokens_cache.get(clave)
+            if conteo is None:
+                conteo = collections.Counter(tokenizar_es(pasaje["indexado"]))
+            else:
+                reutilizados += 1
+            tokens_cache[clave] = conteo
+            conteos.append(conteo)
+
+        vocab = {}
+        for conteo in conteos:
+            for token in conteo:
+                vocab.setdefault(token, len(vocab))
+        tf = np.zeros((len(pasajes), len(vocab)), dtype=np.float32)
+        for fila, conteo in enumerate(conteos):
+            for token, n in conteo.items():
+                tf[fila, vocab[token]] = n
+
+        if len(pasajes):
+            # Pesos BM25 precalculados: una consulta es sólo sumar columnas
+            df = np.count_nonzero(tf, axis=0)
+            idf = np.log(1 + (len(pasajes) - df + 0.5) / (df + 0.5)).astype(np.float32)
+            longitudes = tf.sum(axis=1, keepdims=True)
+            norma = self.k1 * (1 - self.b + self.b * longitudes / max(float(longitudes.mean()), 1.0))
+            pesos = idf * (tf * (self.k1 + 1)) / (tf + norma)
+        else:
+            pesos = np.zeros((0, 0), dtype=np.float32)
+
+        temas_pasajes = np.array([p["tema"] for p in pasajes], dtype=object)
+        publicos = [{k: v for k, v in p.items() if k != "indexado"} for p in pasajes]
+        self._tokens_cache = tokens_cache
+        self._indice = (publicos, vocab, pesos, temas_pasajes)
+        logger.info("Índice de recuperación construido", pasajes=len(pasajes), vocabulario=len(vocab), reutilizados=reutilizados)
+
+    def buscar(self, texto, k=RECUPERACION_TOP_K, tema_preferido=None):
+        """Devuelve los k pasajes más relevantes para el texto, con su puntuación."""
+        pasajes, vocab, pesos, temas_pasajes = self._indice
+        columnas = [vocab[t] for t in tokenizar_es(texto) if t in vocab]
+        if not columnas or not pasajes:
+            return []
+        puntuaciones = pesos[:, columnas].sum(axis=1)
+        if tema_preferido:
+            # Si el tema se nombró explícitamente, sus pasajes van primero entre los relevantes
+            puntuaciones = puntuaciones + (temas_pasajes == tema_preferido) * float(puntuaciones.max())
+        k = min(k, len(pasajes))
+        candidatos = np.argpartition(-puntuaciones, k - 1)[:k]
+        candidatos = candidatos[np.argsort(-puntuaciones[candidatos])]
+        return [dict(pasajes[i], score=round(float(puntuaciones[i]), 4)) for i in candidatos if puntuaciones[i] > 0]
+
+motor_recuperacion = MotorRecuperacion()
+_temas_mtime = {"valor": None, "comprobado": 0.0}
+
+def recargar_temas_si_cambio():
+    """Recarga temas, índice de temas e índice de recuperación si temas.json cambió en disco."""
+    global TEMAS_DISPONIBLES
+    ahora = time.monotonic()
+    if ahora - _temas_mtime["comprobado"] < RECUPERACION_RECARGA_SEG:
+        return False
+    _temas_mtime["comprobado"] = ahora
+    try:
+        mtime = os.path.getmtime('temas.json')
+    except OSError:
+        return False
+    if mtime == _temas_mtime["valor"]:
+        return False
+    logger.info("temas.json cambió en disco, recargando índices")
+    recursos_cache.delete('temas')
+    borrar_payload('temas_response')
+    TEMAS_DISPONIBLES = cargar_temas()
+    return True
+
 def cargar_temas():
-    """Carga temas desde archivo JSON o usa defaults, con caché."""
-    global temas
+    """Carga temas desde archivo JSON o usa defaults, con caché, y reconstruye el índice de temas."""
+    global temas, indice_temas
     cache_key = 'temas'
-    temas_disponibles = []
 
-    if cache_key in cache:
-        temas = cache[cache_key]
+    contenido = recursos_cache.get(cache_key)
+    if contenido is not None:
+        temas = json.loads(contenido)
         logger.info("Temas cargados desde caché")
-        for unidad in temas.get("Unidades", []):
-            for tema in unidad.get("temas", []):
-                if 'nombre' in tema:
-                    temas_disponibles.append(tema['nombre'])
-        return temas_disponibles
+        indice_temas = IndiceTemas(temas)
+        motor_recuperacion.construir(temas)
+        return indice_temas.nombres
 
     try:
-        with open('temas.json', 'r', encoding='utf-8') as f:
-            temas = json.load(f)
-        cache[cache_key] = temas
-        for unidad in temas.get("Unidades", []):
-            for tema in unidad.get("temas", []):
-                if 'nombre' in tema:
-                    temas_disponibles.append(tema['nombre'])
-        logger.info(f"Temas cargados desde archivo: {temas_disponibles}")
-        return temas_disponibles
+        _temas_mtime["valor"] = os.path.getmtime('temas.json')
+        with open('temas.json', 'rb') as f:
+            contenido = f.read()
+        temas = json.loads(contenido)
+        recursos_cache.set(cache_key, contenido)
+        indice_temas = IndiceTemas(temas)
+        motor_recuperacion.construir(temas)
+        logger.info(f"Temas cargados desde archivo: {indice_temas.nombres}")
+        return indice_temas.nombres
     except FileNotFoundError:
         logger.error("Archivo temas.json no encontrado")
         temas = {}
-        return [
+        nombres = [
             'Introducción a la POO', 'Clases y Objetos', 'Encapsulamiento', 'Herencia',
             'Polimorfismo', 'Clases Abstractas e Interfaces', 'Lenguaje de Modelado Unificado (UML)',
             'Diagramas UML', 'Patrones de Diseño en POO', 'Patrón MVC', 'Acceso a Archivos',
             'Bases de Datos y ORM', 'Integración POO + MVC + BD', 'Pruebas y Buenas Prácticas'
         ]
+        indice_temas = IndiceTemas({"Unidades": [{"temas": [{"nombre": n} for n in nombres]}]})
+        motor_recuperacion.construir({})
+        return indice_temas.nombres
     except json.JSONDecodeError as e:
         logger.error("Error al decodificar temas.json", error=str(e))
         temas = {}
+        indice_temas = IndiceTemas({})
+        motor_recuperacion.construir({})
         return []
 
 # --- Manejo Global de Errores ---
@@ -383,6 +1965,8 @@ def handle_exception(e):
         return jsonify({"error": "Tiempo de conexión agotado, verifica tu conexión a internet", "status": 504}), 504
     if isinstance(e, ValidationError):
         return jsonify({"error": f"Datos inválidos: {str(e)}", "status": 400}), 400
+    if isinstance(e, RequestEntityTooLarge):
+        return jsonify({"error": "La solicitud es demasiado grande", "status": 413}), 413
     return jsonify({"error": f"Error interno del servidor: {str(e)}", "status": 500}), 500
 
 # Validar variables de entorno
@@ -394,9 +1978,186 @@ if not os.getenv("DATABASE_URL"):
     exit(1)
 
 # --- Blueprints para Modularizar Rutas ---
+PAGINA_LIMITE_DEFECTO = int(os.getenv('PAGINA_LIMITE_DEFECTO', 50))
+PAGINA_LIMITE_MAX = 200
+
+# Búsqueda de texto completo: la expresión debe coincidir con la del índice GIN para que se use
+TSVECTOR_MENSAJES = "to_tsvector('spanish', content)"
+BUSQUEDA_LIMITE_DEFECTO = 20
+BUSQUEDA_LIMITE_MAX = 50
+BUSQUEDA_OFFSET_MAX = 500
+BUSQUEDA_MAX_CARACTERES = 200
+# Las coincidencias se marcan con «» (no HTML) para que el cliente las resalte sin usar innerHTML
+OPCIONES_FRAGMENTO = "StartSel=«, StopSel=», MaxWords=25, MinWords=8, MaxFragments=2, FragmentDelimiter=\" … \""
+
+def codificar_cursor(created_at, fila_id):
+    """Cursor opaco de paginación keyset sobre (created_at, id)."""
+    crudo = f"{created_at.isoformat()}|{fila_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(crudo).decode('ascii').rstrip('=')
+
+def decodificar_cursor(cursor):
+    """Devuelve (created_at, id) de un cursor; lanza ValueError si es inválido."""
+    try:
+        crudo = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        fecha, fila_id = crudo.split('|')
+        return datetime.fromisoformat(fecha), int(fila_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+
+def leer_paginacion():
+    """Lee limit/before/since de la query string; lanza ValueError si no son válidos."""
+    limite = request.args.get('limit', PAGINA_LIMITE_DEFECTO, type=int)
+    if not 1 <= limite <= PAGINA_LIMITE_MAX:
+        raise ValueError(f"limit debe estar entre 1 y {PAGINA_LIMITE_MAX}")
+    before, since = request.args.get('before'), request.args.get('since')
+    if before and since:
+        raise ValueError("Usa before o since, no ambos")
+    if before or since:
+        decodificar_cursor(before or since)
+    return limite, before, since
+
+def consultar_pagina(c, tabla, columnas, filtro, params, limite, before=None, since=None):
+    """Página keyset sobre (created_at, id): devuelve (filas en orden ascendente, hay_mas).
+
+    Sin cursor devuelve las `limite` filas más recientes; `before` las anteriores a un cursor
+    y `since` las posteriores (sincronización incremental).
+    """
+    condicion, orden, cursor_params = "", "DESC", []
+    if since:
+        condicion, orden, cursor_params = "AND (created_at, id) > (%s, %s)", "ASC", list(decodificar_cursor(since))
+    elif before:
+        condicion, cursor_params = "AND (created_at, id) < (%s, %s)", list(decodificar_cursor(before))
+    c.execute(
+        f"SELECT {columnas} FROM {tabla} WHERE {filtro} {condicion} "
+        f"ORDER BY created_at {orden}, id {orden} LIMIT %s",
+        (*params, *cursor_params, limite + 1)
+    )
+    filas = c.fetchall()
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
+    return (filas if orden == "ASC" else filas[::-1]), hay_mas
+
+def _cursores(filas, indice_fecha, hay_mas):
+    """Cursores para pedir lo anterior (before) y lo nuevo (since) respecto a una página ascendente."""
+    if not filas:
+        return {"has_more": hay_mas, "before": None, "since": None}
+    return {
+        "has_more": hay_mas,
+        "before": codificar_cursor(filas[0][indice_fecha], filas[0][0]),
+        "since": codificar_cursor(filas[-1][indice_fecha], filas[-1][0])
+    }
+
+def insertar_mensajes(c, conv_id, mensajes):
+    """Inserta mensajes en un solo INSERT multi-fila; los que traen un client_id ya guardado no se duplican.
+
+    Devuelve (posición, id, created_at, creado) por mensaje, en el orden recibido.
+    """
+    vistos, valores = set(), []
+    for i, m in enumerate(mensajes):
+        if m.client_id in vistos:
+            continue  # repetido dentro del mismo lote: un solo INSERT no puede tocar la fila dos veces
+        if m.client_id:
+            vistos.add(m.client_id)
+        valores.append((i, conv_id, m.role, m.content, m.tema, m.client_id))
+    filas = execute_values(c, """
+        INSERT INTO messages (conv_id, role, content, tema, client_id, created_at)
+        SELECT v.conv_id, v.role, v.content, v.tema, v.client_id, clock_timestamp()
+        FROM (VALUES %s) AS v(pos, conv_id, role, content, tema, client_id)
+        ORDER BY v.pos
+        ON CONFLICT (conv_id, client_id) WHERE client_id IS NOT NULL
+        DO UPDATE SET client_id = EXCLUDED.client_id
+        RETURNING client_id, id, created_at, (xmax = 0)
+    """, valores, template="(%s, %s::integer, %s, %s, %s, %s)", fetch=True)
+    # RETURNING no garantiza el orden: se empareja por client_id y, sin él, por orden de inserción
+    por_client_id = {f[0]: f for f in filas if f[0] is not None}
+    sin_client_id = iter(sorted((f for f in filas if f[0] is None), key=lambda f: f[1]))
+    resultado = []
+    for i, m in enumerate(mensajes):
+        f = por_client_id[m.client_id] if m.client_id else next(sin_client_id)
+        resultado.append((i, f[1], f[2], f[3]))
+    return resultado
+
+def _mensaje_a_dict(r):
+    """Convierte una fila (id, role, content, created_at, tema) de messages en JSON."""
+    return {
+        "id": r[0],
+        "role": r[1],
+        "content": r[2],
+        "created_at": (r[3].isoformat() if r[3] else None),
+        "tema": r[4]
+    }
+
+def _conversacion_a_dict(r):
+    """Convierte una fila (id, nombre, created_at) de conversations en JSON."""
+    return {
+        "id": r[0],
+        "nombre": r[1] or "Nuevo Chat",
+        "created_at": (r[2].isoformat() if r[2] else None)
+    }
+
 # Blueprint para rutas relacionadas con conversaciones y mensajes
 chat_bp = Blueprint('chat', __name__)
 
+@chat_bp.route('/search', methods=['GET'])
+@limiter.limit("30 per minute")
+def buscar_mensajes():
+    """Busca en los mensajes de todas las conversaciones del usuario, ordenados por relevancia."""
+    usuario = session.get("usuario")
+    consulta = (request.args.get('q') or '').strip()
+    limite = request.args.get('limit', BUSQUEDA_LIMITE_DEFECTO, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if not consulta or len(consulta) > BUSQUEDA_MAX_CARACTERES:
+        return jsonify({"error": f"q debe tener entre 1 y {BUSQUEDA_MAX_CARACTERES} caracteres", "status": 400}), 400
+    if not 1 <= limite <= BUSQUEDA_LIMITE_MAX or not 0 <= offset <= BUSQUEDA_OFFSET_MAX:
+        return jsonify({"error": "limit u offset fuera de rango", "status": 400}), 400
+    if not usuario:
+        return jsonify({"results": [], "query": consulta, "has_more": False, "next_offset": None})
+
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            # El fragmento sólo se genera para la página pedida; el orden usa el índice GIN + ts_rank
+            c.execute(f"""
+                WITH q AS (SELECT websearch_to_tsquery('spanish', %s) AS consulta),
+                aciertos AS (
+                    SELECT m.id, m.conv_id, m.role, m.content, m.created_at, m.tema, cv.nombre,
+                           ts_rank({TSVECTOR_MENSAJES}, q.consulta) AS rango
+                    FROM messages m
+                    JOIN conversations cv ON cv.id = m.conv_id, q
+                    WHERE cv.usuario = %s AND {TSVECTOR_MENSAJES} @@ q.consulta
+                    ORDER BY rango DESC, m.id DESC
+                    LIMIT %s OFFSET %s
+                )
+                SELECT a.id, a.conv_id, a.role, a.created_at, a.tema, a.nombre, a.rango,
+                       ts_headline('spanish', a.content, q.consulta, %s)
+                FROM aciertos a, q
+                ORDER BY a.rango DESC, a.id DESC
+            """, (consulta, usuario, limite + 1, offset, OPCIONES_FRAGMENTO))
+            rows = c.fetchall()
+            conn.commit()
+
+        hay_mas = len(rows) > limite
+        resultados = [{
+            "id": r[0],
+            "conv_id": r[1],
+            "role": r[2],
+            "created_at": (r[3].isoformat() if r[3] else None),
+            "tema": r[4],
+            "conversacion": r[5] or "Nuevo Chat",
+            "rank": round(float(r[6]), 4),
+            "snippet": r[7]
+        } for r in rows[:limite]]
+        logger.info("Búsqueda en historial", usuario=usuario, resultados=len(resultados), offset=offset)
+        return jsonify({
+            "results": resultados,
+            "query": consulta,
+            "has_more": hay_mas,
+            "next_offset": offset + limite if hay_mas else None
+        })
+    except Exception as e:
+        logger.error("Error en búsqueda de mensajes", error=str(e), usuario=usuario)
+        return jsonify({"error": "No se pudo realizar la búsqueda", "status": 500}), 500
+
 @chat_bp.route('/messages/<int:conv_id>', methods=['GET', 'POST'])
 @limiter.limit("50 per hour")
 def handle_messages(conv_id):
@@ -413,28 +2174,23 @@ def handle_messages(conv_id):
 
     if request.method == 'GET':
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("""
-                SELECT id, role, content, created_at, tema
-                FROM messages
-                WHERE conv_id = %s
-                ORDER BY created_at ASC
-            """, (conv_id,))
-            rows = c.fetchall()
-            conn.close()
-
-            messages = [
-                {
-                    "id": r[0],
-                    "role": r[1],
-                    "content": r[2],
-                    "created_at": (r[3].isoformat() if r[3] else None),
-                    "tema": r[4]
-                } for r in rows
-            ]
+            limite, before, since = leer_paginacion()
+        except ValueError as e:
+            return jsonify({"error": str(e), "status": 400}), 400
+        # Read-your-writes: lo que este proceso tenga en cola para la conversación se escribe antes de leer
+        escritor_diferido.esperar(conv_id)
+        try:
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                rows, hay_mas = consultar_pagina(
+                    c, "messages", "id, role, content, created_at, tema", "conv_id = %s", (conv_id,),
+                    limite, before, since
+                )
+                conn.commit()
+
+            messages = [_mensaje_a_dict(r) for r in rows]
             logger.info("Mensajes obtenidos", conv_id=conv_id, usuario=usuario, message_count=len(messages))
-            return jsonify({"messages": messages})
+            return jsonify({"messages": messages, "conv_id": conv_id, **_cursores(rows, 3, hay_mas)})
         except Exception as e:
             logger.error("Error obteniendo mensajes", error=str(e), conv_id=conv_id, usuario=usuario)
             return jsonify({"error": "No se pudieron obtener los mensajes", "status": 500}), 500
@@ -445,23 +2201,18 @@ def handle_messages(conv_id):
         content = data.content
         tema = data.tema
 
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO messages (conv_id, role, content, tema)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id, created_at
-        """, (conv_id, role, content, tema))
-        row = c.fetchone()
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            row = insertar_mensajes(c, conv_id, [data])[0]
+            conn.commit()
 
-        logger.info("Mensaje guardado en messages", conv_id=conv_id, role=role, usuario=usuario)
+        logger.info("Mensaje guardado en messages", conv_id=conv_id, role=role, usuario=usuario, nuevo=row[3])
         return jsonify({
-            "id": row[0],
+            "id": row[1],
             "role": role,
             "content": content,
-            "created_at": row[1].isoformat() if row[1] else None
+            "client_id": data.client_id,
+            "created_at": row[2].isoformat() if row[2] else None
         })
     except ValidationError as e:
         logger.error("Validación fallida en /messages", error=str(e), conv_id=conv_id, usuario=usuario)
@@ -470,6 +2221,39 @@ def handle_messages(conv_id):
         logger.error("Error guardando mensaje", error=str(e), conv_id=conv_id, usuario=usuario)
         return jsonify({"error": "No se pudo guardar el mensaje", "status": 500}), 500
 
+@chat_bp.route('/messages/<int:conv_id>/batch', methods=['POST'])
+@limiter.limit("50 per hour")
+def guardar_mensajes_lote(conv_id):
+    """Guarda varios mensajes de una conversación en un único INSERT multi-fila idempotente."""
+    data_json = request.get_json(silent=True) or {}
+    usuario = data_json.get("usuario") or session.get("usuario")
+    if not usuario or not validar_conversacion(usuario, conv_id):
+        return jsonify({"error": "Conversación no encontrada", "status": 404}), 404
+    try:
+        data = MessageBatchInput(**data_json)
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            filas = insertar_mensajes(c, conv_id, data.messages)
+            conn.commit()
+
+        nuevos = sum(1 for f in filas if f[3])
+        logger.info("Lote de mensajes guardado", conv_id=conv_id, usuario=usuario, total=len(filas), nuevos=nuevos)
+        return jsonify({
+            "messages": [{
+                "id": f[1],
+                "client_id": data.messages[f[0]].client_id,
+                "created_at": f[2].isoformat() if f[2] else None,
+                "created": f[3]
+            } for f in filas],
+            "conv_id": conv_id
+        })
+    except ValidationError as e:
+        logger.error("Validación fallida en /messages/batch", error=str(e), conv_id=conv_id, usuario=usuario)
+        return jsonify({"error": f"Datos inválidos: {str(e)}", "status": 400}), 400
+    except Exception as e:
+        logger.error("Error guardando lote de mensajes", error=str(e), conv_id=conv_id, usuario=usuario)
+        return jsonify({"error": "No se pudieron guardar los mensajes", "status": 500}), 500
+
 @chat_bp.route('/conversations', methods=['GET'])
 @limiter.limit("50 per hour")
 def list_conversations():
@@ -480,26 +2264,22 @@ def list_conversations():
     session['usuario'] = usuario
 
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("""
-            SELECT id, nombre, created_at
-            FROM conversations
-            WHERE usuario = %s
-            ORDER BY created_at DESC, id DESC
-        """, (usuario,))
-        rows = c.fetchall()
-        conn.close()
-
-        conversations = [
-            {
-                "id": r[0],
-                "nombre": r[1] or "Nuevo Chat",
-                "created_at": (r[2].isoformat() if r[2] else None)
-            } for r in rows
-        ]
+        limite, before, since = leer_paginacion()
+    except ValueError as e:
+        return jsonify({"error": str(e), "status": 400}), 400
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            rows, hay_mas = consultar_pagina(
+                c, "conversations", "id, nombre, created_at", "usuario = %s", (usuario,),
+                limite, before, since
+            )
+            conn.commit()
+
+        # Más reciente primero, como se muestran en la barra lateral
+        conversations = [_conversacion_a_dict(r) for r in reversed(rows)]
         logger.info("Conversaciones listadas", usuario=usuario, conversation_count=len(conversations))
-        return jsonify({"conversations": conversations})
+        return jsonify({"conversations": conversations, **_cursores(rows, 2, hay_mas)})
     except Exception as e:
         logger.error("Error listando conversaciones", error=str(e), usuario=usuario)
         return jsonify({"error": "No se pudieron obtener las conversaciones", "status": 500}), 500
@@ -515,15 +2295,13 @@ def manage_conversation(conv_id):
 
     if request.method == 'DELETE':
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("DELETE FROM conversations WHERE id = %s AND usuario = %s", (conv_id, usuario))
-            if c.rowcount == 0:
-                conn.close()
-                logger.warning("Conversación no encontrada o no autorizada", conv_id=conv_id, usuario=usuario)
-                return jsonify({'error': 'Conversación no encontrada o no autorizada', "status": 404}), 404
-            conn.commit()
-            conn.close()
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("DELETE FROM conversations WHERE id = %s AND usuario = %s", (conv_id, usuario))
+                if c.rowcount == 0:
+                    logger.warning("Conversación no encontrada o no autorizada", conv_id=conv_id, usuario=usuario)
+                    return jsonify({'error': 'Conversación no encontrada o no autorizada', "status": 404}), 404
+                conn.commit()
             if session.get('current_conv_id') == conv_id:
                 session.pop('current_conv_id', None)
             logger.info("Conversación eliminada", conv_id=conv_id, usuario=usuario)
@@ -535,15 +2313,13 @@ def manage_conversation(conv_id):
         try:
             data = ConversationInput(**request.get_json())
             nuevo_nombre = data.nombre
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("UPDATE conversations SET nombre = %s WHERE id = %s AND usuario = %s", (nuevo_nombre, conv_id, usuario))
-            if c.rowcount == 0:
-                conn.close()
-                logger.warning("Conversación no encontrada o no autorizada", conv_id=conv_id, usuario=usuario)
-                return jsonify({'error': 'Conversación no encontrada o no autorizada', "status": 404}), 404
-            conn.commit()
-            conn.close()
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("UPDATE conversations SET nombre = %s WHERE id = %s AND usuario = %s", (nuevo_nombre, conv_id, usuario))
+                if c.rowcount == 0:
+                    logger.warning("Conversación no encontrada o no autorizada", conv_id=conv_id, usuario=usuario)
+                    return jsonify({'error': 'Conversación no encontrada o no autorizada', "status": 404}), 404
+                conn.commit()
             logger.info("Conversación renombrada", conv_id=conv_id, usuario=usuario, nuevo_nombre=nuevo_nombre)
             return jsonify({'success': True, 'nombre': nuevo_nombre})
         except ValidationError as e:
@@ -572,7 +2348,7 @@ def create_conversation():
             "id": conv_id,
             "nombre": nombre,
             "created_at": time.time(),
-            "mensaje": "Hola, soy YELIA 👋. ¿En qué tema de Programación Avanzada quieres que te ayude hoy?"
+            "mensaje": SALUDO_INICIAL
         }), 201
     except ValidationError as e:
         logger.error("Validación fallida en /conversations POST", error=str(e), usuario=usuario)
@@ -597,6 +2373,126 @@ def logout():
         return jsonify({"success": True, "message": "Sesión cerrada, se creará un nuevo chat al volver a entrar."})
     return jsonify({"success": True, "message": "No había sesión activa."})
 
+def _preparar_turno(data, usuario):
+    """Valida la conversación, identifica el tema y arma el prompt o la respuesta simple del turno."""
+    pregunta = data.pregunta.strip()
+    nivel_explicacion = data.nivel_explicacion
+    conv_id = data.conv_id
+
+    # Validar conversación y leer sus últimos mensajes y resumen en una sola consulta
+    conv_valida, recientes, resumen, sin_resumir, guardada = (
+        cargar_estado_turno(usuario, conv_id, data.client_id) if conv_id else (False, [], None, 0, None)
+    )
+    ultimo_mensaje = recientes[0][1] if recientes else None
+    if not conv_valida:
+        conv_id = crear_nueva_conversacion(usuario)
+        ultimo_mensaje = SALUDO_INICIAL
+        session['current_conv_id'] = conv_id
+    elif conv_id != session.get('current_conv_id'):
+        session['current_conv_id'] = conv_id
+
+    # Reintento de un turno ya respondido: se devuelve lo guardado en lugar de volver a Groq
+    if guardada:
+        respuesta, tema = guardada
+        logger.info("Turno repetido servido desde la base de datos", conv_id=conv_id, client_id=data.client_id)
+        return {
+            "pregunta": pregunta,
+            "conv_id": conv_id,
+            "tema": tema,
+            "respuesta_simple": respuesta,
+            "mensajes": None,
+            "clave_cache": None,
+            "nivel": nivel_explicacion,
+            "fallback": None,
+            "client_id": data.client_id
+        }
+
+    # Normalizar pregunta
+    pregunta_norm = pregunta.lower().strip()
+
+    # Construir contexto: resumen de lo antiguo + historial reciente acotado por tokens según el nivel
+    contexto, en_prompt = historial_en_presupuesto(recientes, nivel_explicacion)
+    # El resumen avanza hasta donde el presupuesto corta el historial
+    conservar = mensajes_a_conservar(sin_resumir, en_prompt) if conv_valida else None
+    if conservar is not None:
+        programar_resumen(conv_id, conservar)
+    if resumen:
+        contexto = f"\nResumen de la conversación: {resumen}{contexto}"
+
+    # Identificar tema (el más específico mencionado, incluidos alias)
+    recargar_temas_si_cambio()
+    tema_identificado = indice_temas.buscar(pregunta)
+
+    # Recuperar sólo los pasajes de temas.json relevantes para la pregunta
+    pasajes = motor_recuperacion.buscar(pregunta, RECUPERACION_TOP_K, tema_preferido=tema_identificado)
+    if not tema_identificado:
+        tema_identificado = pasajes[0]["tema"] if pasajes else 'General'
+    tema_sugerido = tema_identificado if tema_identificado in indice_temas else (TEMAS_DISPONIBLES[0] if TEMAS_DISPONIBLES else 'General')
+
+    contexto_extra = ""
+    if pasajes:
+        contexto_extra = "\nMaterial del curso relevante:\n" + "\n".join(
+            f"- {p['tema']} ({p['campo']}): {p['texto']}" for p in pasajes
+        )
+
+    # Evitar duplicar saludo
+    es_saludo_duplicado = ultimo_mensaje == SALUDO_INICIAL
+
+    turno = {
+        "pregunta": pregunta,
+        "conv_id": conv_id,
+        "tema": tema_identificado,
+        "respuesta_simple": None,
+        "mensajes": None,
+        "clave_cache": None,
+        "nivel": nivel_explicacion,
+        "fallback": PLANTILLA_FALLBACK.format(tema=tema_sugerido),
+        "client_id": data.client_id
+    }
+
+    # Respuestas simples
+    respuestas_simples = {
+        r"^(hola|¡hola!|buenos días|buenas tardes|buenas noches|hey|hi)$": (
+            RESPUESTA_SALUDO if not es_saludo_duplicado else None
+        ),
+        r"^(qu[ié] eres|qu[ié] es yelia|quien eres|quien es yelia)$": RESPUESTA_PRESENTACION,
+        r"^(ayuda|help|qué puedes hacer|que puedes hacer)$": PLANTILLA_AYUDA.format(tema=tema_sugerido)
+    }
+
+    for patron, respuesta in respuestas_simples.items():
+        if re.match(patron, pregunta_norm, re.IGNORECASE) and respuesta:
+            turno["respuesta_simple"] = respuesta
+            return turno
+
+    # Prompt completo
+    prompt = (
+        f"Eres YELIA, un tutor especializado en Programación Avanzada para Ingeniería en Telemática.\n"
+        f"Sigue estas instrucciones estrictamente:\n"
+        f"1. Responde con prioridad sobre los temas: {', '.join(TEMAS_DISPONIBLES)}.\n"
+        f"2. Nivel de explicación: '{nivel_explicacion}'.\n"
+        f"   - 'basica': SOLO una definición clara y concisa (máximo 70 palabras) en texto plano.\n"
+        f"   - 'ejemplos': Definición breve (máximo 80 palabras) + UN SOLO ejemplo en Java (máximo 10 líneas).\n"
+        f"   - 'avanzada': Definición (máximo 80 palabras) + 2-3 ventajas + UN SOLO ejemplo en Java (máximo 10 líneas) + una breve comparación.\n"
+        f"3. Si la pregunta es ambigua, asume que se refiere al tema más cercano de la lista.\n"
+        f"4. Usa Markdown solo en 'ejemplos' y 'avanzada'.\n"
+        f"5. Mantén coherencia con el contexto previo.\n"
+        f"6. Si el usuario pide una curiosidad, da un dato breve relacionado (máx 50 palabras).\n"
+        f"7. No hagas preguntas al usuario ni uses emojis.\n"
+        f"8. Si no puedes responder, sugiere otro tema de la lista.\n"
+        f"9. Si el usuario pega un código o ejercicio, explícalo paso a paso aunque no esté en la lista.\n"
+        f"Contexto: {contexto}{contexto_extra}"
+    )
+    turno["clave_cache"] = clave_respuesta(pregunta, nivel_explicacion, tema_identificado, contexto)
+    turno["mensajes"] = [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": pregunta}
+    ]
+    return turno
+
+def _evento_sse(evento, datos):
+    """Serializa un evento Server-Sent Events con datos JSON."""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
 @chat_bp.route('/buscar_respuesta', methods=['POST'])
 @limiter.limit("50 per hour")
 def buscar_respuesta():
@@ -608,130 +2504,46 @@ def buscar_respuesta():
     try:
         # Validar JSON recibido
         data = BuscarRespuestaInput(**request.get_json())
-        pregunta = data.pregunta.strip()
-        historial = data.historial
-        nivel_explicacion = data.nivel_explicacion
-        conv_id = data.conv_id
-
-        # Validar o crear conversación
-        if not conv_id or not validar_conversacion(usuario, conv_id):
-            conv_id = crear_nueva_conversacion(usuario)
-            session['current_conv_id'] = conv_id
-        elif conv_id != session.get('current_conv_id'):
-            session['current_conv_id'] = conv_id
-
-        # Normalizar pregunta
-        pregunta_norm = pregunta.lower().strip()
-
-        # Construir contexto a partir del historial
-        contexto = ""
-        if historial:
-            contexto = "\nHistorial reciente:\n" + "\n".join(
-                [f"- Pregunta: {h['pregunta']}\n  Respuesta: {h['respuesta']}" for h in historial[-5:]]
-            )
-
-        # Identificar tema
-        tema_identificado = None
-        for tema in TEMAS_DISPONIBLES:
-            if tema.lower() in pregunta_norm:
-                tema_identificado = tema
-                break
-        if not tema_identificado:
-            tema_identificado = TEMAS_DISPONIBLES[0] if TEMAS_DISPONIBLES else 'General'
-
-        # Extraer definición y ejemplo del tema de temas.json
-        tema_detalle = None
-        for unidad in TEMAS_COMPLETOS:  # asegúrate que cargaste temas.json completo en TEMAS_COMPLETOS
-            for t in unidad.get("temas", []):
-                if t["nombre"].lower() == tema_identificado.lower():
-                    tema_detalle = t
-                    break
-            if tema_detalle:
-                break
+        turno = _preparar_turno(data, usuario)
+        pregunta, conv_id, tema_identificado = turno["pregunta"], turno["conv_id"], turno["tema"]
 
-        contexto_extra = ""
-        if tema_detalle:
-            definicion = tema_detalle.get("definición", "")
-            ejemplo = tema_detalle.get("ejemplo", "")
-            contexto_extra = f"\nDefinición del tema '{tema_identificado}': {definicion}\nEjemplo: {ejemplo}"
+        if turno["respuesta_simple"]:
+            guardar_turno(usuario, conv_id, pregunta, turno["respuesta_simple"], tema=tema_identificado, client_id=turno["client_id"])
+            return jsonify({'respuesta': turno["respuesta_simple"], 'conv_id': conv_id})
 
-        # Evitar duplicar saludo
-        saludo_inicial = "Hola, soy YELIA 👋. ¿En qué tema de Programación Avanzada quieres que te ayude hoy?"
-        es_saludo_duplicado = False
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT content FROM messages WHERE conv_id = %s ORDER BY created_at DESC LIMIT 1", (conv_id,))
-                ultimo_mensaje = cur.fetchone()
-                if ultimo_mensaje and ultimo_mensaje[0] == saludo_inicial:
-                    es_saludo_duplicado = True
-
-        # Respuestas simples
-        respuestas_simples = {
-            r"^(hola|¡hola!|buenos días|buenas tardes|buenas noches|hey|hi)$": (
-                "Hola, ¿cómo puedo ayudarte con Programación Avanzada hoy?"
-                if not es_saludo_duplicado else None
-            ),
-            r"^(qu[ié] eres|qu[ié] es yelia|quien eres|quien es yelia)$": (
-                "Soy YELIA, un tutor de Programación Avanzada para Ingeniería en Telemática. "
-                "Puedo explicarte temas como POO, UML, patrones de diseño, y más. ¿Qué quieres aprender?"
-            ),
-            r"^(ayuda|help|qué puedes hacer|que puedes hacer)$": (
-                "Puedo explicarte temas de Programación Avanzada, generar quizzes, recomendar temas y convertir texto a voz. "
-                f"Prueba con una pregunta sobre {tema_identificado} o pide un quiz."
-            )
-        }
-
-        for patron, respuesta in respuestas_simples.items():
-            if re.match(patron, pregunta_norm, re.IGNORECASE) and respuesta:
-                guardar_mensaje(usuario, conv_id, 'user', pregunta, tema=tema_identificado)
-                guardar_mensaje(usuario, conv_id, 'bot', respuesta, tema=tema_identificado)
-                return jsonify({'respuesta': respuesta, 'conv_id': conv_id})
-
-        # Prompt completo
-        prompt = (
-            f"Eres YELIA, un tutor especializado en Programación Avanzada para Ingeniería en Telemática.\n"
-            f"Sigue estas instrucciones estrictamente:\n"
-            f"1. Responde con prioridad sobre los temas: {', '.join(TEMAS_DISPONIBLES)}.\n"
-            f"2. Nivel de explicación: '{nivel_explicacion}'.\n"
-            f"   - 'basica': SOLO una definición clara y concisa (máximo 70 palabras) en texto plano.\n"
-            f"   - 'ejemplos': Definición breve (máximo 80 palabras) + UN SOLO ejemplo en Java (máximo 10 líneas).\n"
-            f"   - 'avanzada': Definición (máximo 80 palabras) + 2-3 ventajas + UN SOLO ejemplo en Java (máximo 10 líneas) + una breve comparación.\n"
-            f"3. Si la pregunta es ambigua, asume que se refiere al tema más cercano de la lista.\n"
-            f"4. Usa Markdown solo en 'ejemplos' y 'avanzada'.\n"
-            f"5. Mantén coherencia con el contexto previo.\n"
-            f"6. Si el usuario pide una curiosidad, da un dato breve relacionado (máx 50 palabras).\n"
-            f"7. No hagas preguntas al usuario ni uses emojis.\n"
-            f"8. Si no puedes responder, sugiere otro tema de la lista.\n"
-            f"9. Si el usuario pega un código o ejercicio, explícalo paso a paso aunque no esté en la lista.\n"
-            f"Contexto: {contexto}{contexto_extra}\n"
-            f"Timestamp: {int(time.time())}"
-        )
+        respuesta = respuestas_cache.get_texto(turno["clave_cache"])
+        if respuesta:
+            logger.info("Respuesta servida desde caché", usuario=usuario, conv_id=conv_id, tema=tema_identificado)
+            guardar_turno(usuario, conv_id, pregunta, respuesta, tema=tema_identificado, client_id=turno["client_id"])
+            return jsonify({'respuesta': respuesta, 'conv_id': conv_id})
 
         try:
-            completion = call_groq_api(
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": pregunta}
-                ],
-                model="llama3-70b-8192",
-                max_tokens=300,
-                temperature=0.2
-            )
-
-            # Validar respuesta
-            respuesta = getattr(completion.choices[0].message, "content", None) or ""
-            if not respuesta.strip():
-                raise ValueError("Respuesta de Groq vacía o inválida")
-
-            guardar_mensaje(usuario, conv_id, 'user', pregunta, tema=tema_identificado)
-            guardar_mensaje(usuario, conv_id, 'bot', respuesta, tema=tema_identificado)
+            # Preguntas idénticas simultáneas comparten una sola llamada a Groq
+            with vuelos.coordinar('respuestas', turno["clave_cache"],
+                                  lambda: respuestas_cache.get_texto(turno["clave_cache"])) as vuelo:
+                respuesta = vuelo.resultado
+                if respuesta is None:
+                    completion = call_groq_api(
+                        messages=turno["mensajes"],
+                        model="llama3-70b-8192",
+                        max_tokens=300,
+                        temperature=0.2
+                    )
+
+                    # Validar respuesta
+                    respuesta = getattr(completion.choices[0].message, "content", None) or ""
+                    if not respuesta.strip():
+                        raise ValueError("Respuesta de Groq vacía o inválida")
+
+                    respuestas_cache.set_texto(turno["clave_cache"], respuesta.strip())
+                    vuelo.publicar(respuesta.strip())
+            guardar_turno(usuario, conv_id, pregunta, respuesta, tema=tema_identificado, client_id=turno["client_id"])
             return jsonify({'respuesta': respuesta.strip(), 'conv_id': conv_id})
 
         except Exception as e:
             logger.error("Error al procesar respuesta de Groq", error=str(e), pregunta=pregunta, usuario=usuario, conv_id=conv_id)
-            respuesta = f"No encontré respuesta directa, pero podemos revisar el tema '{tema_identificado}' o resolver un ejercicio juntos."
-            guardar_mensaje(usuario, conv_id, 'user', pregunta, tema=tema_identificado)
-            guardar_mensaje(usuario, conv_id, 'bot', respuesta, tema=tema_identificado)
+            respuesta = turno["fallback"]
+            guardar_turno(usuario, conv_id, pregunta, respuesta, tema=tema_identificado, client_id=turno["client_id"])
             return jsonify({'respuesta': respuesta, 'conv_id': conv_id})
 
     except ValidationError as e:
@@ -740,6 +2552,354 @@ def buscar_respuesta():
         logger.error("Error en /buscar_respuesta", error=str(e), usuario=usuario)
         return jsonify({"error": f"Error al procesar la solicitud: {str(e)}", "status": 500}), 500
 
+@chat_bp.route('/buscar_respuesta/stream', methods=['POST'])
+@limiter.limit("50 per hour")
+def buscar_respuesta_stream():
+    """Variante de /buscar_respuesta que envía los tokens de Groq como Server-Sent Events."""
+    data_json = request.get_json(silent=True) or {}
+    usuario = data_json.get("usuario") or session.get("usuario") or uuid.uuid4().hex
+    session['usuario'] = usuario
+
+    try:
+        data = BuscarRespuestaInput(**request.get_json())
+        turno = _preparar_turno(data, usuario)
+    except ValidationError as e:
+        return jsonify({"error": f"Datos inválidos: {str(e)}", "status": 400}), 400
+    except Exception as e:
+        logger.error("Error en /buscar_respuesta/stream", error=str(e), usuario=usuario)
+        return jsonify({"error": f"Error al procesar la solicitud: {str(e)}", "status": 500}), 500
+
+    pregunta, conv_id, tema_identificado = turno["pregunta"], turno["conv_id"], turno["tema"]
+    respuesta_cacheada = respuestas_cache.get_texto(turno["clave_cache"]) if turno["clave_cache"] else None
+
+    def eventos():
+        yield _evento_sse("inicio", {"conv_id": conv_id, "tema": tema_identificado})
+        if turno["respuesta_simple"]:
+            respuesta = turno["respuesta_simple"]
+            yield _evento_sse("token", {"t": respuesta})
+        elif respuesta_cacheada:
+            respuesta = respuesta_cacheada
+            yield _evento_sse("token", {"t": respuesta})
+        else:
+            partes = []
+            try:
+                # Si otra petición idéntica ya está generando, se envía su respuesta completa de una vez
+                with vuelos.coordinar('respuestas', turno["clave_cache"],
+                                      lambda: respuestas_cache.get_texto(turno["clave_cache"])) as vuelo:
+                    if vuelo.resultado is not None:
+                        partes.append(vuelo.resultado)
+                        yield _evento_sse("token", {"t": vuelo.resultado})
+                    else:
+                        for token in stream_groq_api(
+                            messages=turno["mensajes"],
+                            model="llama3-70b-8192",
+                            max_tokens=300,
+                            temperature=0.2
+                        ):
+                            partes.append(token)
+                            yield _evento_sse("token", {"t": token})
+                        if not "".join(partes).strip():
+                            raise ValueError("Respuesta de Groq vacía o inválida")
+                        respuestas_cache.set_texto(turno["clave_cache"], "".join(partes).strip())
+                        vuelo.publicar("".join(partes).strip())
+            except Exception as e:
+                logger.error("Error en streaming de Groq", error=str(e), pregunta=pregunta, usuario=usuario, conv_id=conv_id)
+                if not "".join(partes).strip():
+                    partes = [turno["fallback"]]
+                    yield _evento_sse("token", {"t": turno["fallback"]})
+            respuesta = "".join(partes).strip()
+        # El mensaje del bot se persiste completo una sola vez, al cerrar el stream
+        guardar_turno(usuario, conv_id, pregunta, respuesta, tema=tema_identificado, client_id=turno["client_id"])
+        yield _evento_sse("fin", {"conv_id": conv_id, "respuesta": respuesta})
+
+    return Response(
+        stream_with_context(eventos()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+# --- Banco de Preguntas de Quiz ---
+QUIZ_BANCO_REFILL = os.getenv('QUIZ_BANCO_REFILL', 'true').lower() == 'true'
+QUIZ_BANCO_OBJETIVO = int(os.getenv('QUIZ_BANCO_OBJETIVO', 10))  # preguntas deseadas por (tema, nivel)
+QUIZ_BANCO_INTERVALO = int(os.getenv('QUIZ_BANCO_INTERVALO', 300))  # segundos entre rondas de relleno
+QUIZ_BANCO_POR_RONDA = int(os.getenv('QUIZ_BANCO_POR_RONDA', 5))  # llamadas a Groq por ronda
+QUIZ_LOTE = int(os.getenv('QUIZ_LOTE', 8))  # preguntas pedidas por llamada a Groq
+QUIZ_TOKENS_POR_PREGUNTA = 350
+QUIZ_BANCO_MARCA = "quiz_banco:ronda"  # fila en vuelos_en_curso: un solo worker rellena a la vez
+
+# Niveles aceptados y su forma canónica en el banco ('ejemplos' es el nivel del chat)
+NIVELES_QUIZ = {
+    'basica': 'basica', 'basico': 'basica',
+    'ejemplos': 'intermedio', 'intermedio': 'intermedio',
+    'avanzada': 'avanzada'
+}
+
+def normalizar_nivel_quiz(nivel):
+    """Devuelve el nivel canónico de quiz para un nivel de explicación."""
+    return NIVELES_QUIZ.get((nivel or '').lower(), 'basica')
+
+def validate_quiz_format(quiz_data):
+    """Valida la estructura de una pregunta de quiz; lanza ValueError si no es válida."""
+    required_keys = ["pregunta", "opciones", "respuesta_correcta", "tema", "nivel"]
+    if not all(key in quiz_data for key in required_keys):
+        raise ValueError("Faltan claves requeridas en quiz_data")
+    if not isinstance(quiz_data["opciones"], list) or len(quiz_data["opciones"]) != 4:
+        raise ValueError("Opciones deben ser una lista de exactamente 4 elementos")
+    if quiz_data["respuesta_correcta"] not in quiz_data["opciones"]:
+        raise ValueError("Respuesta correcta no está en las opciones")
+    if quiz_data["tema"] not in indice_temas:
+        raise ValueError(f"Tema {quiz_data['tema']} no es válido")
+    if str(quiz_data["nivel"]).lower() not in NIVELES_QUIZ:
+        raise ValueError(f"Nivel {quiz_data['nivel']} no es válido")
+
+def validar_explicaciones(quiz_data):
+    """Valida que haya una explicación no vacía por cada opción; lanza ValueError si no."""
+    explicaciones = quiz_data.get("explicaciones")
+    if not isinstance(explicaciones, dict):
+        raise ValueError("Explicaciones deben ser un objeto opción -> texto")
+    for opcion in quiz_data["opciones"]:
+        if not isinstance(explicaciones.get(opcion), str) or not explicaciones[opcion].strip():
+            raise ValueError(f"Falta la explicación de la opción {opcion}")
+
+def generar_quizzes(tema, nivel, cantidad=QUIZ_LOTE, prioridad=PRIORIDAD_INTERACTIVA):
+    """Genera con una sola llamada a Groq (modo JSON) hasta `cantidad` preguntas validadas para (tema, nivel).
+
+    El prompt no lleva contexto de ninguna conversación: las preguntas van al banco compartido por todos.
+    """
+    prompt = (
+        f"Eres YELIA, un tutor especializado en Programación Avanzada para Ingeniería en Telemática. "
+        f"Genera {cantidad} preguntas de opción múltiple distintas (4 opciones, 1 correcta) sobre el tema '{tema}' "
+        f"para el nivel '{nivel}'. Devuelve un objeto JSON con la clave 'preguntas': una lista de objetos con las claves "
+        f"'pregunta' (máximo 100 caracteres), 'opciones' (lista de 4 strings, máximo 50 caracteres cada una), "
+        f"'respuesta_correcta' (string, debe coincidir con una opción) y 'explicaciones' (objeto cuyas claves son "
+        f"exactamente las 4 opciones y cuyos valores explican en máximo 2 frases por qué cada opción es o no correcta). "
+        "No uses Markdown ni emojis."
+    )
+    completion = call_groq_api(
+        messages=[
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": f"Genera {cantidad} preguntas de quiz."}
+        ],
+        model="llama3-70b-8192",
+        max_tokens=min(QUIZ_TOKENS_POR_PREGUNTA * cantidad, 8000),
+        temperature=0.4,
+        prioridad=prioridad,
+        response_format={"type": "json_object"}
+    )
+    try:
+        items = json.loads(completion.choices[0].message.content).get("preguntas", [])
+    except (json.JSONDecodeError, AttributeError) as e:
+        logger.error("Lote de quiz de Groq ilegible", error=str(e), tema=tema, nivel=nivel)
+        return []
+    if not isinstance(items, list):
+        return []
+
+    # Cada pregunta se valida por separado: las inválidas se descartan sin perder el resto del lote
+    validas, huellas = [], set()
+    for item in items:
+        try:
+            quiz_data = {
+                "pregunta": item["pregunta"], "opciones": item["opciones"],
+                "respuesta_correcta": item["respuesta_correcta"], "explicaciones": item.get("explicaciones"),
+                "tema": tema, "nivel": nivel
+            }
+            validate_quiz_format(quiz_data)
+            validar_explicaciones(quiz_data)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Pregunta de quiz descartada", error=str(e), tema=tema, nivel=nivel)
+            continue
+        if huella_quiz(quiz_data) not in huellas:
+            huellas.add(huella_quiz(quiz_data))
+            validas.append(quiz_data)
+    logger.info("Lote de quiz generado", tema=tema, nivel=nivel, pedidas=cantidad, recibidas=len(items), validas=len(validas))
+    return validas
+
+def huella_quiz(quiz_data):
+    """Huella para de-duplicar preguntas equivalentes dentro del banco."""
+    return hashlib.sha256(normalizar_pregunta(quiz_data["pregunta"]).encode('utf-8')).hexdigest()
+
+def guardar_en_banco(quizzes):
+    """Inserta preguntas validadas en quiz_banco con un INSERT multi-fila; devuelve {huella: (id, insertada)}."""
+    if not quizzes:
+        return {}
+    filas = [
+        (q["tema"], q["nivel"], q["pregunta"], json.dumps(q["opciones"], ensure_ascii=False),
+         q["respuesta_correcta"], json.dumps(q.get("explicaciones") or {}, ensure_ascii=False), huella_quiz(q))
+        for q in quizzes
+    ]
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            # DO UPDATE sin cambios para que RETURNING incluya también las filas ya existentes
+            resultado = execute_values(c, """
+                INSERT INTO quiz_banco (tema, nivel, pregunta, opciones, respuesta_correcta, explicaciones, huella)
+                VALUES %s
+                ON CONFLICT (tema, nivel, huella) DO UPDATE SET huella = EXCLUDED.huella
+                RETURNING huella, id, (xmax = 0)
+            """, filas, fetch=True)
+            conn.commit()
+        return {huella: (quiz_id, insertada) for huella, quiz_id, insertada in resultado}
+    except PsycopgError as e:
+        logger.error("Error al guardar en quiz_banco", error=str(e))
+        return {}
+
+def tomar_quiz_banco(usuario, tema, nivel):
+    """Devuelve una pregunta del banco para (tema, nivel) que el usuario aún no haya respondido."""
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT b.id, b.pregunta, b.opciones, b.respuesta_correcta
+                FROM quiz_banco b
+                WHERE b.tema = %s AND b.nivel = %s
+                  AND NOT EXISTS (
+                      SELECT 1 FROM quiz_logs l WHERE l.usuario = %s AND l.pregunta = b.pregunta
+                  )
+                ORDER BY random()
+                LIMIT 1
+            """, (tema, nivel, usuario))
+            row = c.fetchone()
+            conn.commit()
+    except PsycopgError as e:
+        logger.error("Error al leer quiz_banco", error=str(e), tema=tema, nivel=nivel)
+        return None
+    if not row:
+        return None
+    return {
+        "quiz_id": row[0], "pregunta": row[1], "opciones": row[2],
+        "respuesta_correcta": row[3], "tema": tema, "nivel": nivel
+    }
+
+def cargar_quiz_banco(quiz_id):
+    """Devuelve pregunta, respuesta correcta, tema y explicaciones de una pregunta del banco."""
+    try:
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            c.execute(
+                "SELECT pregunta, respuesta_correcta, tema, explicaciones FROM quiz_banco WHERE id = %s",
+                (quiz_id,)
+            )
+            row = c.fetchone()
+            conn.commit()
+    except PsycopgError as e:
+        logger.error("Error al leer quiz_banco", error=str(e), quiz_id=quiz_id)
+        return None
+    if not row:
+        return None
+    return {"pregunta": row[0], "respuesta_correcta": row[1], "tema": row[2], "explicaciones": row[3] or {}}
+
+def explicar_desde_banco(banco, respuesta, respuesta_correcta, es_correcta):
+    """Arma la explicación con las explicaciones por opción guardadas; None si faltan."""
+    normalizar = lambda texto: ''.join(texto.strip().lower().split())
+    explicaciones = {normalizar(opcion): texto for opcion, texto in banco["explicaciones"].items()}
+    correcta = explicaciones.get(normalizar(respuesta_correcta))
+    if not correcta:
+        return None
+    if es_correcta:
+        return correcta
+    elegida = explicaciones.get(normalizar(respuesta))
+    return f"{elegida} {correcta}" if elegida else correcta
+
+def explicar_con_groq(pregunta, respuesta, respuesta_correcta, es_correcta, usuario):
+    """Genera la explicación de una respuesta de quiz con Groq (sólo para payloads sin explicaciones)."""
+    try:
+        prompt = (
+            f"Eres YELIA, un tutor educativo de Programación Avanzada para Ingeniería en Telemática. "
+            f"El usuario respondió a la pregunta: '{pregunta}'. "
+            f"La respuesta dada fue: '{respuesta}'. "
+            f"La respuesta correcta es: '{respuesta_correcta}'. "
+            f"La respuesta es {'correcta' if es_correcta else 'incorrecta'}. "
+            f"Proporciona una explicación breve en español de por qué la respuesta correcta es adecuada (máximo 50 palabras). "
+            f"Si es incorrecta, explica por qué la seleccionada es errónea y por qué la correcta es adecuada. "
+            f"Responde solo con la explicación, sin formato adicional ni Markdown."
+        )
+        response = call_groq_api(
+            messages=[{"role": "system", "content": prompt}],
+            model="llama3-70b-8192",
+            max_tokens=100,
+            temperature=0.2
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        logger.error("Error al generar explicación con Groq", error=str(e), usuario=usuario)
+        return explicacion_quiz_respaldo(es_correcta)
+
+def explicacion_quiz_respaldo(es_correcta):
+    """Explicación fija cuando Groq no puede explicar la respuesta."""
+    return (
+        f"La respuesta es {'correcta' if es_correcta else 'incorrecta'}. "
+        f"{'La respuesta es correcta.' if es_correcta else 'La respuesta seleccionada no es adecuada.'} "
+    )
+
+class RellenadorQuizBanco:
+    """Hilo de fondo que mantiene cada celda (tema, nivel) de quiz_banco con preguntas validadas."""
+
+    def __init__(self, objetivo, intervalo, por_ronda):
+        self.objetivo = objetivo
+        self.intervalo = intervalo
+        self.por_ronda = por_ronda
+        self._pid = None
+        self._hilo = None
+        self._parar = threading.Event()
+
+    def iniciar(self):
+        """Arranca el hilo una vez por proceso (los hilos no sobreviven al fork de gunicorn)."""
+        if self._pid == os.getpid() and self._hilo and self._hilo.is_alive():
+            return
+        self._pid = os.getpid()
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="rellenador-quiz", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._parar.set()
+
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo):
+            try:
+                self.ronda()
+            except Exception as e:
+                logger.error("Error en ronda de relleno de quiz_banco", error=str(e))
+
+    def _deficits(self, c):
+        c.execute("SELECT tema, nivel, COUNT(*) FROM quiz_banco GROUP BY tema, nivel")
+        existentes = {(tema, nivel): n for tema, nivel, n in c.fetchall()}
+        deficits = [
+            (self.objetivo - existentes.get((tema, nivel), 0), tema, nivel)
+            for tema in TEMAS_DISPONIBLES
+            for nivel in sorted(set(NIVELES_QUIZ.values()))
+        ]
+        return sorted((d for d in deficits if d[0] > 0), reverse=True)
+
+    def ronda(self):
+        """Genera preguntas para las celdas con más déficit, hasta `por_ronda` llamadas a Groq."""
+        # Un solo worker rellena a la vez; la marca caduca sola si el worker muere a mitad de ronda
+        if not vuelos.marcar(QUIZ_BANCO_MARCA, ttl=self.intervalo):
+            return 0
+        try:
+            # La conexión sólo se usa para leer los déficits, no durante las llamadas a Groq
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                deficits = self._deficits(c)
+                conn.commit()
+            llamadas, nuevas = 0, 0
+            for deficit, tema, nivel in deficits:
+                if llamadas >= self.por_ronda or self._parar.is_set():
+                    break
+                llamadas += 1
+                try:
+                    lote = generar_quizzes(tema, nivel, min(deficit, QUIZ_LOTE), prioridad=PRIORIDAD_FONDO)
+                except ValueError as e:
+                    logger.warning("Lote de quiz descartado", error=str(e), tema=tema, nivel=nivel)
+                    continue
+                nuevas += sum(1 for _, insertada in guardar_en_banco(lote).values() if insertada)
+            logger.info("Ronda de relleno de quiz_banco", llamadas=llamadas, nuevas=nuevas, celdas_con_deficit=len(deficits))
+            return nuevas
+        finally:
+            vuelos.desmarcar(QUIZ_BANCO_MARCA)
+
+rellenador_quiz = RellenadorQuizBanco(QUIZ_BANCO_OBJETIVO, QUIZ_BANCO_INTERVALO, QUIZ_BANCO_POR_RONDA)
 
 # Blueprint para rutas relacionadas con quiz
 quiz_bp = Blueprint('quiz', __name__)
@@ -747,7 +2907,7 @@ quiz_bp = Blueprint('quiz', __name__)
 @quiz_bp.route('/quiz', methods=['POST'])
 @limiter.limit("20 per hour")
 def quiz():
-    """Genera una pregunta de quiz usando Groq API."""
+    """Sirve una pregunta de quiz desde el banco, generándola con Groq sólo si no hay disponibles."""
     # --- Manejo de userId persistente ---
     data_json = request.get_json(silent=True) or {}
     usuario = data_json.get("usuario") or session.get("usuario") or uuid.uuid4().hex
@@ -755,9 +2915,8 @@ def quiz():
 
     try:
         data = QuizInput(**request.get_json())
-        historial = data.historial
-        nivel = data.nivel.lower()
-        tema_seleccionado = data.tema if data.tema in TEMAS_DISPONIBLES else random.choice(TEMAS_DISPONIBLES)
+        nivel = normalizar_nivel_quiz(data.nivel)
+        tema_seleccionado = indice_temas.resolver(data.tema) or random.choice(TEMAS_DISPONIBLES)
 
         # Crear o validar conversación
         conv_id = session.get('current_conv_id')
@@ -765,60 +2924,18 @@ def quiz():
             conv_id = crear_nueva_conversacion(usuario)
             session['current_conv_id'] = conv_id
 
-        def validate_quiz_format(quiz_data):
-            required_keys = ["pregunta", "opciones", "respuesta_correcta", "tema", "nivel"]
-            if not all(key in quiz_data for key in required_keys):
-                raise ValueError("Faltan claves requeridas en quiz_data")
-            if not isinstance(quiz_data["opciones"], list) or len(quiz_data["opciones"]) != 4:
-                raise ValueError("Opciones deben ser una lista de exactamente 4 elementos")
-            if quiz_data["respuesta_correcta"] not in quiz_data["opciones"]:
-                raise ValueError("Respuesta correcta no está en las opciones")
-            if quiz_data["tema"] not in TEMAS_DISPONIBLES:
-                raise ValueError(f"Tema {quiz_data['tema']} no es válido")
-            if quiz_data["nivel"].lower() not in ["basica", "basico", "intermedio", "avanzada"]:
-                raise ValueError(f"Nivel {quiz_data['nivel']} no es válido")
-
-        contexto = ""
-        if historial:
-            contexto = "\nHistorial reciente:\n" + "\n".join([f"- Pregunta: {h['pregunta']}\n  Respuesta: {h['respuesta']}" for h in historial[-5:]])
-
-        prompt = (
-            f"Eres YELIA, un tutor especializado en Programación Avanzada para Ingeniería en Telemática. Civilian"
-            f"Genera una pregunta de opción múltiple (4 opciones, 1 correcta) sobre el tema '{tema_seleccionado}' "
-            f"para el nivel '{nivel}'. Devuelve un objeto JSON con las claves: "
-            f"'pregunta' (máximo 100 caracteres), 'opciones' (lista de 4 strings, máximo 50 caracteres cada una), "
-            f"'respuesta_correcta' (string, debe coincidir con una opción), 'tema' (string), 'nivel' (string). "
-            f"No uses Markdown, emojis, ni texto adicional. Usa 'nivel': '{nivel}' exactamente. "
-            f"Contexto: {contexto}\nTemas disponibles: {', '.join(TEMAS_DISPONIBLES)}"
-        )
-
-        completion = call_groq_api(
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": "Genera una pregunta de quiz."}
-            ],
-            model="llama3-70b-8192",
-            max_tokens=300,
-            temperature=0.2
-        )
-
-        try:
-            quiz_data = json.loads(completion.choices[0].message.content.strip())
-            validate_quiz_format(quiz_data)
-        except (json.JSONDecodeError, ValueError) as e:
-            logger.error("Error en el formato del quiz de Groq", error=str(e), usuario=usuario, tema=tema_seleccionado)
-            quiz_data = {
-                "pregunta": f"¿Qué permite ocultar los detalles internos de una clase?" if tema_seleccionado == "Encapsulamiento" else f"¿Qué diagrama UML muestra la estructura estática?",
-                "opciones": ["Encapsulamiento", "Herencia", "Polimorfismo", "Abstracción"] if tema_seleccionado == "Encapsulamiento" else ["Diagrama de Clases", "Diagrama de Actividades", "Diagrama de Estados", "Diagrama de Componentes"],
-                "respuesta_correcta": "Encapsulamiento" if tema_seleccionado == "Encapsulamiento" else "Diagrama de Clases",
-                "tema": tema_seleccionado,
-                "nivel": nivel
-            }
-            try:
-                validate_quiz_format(quiz_data)
-            except ValueError as ve:
-                logger.error("Formato de quiz de respaldo inválido", error=str(ve), usuario=usuario)
-                return jsonify({"error": "No se pudo generar un quiz válido", "status": 500}), 500
+        quiz_data = tomar_quiz_banco(usuario, tema_seleccionado, nivel)
+        if quiz_data:
+            logger.info("Quiz servido desde el banco", usuario=usuario, tema=tema_seleccionado, nivel=nivel, quiz_id=quiz_data["quiz_id"])
+        else:
+            # Un lote completo: la primera pregunta se sirve ahora y el resto queda en el banco
+            lote = generar_quizzes(tema_seleccionado, nivel, QUIZ_LOTE)
+            if not lote:
+                logger.error("Groq no devolvió preguntas de quiz válidas", usuario=usuario, tema=tema_seleccionado, nivel=nivel)
+                return jsonify({"error": "No se pudo generar un quiz válido", "status": 503}), 503
+            guardados = guardar_en_banco(lote)
+            quiz_data = {k: v for k, v in lote[0].items() if k != "explicaciones"}
+            quiz_data["quiz_id"] = guardados.get(huella_quiz(quiz_data), (None, False))[0]
 
         # Guardar la pregunta del quiz como mensaje
         pregunta_texto = f"{quiz_data['pregunta']} Opciones: {', '.join(quiz_data['opciones'])}"
@@ -846,7 +2963,6 @@ def responder_quiz():
     try:
         data = ResponderQuizInput(**request.get_json())
         respuesta = data.respuesta
-        respuesta_correcta = data.respuesta_correcta
         tema = data.tema
         pregunta = data.pregunta
 
@@ -856,54 +2972,52 @@ def responder_quiz():
             conv_id = crear_nueva_conversacion(usuario)
             session['current_conv_id'] = conv_id
 
+        # Preguntas del banco: la respuesta correcta y las explicaciones salen del servidor
+        banco = cargar_quiz_banco(data.quiz_id) if data.quiz_id else None
+        if banco:
+            pregunta, respuesta_correcta, tema = banco["pregunta"], banco["respuesta_correcta"], banco["tema"]
+        elif data.respuesta_correcta:
+            respuesta_correcta = data.respuesta_correcta
+        else:
+            return jsonify({"error": "Falta quiz_id o respuesta_correcta", "status": 400}), 400
+
         respuesta_norm = ''.join(respuesta.strip().lower().split())
         respuesta_correcta_norm = ''.join(respuesta_correcta.strip().lower().split())
         es_correcta = respuesta_norm == respuesta_correcta_norm
         logger.info("Comparando respuesta", respuesta=respuesta_norm, respuesta_correcta=respuesta_correcta_norm, es_correcta=es_correcta, usuario=usuario)
 
+        explicacion = explicar_desde_banco(banco, respuesta, respuesta_correcta, es_correcta) if banco else None
+        if explicacion is None:
+            # Payload heredado (sin quiz_id o sin explicaciones guardadas): se explica con Groq
+            explicacion = explicar_con_groq(pregunta, respuesta, respuesta_correcta, es_correcta, usuario)
+
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
             puntos = 10 if es_correcta else 0
-            cursor.execute(
-                'INSERT INTO quiz_logs (usuario, pregunta, respuesta, es_correcta, tema, puntos) VALUES (%s, %s, %s, %s, %s, %s)',
-                (usuario, pregunta, respuesta, es_correcta, tema, puntos)
-            )
-            conn.commit()
-            cursor.close()
-            conn.close()
-            logger.info("Quiz guardado en quiz_logs", usuario=usuario, pregunta=pregunta, respuesta=respuesta)
+            diferido = escritor_diferido.encolar(conv_id, [
+                ('quiz_logs', (usuario, pregunta, respuesta, es_correcta, tema, puntos)),
+                ('mensajes', (conv_id, 'bot', explicacion, tema, None))
+            ])
+            if not diferido:
+                with get_db_connection() as conn:
+                    cursor = conn.cursor()
+                    # Registro del quiz y mensaje de explicación en una sola sentencia y transacción
+                    cursor.execute(
+                        """
+                        WITH registro AS (
+                            INSERT INTO quiz_logs (usuario, pregunta, respuesta, es_correcta, tema, puntos)
+                            VALUES (%s, %s, %s, %s, %s, %s)
+                        )
+                        INSERT INTO messages (conv_id, role, content, tema) VALUES (%s, 'bot', %s, %s)
+                        """,
+                        (usuario, pregunta, respuesta, es_correcta, tema, puntos, conv_id, explicacion, tema)
+                    )
+                    conn.commit()
+                    cursor.close()
+            logger.info("Quiz guardado en quiz_logs", usuario=usuario, pregunta=pregunta, respuesta=respuesta, quiz_id=data.quiz_id, diferido=diferido)
         except PsycopgError as e:
             logger.error("Error al guardar en quiz_logs", error=str(e), usuario=usuario)
             return jsonify({"error": f"Error de base de datos al guardar quiz: {str(e)}", "status": 500}), 500
 
-        try:
-            prompt = (
-                f"Eres YELIA, un tutor educativo de Programación Avanzada para Ingeniería en Telemática. "
-                f"El usuario respondió a la pregunta: '{pregunta}'. "
-                f"La respuesta dada fue: '{respuesta}'. "
-                f"La respuesta correcta es: '{respuesta_correcta}'. "
-                f"La respuesta es {'correcta' if es_correcta else 'incorrecta'}. "
-                f"Proporciona una explicación breve en español de por qué la respuesta correcta es adecuada (máximo 50 palabras). "
-                f"Si es incorrecta, explica por qué la seleccionada es errónea y por qué la correcta es adecuada. "
-                f"Responde solo con la explicación, sin formato adicional ni Markdown."
-            )
-            response = call_groq_api(
-                messages=[{"role": "system", "content": prompt}],
-                model="llama3-70b-8192",
-                max_tokens=100,
-                temperature=0.2
-            )
-            explicacion = response.choices[0].message.content.strip()
-        except Exception as e:
-            logger.error("Error al generar explicación con Groq", error=str(e), usuario=usuario)
-            explicacion = (
-                f"La respuesta es {'correcta' if es_correcta else 'incorrecta'}. "
-                f"{'La respuesta es correcta.' if es_correcta else 'La respuesta seleccionada no es adecuada.'} "
-            )
-
-        # Guardar la explicación como mensaje
-        guardar_mensaje(usuario, conv_id, 'bot', explicacion, tema=tema)
         logger.info("Respuesta de quiz procesada", es_correcta=es_correcta, usuario=usuario, conv_id=conv_id)
         return jsonify({
             'es_correcta': es_correcta,
@@ -920,11 +3034,191 @@ def responder_quiz():
             return jsonify({"error": "Servidor de Groq no disponible, intenta de nuevo más tarde", "status": 503}), 503
         return jsonify({"error": f"No se pudo procesar la respuesta del quiz: {str(e)}", "status": 500}), 500
 
+# --- Almacén de Audio TTS ---
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tts_cache'))
+TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+TTS_HILOS = int(os.getenv('TTS_HILOS', 4))  # síntesis de oraciones en paralelo por worker
+TTS_LANG = 'es'
+TTS_TLD = 'com.mx'
+
+REEMPLAZOS_TTS = {
+    'POO': 'Programación Orientada a Objetos',
+    'UML': 'U Em Ele',
+    'MVC': 'Em Vi Ci',
+    'ORM': 'Mapeo Objeto Relacional',
+    'BD': 'Base de Datos'
+}
+_PATRON_REEMPLAZOS_TTS = re.compile(rf"\b({'|'.join(REEMPLAZOS_TTS)})\b", re.IGNORECASE)
+
+def aplicar_reemplazos_tts(texto):
+    """Expande siglas para que gTTS las pronuncie bien."""
+    return _PATRON_REEMPLAZOS_TTS.sub(lambda m: REEMPLAZOS_TTS[m.group(1).upper()], texto)
+
+def clave_audio(texto, lang=TTS_LANG, tld=TTS_TLD):
+    """Clave de contenido del audio: hash del texto ya sustituido más los parámetros de voz."""
+    return hashlib.sha256(f"{lang}|{tld}|{texto}".encode('utf-8')).hexdigest()
+
+class AlmacenAudioTTS:
+    """Caché de MP3 en disco direccionada por contenido, con presupuesto en bytes y desalojo LRU.
+
+    El índice vive en SQLite dentro del mismo directorio, así que todos los workers de gunicorn
+    lo comparten; los archivos se escriben de forma atómica (temporal + os.replace).
+    """
+
+    ACTUALIZAR_ACCESO_SEG = 60  # no reescribir ultimo_acceso en cada reproducción
+
+    def __init__(self, directorio, max_bytes):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.aciertos = 0
+        self.fallos = 0
+        os.makedirs(directorio, exist_ok=True)
+        with self._indice() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS audios
+                          (clave TEXT PRIMARY KEY, bytes INTEGER NOT NULL, ultimo_acceso REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_audios_acceso ON audios(ultimo_acceso)")
+
+    @contextmanager
+    def _indice(self):
+        db = sqlite3.connect(os.path.join(self.directorio, 'indice.sqlite3'), timeout=10, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def ruta(self, clave):
+        return os.path.join(self.directorio, clave[:2], f"{clave}.mp3")
+
+    def obtener(self, clave):
+        """Devuelve la ruta del MP3 si está en caché, o None."""
+        ruta = self.ruta(clave)
+        if not os.path.exists(ruta):
+            self.fallos += 1
+            return None
+        ahora = time.time()
+        try:
+            with self._indice() as db:
+                cur = db.execute(
+                    "UPDATE audios SET ultimo_acceso = ? WHERE clave = ? AND ultimo_acceso < ?",
+                    (ahora, clave, ahora - self.ACTUALIZAR_ACCESO_SEG)
+                )
+                if cur.rowcount == 0 and not db.execute("SELECT 1 FROM audios WHERE clave = ?", (clave,)).fetchone():
+                    # Archivo huérfano (índice perdido): se vuelve a registrar
+                    db.execute("INSERT OR REPLACE INTO audios VALUES (?, ?, ?)", (clave, os.path.getsize(ruta), ahora))
+        except sqlite3.Error as e:
+            logger.warning("Error al actualizar índice de audio", error=str(e))
+        self.aciertos += 1
+        return ruta
+
+    def guardar(self, clave, audio_bytes):
+        """Escribe el MP3 de forma atómica, lo registra y desaloja lo menos usado si se excede el presupuesto."""
+        ruta = self.ruta(clave)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, 'wb') as f:
+            f.write(audio_bytes)
+        os.replace(temporal, ruta)
+        try:
+            with self._indice() as db:
+                db.execute("BEGIN IMMEDIATE")
+                db.execute("INSERT OR REPLACE INTO audios VALUES (?, ?, ?)", (clave, len(audio_bytes), time.time()))
+                total = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM audios").fetchone()[0]
+                desalojados = []
+                if total > self.max_bytes:
+                    for vieja, tamano in db.execute(
+                        "SELECT clave, bytes FROM audios WHERE clave <> ? ORDER BY ultimo_acceso", (clave,)
+                    ).fetchall():
+                        if total <= self.max_bytes:
+                            break
+                        desalojados.append(vieja)
+                        total -= tamano
+                    db.executemany("DELETE FROM audios WHERE clave = ?", [(c,) for c in desalojados])
+                db.execute("COMMIT")
+            for vieja in desalojados:
+                try:
+                    os.remove(self.ruta(vieja))
+                except FileNotFoundError:
+                    pass
+            if desalojados:
+                logger.info("Audios desalojados de la caché TTS", cantidad=len(desalojados), bytes_totales=total)
+        except sqlite3.Error as e:
+            logger.warning("Error al actualizar índice de audio", error=str(e))
+        return ruta
+
+    def stats(self):
+        try:
+            with self._indice() as db:
+                archivos, total = db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM audios").fetchone()
+        except sqlite3.Error:
+            archivos, total = None, None
+        return {"archivos": archivos, "bytes": total, "max_bytes": self.max_bytes,
+                "aciertos": self.aciertos, "fallos": self.fallos}
+
+audio_tts = AlmacenAudioTTS(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES)
+
+_PATRON_ORACIONES = re.compile(r'(?<=[.!?;:])\s+|\n+')
+
+def dividir_oraciones(texto, minimo=20):
+    """Divide el texto en oraciones, uniendo fragmentos muy cortos a la siguiente."""
+    oraciones, pendiente = [], ''
+    for parte in _PATRON_ORACIONES.split(texto):
+        parte = parte.strip()
+        if not parte:
+            continue
+        pendiente = f"{pendiente} {parte}".strip()
+        if len(pendiente) >= minimo:
+            oraciones.append(pendiente)
+            pendiente = ''
+    if pendiente:
+        if oraciones:
+            oraciones[-1] = f"{oraciones[-1]} {pendiente}"
+        else:
+            oraciones.append(pendiente)
+    return oraciones
+
+tts_executor = ThreadPoolExecutor(max_workers=TTS_HILOS, thread_name_prefix="tts")
+
+def sintetizar_oracion(oracion):
+    """Devuelve el MP3 de una oración, desde el almacén o generándolo con gTTS."""
+    clave = clave_audio(oracion)
+    ruta = audio_tts.obtener(clave)
+    if ruta:
+        with open(ruta, 'rb') as f:
+            return f.read()
+    # La misma oración pedida a la vez por varias peticiones se sintetiza una sola vez
+    with vuelos.coordinar('tts_oracion', clave, lambda: audio_tts.obtener(clave)) as vuelo:
+        if vuelo.resultado is None:
+            audio_io = io.BytesIO()
+            gTTS(text=oracion, lang=TTS_LANG, tld=TTS_TLD, timeout=GTTS_TIMEOUT).write_to_fp(audio_io)
+            vuelo.publicar(audio_tts.guardar(clave, audio_io.getvalue()))
+            return audio_io.getvalue()
+    with open(vuelo.resultado, 'rb') as f:
+        return f.read()
+
+def sintetizar_texto(texto):
+    """Sintetiza el texto oración por oración en paralelo y concatena los frames MP3 en orden."""
+    oraciones = dividir_oraciones(texto)
+    if len(oraciones) == 1:
+        return sintetizar_oracion(oraciones[0])
+    return b''.join(tts_executor.map(sintetizar_oracion, oraciones))
+
+def enviar_audio(clave, ruta, desde_cache=True):
+    """Sirve un MP3 del almacén con soporte de Range y ETag fuerte (la clave de contenido)."""
+    respuesta = send_file(ruta, mimetype='audio/mpeg', conditional=True, etag=clave, max_age=365 * 24 * 60 * 60)
+    respuesta.headers['X-TTS-Clave'] = clave
+    respuesta.headers['X-TTS-Cache'] = 'hit' if desde_cache else 'miss'
+    return respuesta
+
+def tts_consume_limite(response):
+    """Sólo el audio sintetizado de verdad cuenta para el límite de /tts; la caché es gratis."""
+    return response.headers.get('X-TTS-Cache') != 'hit'
+
 # Blueprint para rutas relacionadas con TTS
 tts_bp = Blueprint('tts', __name__)
 
 @tts_bp.route("/tts", methods=["POST"])
-@limiter.limit("5 per hour")
+@limiter.limit("5 per hour", deduct_when=tts_consume_limite)
 def tts():
     """Genera audio TTS a partir de texto."""
     # --- Manejo de userId persistente ---
@@ -935,40 +3229,33 @@ def tts():
     try:
         data = TTSInput(**request.get_json())
         text = data.text
-        if not text:
+        if not text.strip():
             logger.error("Texto vacío en /tts", usuario=usuario)
             return jsonify({"error": "El texto no puede estar vacío", "status": 400}), 400
         if not all(c.isprintable() or c.isspace() for c in text):
             logger.error("Texto contiene caracteres no válidos", usuario=usuario)
             return jsonify({"error": "El texto contiene caracteres no válidos", "status": 400}), 400
 
-        # Caché de audio
-        cache_key = f"tts:{text}"
-        if cache_key in cache:
-            logger.info("Audio servido desde caché", text=text, usuario=usuario)
-            audio_bytes = cache[cache_key]
-            audio_io = io.BytesIO(audio_bytes)
-            return send_file(audio_io, mimetype='audio/mp3')
-
-        reemplazos = {
-            'POO': 'Programación Orientada a Objetos',
-            'UML': 'U Em Ele',
-            'MVC': 'Em Vi Ci',
-            'ORM': 'Mapeo Objeto Relacional',
-            'BD': 'Base de Datos'
-        }
-        for term, replacement in reemplazos.items():
-            text = re.sub(rf'\b{term}\b', replacement, text, flags=re.IGNORECASE)
+        text = aplicar_reemplazos_tts(text)
+        clave = clave_audio(text)
+
+        # Caché de audio en disco
+        ruta = audio_tts.obtener(clave)
+        if ruta:
+            logger.info("Audio servido desde caché", clave=clave, usuario=usuario)
+            return enviar_audio(clave, ruta)
 
         try:
-            tts = gTTS(text=text, lang='es', tld='com.mx', timeout=GTTS_TIMEOUT)
-            audio_io = io.BytesIO()
-            tts.write_to_fp(audio_io)
-            audio_bytes = audio_io.getvalue()
-            cache[cache_key] = audio_bytes
-            audio_io.seek(0)
-            logger.info("Audio generado exitosamente", text=text, usuario=usuario)
-            return send_file(audio_io, mimetype='audio/mp3')
+            with vuelos.coordinar('tts', clave, lambda: audio_tts.obtener(clave)) as vuelo:
+                compartido = vuelo.resultado is not None
+                if not compartido:
+                    vuelo.publicar(audio_tts.guardar(clave, sintetizar_texto(text)))
+            if compartido:
+                # Otra petición idéntica lo acaba de sintetizar: para el límite cuenta como caché
+                logger.info("Audio compartido con petición en curso", clave=clave, usuario=usuario)
+                return enviar_audio(clave, vuelo.resultado)
+            logger.info("Audio generado exitosamente", text=text, clave=clave, usuario=usuario)
+            return enviar_audio(clave, vuelo.resultado, desde_cache=False)
         except Exception as gtts_error:
             logger.error("Error en gTTS", error=str(gtts_error), usuario=usuario)
             if "429" in str(gtts_error):
@@ -983,23 +3270,187 @@ def tts():
         logger.error("Error en /tts", error=str(e), usuario=session.get('usuario', 'anonimo'))
         return jsonify({"error": f"Error al procesar la solicitud: {str(e)}", "status": 500}), 500
 
+@tts_bp.route("/tts/stream", methods=["POST"])
+@limiter.limit("5 per hour", deduct_when=tts_consume_limite)
+def tts_stream():
+    """Envía el MP3 por partes a medida que se sintetiza cada oración."""
+    # --- Manejo de userId persistente ---
+    data_json = request.get_json(silent=True) or {}
+    usuario = data_json.get("usuario") or session.get("usuario") or uuid.uuid4().hex
+    session['usuario'] = usuario
+
+    try:
+        data = TTSInput(**request.get_json())
+    except ValidationError as e:
+        logger.error("Validación fallida en /tts/stream", error=str(e), usuario=usuario)
+        return jsonify({"error": f"Datos inválidos: {str(e)}", "status": 400}), 400
+    if not data.text.strip() or not all(c.isprintable() or c.isspace() for c in data.text):
+        return jsonify({"error": "El texto está vacío o contiene caracteres no válidos", "status": 400}), 400
+
+    text = aplicar_reemplazos_tts(data.text)
+    clave = clave_audio(text)
+    ruta = audio_tts.obtener(clave)
+    if ruta:
+        logger.info("Audio servido desde caché", clave=clave, usuario=usuario)
+        return enviar_audio(clave, ruta)
+
+    # Todas las oraciones se encolan ya; se envían en orden conforme terminan
+    futuros = [tts_executor.submit(sintetizar_oracion, oracion) for oracion in dividir_oraciones(text)]
+    try:
+        # La primera parte se espera aquí para poder responder con un error HTTP si gTTS falla
+        primera = futuros[0].result()
+    except Exception as gtts_error:
+        for futuro in futuros[1:]:
+            futuro.cancel()
+        logger.error("Error en gTTS", error=str(gtts_error), usuario=usuario)
+        if "429" in str(gtts_error):
+            return jsonify({"error": "Límite de solicitudes alcanzado en gTTS, espera unos minutos", "status": 429}), 429
+        if isinstance(gtts_error, httpx.ConnectTimeout):
+            return jsonify({"error": "Tiempo de conexión agotado en gTTS, verifica tu conexión a internet", "status": 504}), 504
+        return jsonify({"error": f"Error en la generación de audio: {str(gtts_error)}", "status": 500}), 500
+
+    def generar():
+        partes = [primera]
+        yield primera
+        try:
+            for futuro in futuros[1:]:
+                partes.append(futuro.result())
+                yield partes[-1]
+        except Exception as e:
+            logger.error("Error en gTTS durante el streaming", error=str(e), usuario=usuario)
+            return
+        # El audio completo queda en caché para la próxima reproducción
+        audio_tts.guardar(clave, b''.join(partes))
+        logger.info("Audio generado en streaming", clave=clave, oraciones=len(partes), usuario=usuario)
+
+    return Response(
+        generar(),
+        mimetype='audio/mpeg',
+        headers={'X-TTS-Clave': clave, 'X-TTS-Cache': 'miss', 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@tts_bp.route("/tts/audio/<clave>", methods=["GET"])
+@limiter.exempt
+def tts_audio(clave):
+    """Sirve un audio ya sintetizado por su clave de contenido."""
+    if not re.fullmatch(r'[0-9a-f]{64}', clave):
+        return jsonify({"error": "Clave de audio inválida", "status": 400}), 400
+    ruta = audio_tts.obtener(clave)
+    if not ruta:
+        return jsonify({"error": "Audio no encontrado", "status": 404}), 404
+    return enviar_audio(clave, ruta)
+
+# --- Calentamiento de la Caché TTS ---
+# El camino principal es `flask tts-warmup` en el despliegue; al iniciar es opcional
+TTS_WARMUP_AL_INICIAR = os.getenv('TTS_WARMUP_AL_INICIAR', 'false').lower() == 'true'
+TTS_WARMUP_ARCHIVO = os.getenv('TTS_WARMUP_ARCHIVO')  # frases extra, una por línea
+TTS_WARMUP_VIGENCIA = int(os.getenv('TTS_WARMUP_VIGENCIA', 86400))  # segundos antes de volver a calentar
+TTS_WARMUP_MARCA = "tts:calentamiento"  # fila en vuelos_en_curso: un solo worker calienta por vigencia
+
+_PATRON_EMOJIS = re.compile(
+    '[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF\U0001F680-\U0001F6FF\U0001F700-\U0001F77F'
+    '\U0001F780-\U0001F7FF\U0001F800-\U0001F8FF\U0001F900-\U0001F9FF\U0001FA00-\U0001FA6F'
+    '\U0001FA70-\U0001FAFF\u2700-\u27BF]'
+)
+REEMPLAZOS_TTS_CLIENTE = dict(REEMPLAZOS_TTS, API='A Pi I', SQL='Esquiu Ele')
+
+def normalizar_texto_tts(texto):
+    """Replica la limpieza que hace script.js antes de llamar a /tts, para que las claves coincidan."""
+    texto = _PATRON_EMOJIS.sub('', texto)
+    texto = re.sub(r'```[\s\S]*?```', '', texto)
+    texto = re.sub(r'`[^`]+`', '', texto)
+    texto = re.sub(r'\*\*([^*]+)\*\*', r'\1', texto)
+    texto = re.sub(r'\*([^*]+)\*', r'\1', texto)
+    texto = re.sub(r'#+\s*', '', texto)
+    texto = re.sub(r'-\s*', '', texto)
+    texto = re.sub(r'\n+', ' ', texto)
+    texto = re.sub(r'\b(POO|UML|MVC|ORM|BD|API|SQL)\b', lambda m: REEMPLAZOS_TTS_CLIENTE[m.group(1)], texto)
+    texto = re.sub(r'\bYELIA\b', 'Yelia', texto)
+    return texto.strip()
+
+def frases_calentamiento(definiciones=True, archivo=None):
+    """Frases que la app pronuncia una y otra vez, más definiciones de temas y un archivo opcional."""
+    frases = [SALUDO_INICIAL, RESPUESTA_SALUDO, RESPUESTA_PRESENTACION, f"¡Correcto! {explicacion_quiz_respaldo(True)}"]
+    for tema in TEMAS_DISPONIBLES:
+        frases += [PLANTILLA_AYUDA.format(tema=tema), PLANTILLA_FALLBACK.format(tema=tema)]
+        if definiciones:
+            definicion = (indice_temas.detalle(tema) or {}).get('definición')
+            if definicion:
+                frases.append(definicion)
+    if archivo:
+        with open(archivo, encoding='utf-8') as f:
+            frases += [linea.strip() for linea in f if linea.strip()]
+    return list(dict.fromkeys(frases))
+
+def calentar_tts(frases):
+    """Pre-sintetiza las frases en el almacén de audio; devuelve cuántas eran nuevas, ya existían o fallaron."""
+    resultado = {"nuevas": 0, "existentes": 0, "fallidas": 0}
+    for frase in frases:
+        texto = aplicar_reemplazos_tts(normalizar_texto_tts(frase))
+        if not texto:
+            continue
+        clave = clave_audio(texto)
+        if audio_tts.obtener(clave):
+            resultado["existentes"] += 1
+            continue
+        try:
+            audio_tts.guardar(clave, sintetizar_texto(texto))
+            resultado["nuevas"] += 1
+        except Exception as e:
+            resultado["fallidas"] += 1
+            logger.warning("No se pudo pre-sintetizar frase", error=str(e), texto=texto[:60])
+    logger.info("Calentamiento de caché TTS terminado", **resultado)
+    return resultado
+
+_calentamiento_pid = None
+
+def iniciar_calentamiento_tts():
+    """Lanza el calentamiento en un hilo de fondo, una vez por proceso y una vez por vigencia en el despliegue."""
+    global _calentamiento_pid
+    if _calentamiento_pid == os.getpid():
+        return
+    _calentamiento_pid = os.getpid()
+    threading.Thread(target=_calentar_tts_una_vez, name="calentamiento-tts", daemon=True).start()
+
+def _calentar_tts_una_vez():
+    # La marca queda puesta al terminar: otros workers y los reciclajes por max_requests no repiten
+    if not vuelos.marcar(TTS_WARMUP_MARCA, ttl=TTS_WARMUP_VIGENCIA):
+        return
+    try:
+        calentar_tts(frases_calentamiento(archivo=TTS_WARMUP_ARCHIVO))
+    except Exception as e:
+        vuelos.desmarcar(TTS_WARMUP_MARCA)
+        logger.error("Error en el calentamiento de caché TTS", error=str(e))
+
+@app.cli.command('tts-warmup')
+@click.option('--definiciones/--sin-definiciones', default=True, help='Incluir las definiciones de temas.json.')
+@click.option('--archivo', type=click.Path(exists=True, dir_okay=False), default=TTS_WARMUP_ARCHIVO,
+              help='Archivo con frases extra, una por línea.')
+def tts_warmup(definiciones, archivo):
+    """Pre-sintetiza en la caché TTS las frases fijas de YELIA."""
+    frases = frases_calentamiento(definiciones, archivo)
+    click.echo(f"Pre-sintetizando {len(frases)} frases en {TTS_CACHE_DIR}...")
+    resultado = calentar_tts(frases)
+    click.echo(f"Nuevas: {resultado['nuevas']}, ya en caché: {resultado['existentes']}, fallidas: {resultado['fallidas']}")
+
 # Blueprint para rutas relacionadas con recomendaciones
 recommend_bp = Blueprint('recommend', __name__)
 
 @recommend_bp.route("/recommend", methods=["POST"])
 @limiter.limit("20 per hour")
-@retrying.retry(wait_fixed=GROQ_RETRY_WAIT, stop_max_attempt_number=GROQ_RETRY_ATTEMPTS)
 def recommend():
     """Genera una recomendación de tema usando Groq API."""
+    try:
+        data = RecommendInput(**(request.get_json(silent=True) or {}))
+    except ValidationError as e:
+        logger.error("Validación fallida en /recommend", error=str(e), usuario=session.get('usuario', 'anonimo'))
+        return jsonify({"error": f"Datos inválidos: {str(e)}", "status": 400}), 400
+
     # --- Manejo de userId persistente ---
-    data_json = request.get_json(silent=True) or {}
-    usuario = data_json.get("usuario") or session.get("usuario") or uuid.uuid4().hex
+    usuario = data.usuario or session.get("usuario") or uuid.uuid4().hex
     session['usuario'] = usuario
 
     try:
-        data = RecommendInput(**request.get_json())
-        historial = data.historial
-
         # Crear o validar conversación
         conv_id = session.get('current_conv_id')
         if not conv_id or not validar_conversacion(usuario, conv_id):
@@ -1008,23 +3459,19 @@ def recommend():
 
         progreso = cargar_progreso(usuario)
         temas_aprendidos = progreso["temas_aprendidos"].split(",") if progreso["temas_aprendidos"] else []
-        temas_disponibles = []
-        for unidad in temas.get("Unidades", []):
-            for tema in unidad.get("temas", []):
-                if 'nombre' in tema:
-                    temas_disponibles.append(tema['nombre'])
+        temas_disponibles = indice_temas.nombres
 
         temas_no_aprendidos = [t for t in temas_disponibles if t not in temas_aprendidos]
         if not temas_no_aprendidos:
             temas_no_aprendidos = temas_disponibles
 
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT temas_recomendados FROM progreso WHERE usuario = %s", (usuario,))
-            row = c.fetchone()
+            escritor_diferido.esperar(('progreso', usuario))
+            with get_db_connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT temas_recomendados FROM progreso WHERE usuario = %s", (usuario,))
+                row = c.fetchone()
             temas_recomendados = row[0].split(",") if row and row[0] else []
-            conn.close()
         except PsycopgError as e:
             logger.error("Error al cargar temas recomendados", error=str(e), usuario=usuario)
             temas_recomendados = []
@@ -1033,9 +3480,7 @@ def recommend():
         if not temas_disponibles_para_recomendar:
             temas_disponibles_para_recomendar = temas_no_aprendidos
 
-        contexto = ""
-        if historial:
-            contexto = "\nHistorial reciente:\n" + "\n".join([f"- Pregunta: {h['pregunta']}\n  Respuesta: {h['respuesta']}" for h in historial[-5:]])
+        contexto = cargar_contexto_historial(conv_id, 'basica')
 
         prompt = (
             "Eres YELIA, un tutor de Programación Avanzada para Ingeniería en Telemática. "
@@ -1059,6 +3504,7 @@ def recommend():
         try:
             recomendacion_data = json.loads(completion.choices[0].message.content.strip())
             recomendacion = recomendacion_data.get("recommendation", "")
+            recomendacion = indice_temas.resolver(recomendacion) or recomendacion
             if not recomendacion:
                 raise json.JSONDecodeError("Recommendation vacía", "", 0)
         except json.JSONDecodeError as je:
@@ -1069,22 +3515,12 @@ def recommend():
         temas_recomendados.append(recomendacion)
         if len(temas_recomendados) > 5:
             temas_recomendados = temas_recomendados[-5:]
-        try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("UPDATE progreso SET temas_recomendados = %s WHERE usuario = %s", (",".join(temas_recomendados), usuario))
-            conn.commit()
-            conn.close()
-        except PsycopgError as e:
-            logger.error("Error al guardar temas recomendados", error=str(e), usuario=usuario)
+        guardar_temas_recomendados(usuario, temas_recomendados)
 
         recomendacion_texto = f"Te recomiendo estudiar: {recomendacion}"
         guardar_mensaje(usuario, conv_id, 'bot', recomendacion_texto, tema=recomendacion)
         logger.info("Recomendación generada", recomendacion=recomendacion_texto, usuario=usuario, conv_id=conv_id)
         return jsonify({"recommendation": recomendacion_texto, 'conv_id': conv_id})
-    except ValidationError as e:
-        logger.error("Validación fallida en /recommend", error=str(e), usuario=session.get('usuario', 'anonimo'))
-        return jsonify({"error": f"Datos inválidos: {str(e)}", "status": 400}), 400
     except Exception as e:
         logger.error("Error en /recommend", error=str(e), usuario=session.get('usuario', 'anonimo'))
         recomendacion = random.choice(temas_no_aprendidos) if temas_no_aprendidos else random.choice(temas_disponibles)
@@ -1099,21 +3535,9 @@ resources_bp = Blueprint('resources', __name__)
 @limiter.limit("100 per hour")
 def get_temas():
     """Obtiene la lista de temas disponibles."""
-    cache_key = 'temas_response'
-    if cache_key in cache:
-        logger.info("Temas servidos desde caché")
-        return cache[cache_key]
-
+    recargar_temas_si_cambio()
     try:
-        temas_disponibles = []
-        for unidad in temas.get("Unidades", []):
-            for tema in unidad.get("temas", []):
-                if 'nombre' in tema:
-                    temas_disponibles.append(tema['nombre'])
-        response = jsonify({"temas": temas_disponibles})
-        cache[cache_key] = response
-        logger.info("Temas disponibles enviados", temas=temas_disponibles)
-        return response
+        return responder_payload('temas_response', lambda: {"temas": indice_temas.nombres}, max_age=300)
     except Exception as e:
         logger.error("Error en /temas", error=str(e))
         return jsonify({"error": "Error al obtener temas", "status": 500}), 500
@@ -1122,26 +3546,111 @@ def get_temas():
 @limiter.limit("100 per hour")
 def get_avatars():
     """Obtiene la lista de avatares disponibles."""
-    cache_key = 'avatars_response'
-    if cache_key in cache:
-        logger.info("Avatares servidos desde caché")
-        return cache[cache_key]
+    return responder_payload('avatars_response', cargar_avatares, max_age=3600)
+
+AVATAR_POR_DEFECTO = {'avatar_id': 'default', 'nombre': 'Avatar Predeterminado', 'url': '/static/favicon.ico', 'animation_url': ''}
 
+def consultar_avatares(c):
+    """Lee los avatares con el cursor dado."""
+    c.execute("SELECT avatar_id, nombre, url, animation_url FROM avatars")
+    return [{'avatar_id': row[0], 'nombre': row[1], 'url': row[2], 'animation_url': row[3]} for row in c.fetchall()]
+
+def cargar_avatares():
+    """Lee los avatares de la base de datos, con un avatar por defecto si falla."""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT avatar_id, nombre, url, animation_url FROM avatars")
-        avatars = [{'avatar_id': row[0], 'nombre': row[1], 'url': row[2], 'animation_url': row[3]} for row in c.fetchall()]
-        conn.close()
-        response = jsonify({'avatars': avatars})
-        cache[cache_key] = response
-        logger.info("Avatares enviados", avatars=[avatar['nombre'] for avatar in avatars])
-        return response
+        with get_db_connection() as conn:
+            avatars = consultar_avatares(conn.cursor())
+        logger.info("Avatares cargados", avatars=[avatar['nombre'] for avatar in avatars])
     except Exception as e:
         logger.error("Error al obtener avatares", error=str(e))
-        response = jsonify({'avatars': [{'avatar_id': 'default', 'nombre': 'Avatar Predeterminado', 'url': '/static/favicon.ico', 'animation_url': ''}]})
-        cache[cache_key] = response
-        return response, 200
+        avatars = [AVATAR_POR_DEFECTO]
+    return {'avatars': avatars}
+
+@resources_bp.route('/bootstrap', methods=['GET'])
+@limiter.limit("100 per hour")
+def bootstrap():
+    """Devuelve en una respuesta lo que la página necesita al cargar: temas, avatares, conversaciones y mensajes."""
+    # --- Manejo de userId persistente ---
+    usuario = request.args.get("usuario") or session.get("usuario") or uuid.uuid4().hex
+    session['usuario'] = usuario
+    recargar_temas_si_cambio()
+
+    conv_id = request.args.get('conv_id', type=int) or session.get('current_conv_id')
+    avatars_cacheados = recursos_cache.get('avatars_response')
+    try:
+        # Todas las consultas en una sola conexión del pool
+        with get_db_connection() as conn:
+            c = conn.cursor()
+            filas_conv, conv_hay_mas = consultar_pagina(
+                c, "conversations", "id, nombre, created_at", "usuario = %s", (usuario,), PAGINA_LIMITE_DEFECTO
+            )
+            conversations = [_conversacion_a_dict(r) for r in reversed(filas_conv)]
+
+            # La conversación pedida sólo vale si es del usuario; si no, la más reciente
+            if conv_id not in {conv["id"] for conv in conversations}:
+                if conv_id:
+                    c.execute("SELECT 1 FROM conversations WHERE id = %s AND usuario = %s", (conv_id, usuario))
+                    if not c.fetchone():
+                        conv_id = None
+                conv_id = conv_id or (conversations[0]["id"] if conversations else None)
+            filas_msg, msg_hay_mas = [], False
+            if conv_id:
+                escritor_diferido.esperar(conv_id)
+                filas_msg, msg_hay_mas = consultar_pagina(
+                    c, "messages", "id, role, content, created_at, tema", "conv_id = %s", (conv_id,), BOOTSTRAP_MENSAJES
+                )
+            messages = [_mensaje_a_dict(r) for r in filas_msg]
+
+            if avatars_cacheados is not None:
+                avatars = json.loads(avatars_cacheados)['avatars']
+            else:
+                try:
+                    avatars = consultar_avatares(c)
+                    guardar_payload('avatars_response', {'avatars': avatars})
+                except PsycopgError as e:
+                    logger.error("Error al obtener avatares", error=str(e))
+                    conn.rollback()
+                    avatars = [AVATAR_POR_DEFECTO]
+            conn.commit()
+    except Exception as e:
+        logger.error("Error en /bootstrap", error=str(e), usuario=usuario)
+        return jsonify({"error": "No se pudo cargar el estado inicial", "status": 500}), 500
+
+    if conv_id:
+        session['current_conv_id'] = conv_id
+    else:
+        session.pop('current_conv_id', None)
+    logger.info("Bootstrap enviado", usuario=usuario, conv_id=conv_id,
+                conversation_count=len(conversations), message_count=len(messages))
+    return jsonify({
+        "usuario": usuario,
+        "temas": indice_temas.nombres,
+        "avatars": avatars,
+        "conversations": conversations,
+        "conversations_cursor": _cursores(filas_conv, 2, conv_hay_mas),
+        "conv_id": conv_id,
+        "messages": messages,
+        "messages_cursor": _cursores(filas_msg, 3, msg_hay_mas)
+    })
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # sin token la ruta /metrics no existe
+
+@resources_bp.route('/metrics', methods=['GET'])
+@limiter.limit("100 per hour")
+def get_metrics():
+    """Expone contadores internos del proceso (pool de conexiones, cachés, escrituras y llamadas al LLM)."""
+    if not METRICS_TOKEN:
+        return jsonify({"error": "Recurso no encontrado", "status": 404}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"error": "No autorizado", "status": 401}), 401
+    return jsonify({
+        "db_pool": db_pool.stats(),
+        "caches": {nombre: espacio.stats() for nombre, espacio in caches.items()},
+        "audio_tts": audio_tts.stats(),
+        "escritura_diferida": escritor_diferido.stats(),
+        "llm": planificador_llm.stats(),
+        "vuelos": vuelos.stats()
+    })
 
 # --- Rutas Principales ---
 @app.route('/')
@@ -1163,6 +3672,14 @@ def index():
         logger.error("Error al renderizar index.html", error=str(e), usuario=session.get('usuario', 'anonimo'))
         return jsonify({'error': 'Error al cargar la página principal', "status": 500}), 500
 
+@app.before_request
+def iniciar_tareas_de_fondo():
+    """Arranca en cada worker los hilos de fondo que no sobreviven al fork."""
+    if QUIZ_BANCO_REFILL:
+        rellenador_quiz.iniciar()
+    if TTS_WARMUP_AL_INICIAR:
+        iniciar_calentamiento_tts()
+
 # Registrar Blueprints
 app.register_blueprint(chat_bp)
 app.register_blueprint(quiz_bp)
@@ -1181,13 +3698,10 @@ except Exception as e:
 
 # Carga inicial de temas
 temas = {}
-try:
-    with open('temas.json', 'r', encoding='utf-8') as f:
-        temas_json = json.load(f)
-        TEMAS_COMPLETOS = temas_json.get("Unidades", [])
-except Exception:
-    TEMAS_COMPLETOS = []
+indice_temas = IndiceTemas({})
 TEMAS_DISPONIBLES = cargar_temas()
 
 if __name__ == "__main__":
+    if TTS_WARMUP_AL_INICIAR:
+        iniciar_calentamiento_tts()
     app.run(debug=False, host='0.0.0.0', port=int(os.getenv("PORT", 10000)))
\ No newline at end of file
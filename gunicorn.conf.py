@@ -0,0 +1,28 @@
+"""Configuración de gunicorn para producción.
+
+Los workers gevent atienden cada petición en un greenlet: mientras una espera a Groq, gTTS o
+Postgres, el worker sigue sirviendo las demás. app.py detecta el modo gevent y hace cooperativo
+a psycopg2; el cliente de Groq comparte un pool HTTP por worker.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 10000)}"
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+# app.py reparte los límites de Groq por minuto entre los workers; los hijos heredan este entorno
+os.environ['WEB_CONCURRENCY'] = str(workers)
+# Peticiones simultáneas por worker (greenlets); casi todas pasan el tiempo esperando a la API
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 500))
+# Las respuestas en streaming pueden durar lo que tarde el modelo
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+# Margen para que el escritor diferido vacíe su cola al reiniciar
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+# Reciclar workers de vez en cuando acota la memoria de cachés y fragmentación
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = 500
+# Sin preload: gevent debe parchear la librería estándar antes de importar app.py
+preload_app = False
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOGLEVEL', 'info')
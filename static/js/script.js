@@ -12,19 +12,28 @@ const config = {
     pendingWelcomeMessage: null,
     lastVoiceHintTime: 0,
     currentConvId: localStorage.getItem('lastConvId') || null,
-    historial: JSON.parse(localStorage.getItem('historial') || '[]'),
     quizHistory: JSON.parse(localStorage.getItem('quizHistory') || '[]'),
     nivelExplicacion: localStorage.getItem('nivelExplicacion') || 'basica',
     temaSeleccionado: null,
     API_URL: '/buscar_respuesta',
+    API_STREAM_URL: '/buscar_respuesta/stream',
     QUIZ_URL: '/quiz',
     TTS_URL: '/tts',
+    TTS_STREAM_URL: '/tts/stream',
+    ttsAudioUrls: new Map(),  // texto -> URL del audio ya sintetizado en el servidor
     RECOMMEND_URL: '/recommend',
     CONVERSATIONS_URL: '/conversations',
     MESSAGES_URL: '/messages',
     AVATARS_URL: '/avatars',
     TEMAS_URL: '/temas',
     LOGOUT_URL: '/logout',
+    BOOTSTRAP_URL: '/bootstrap',
+    SEARCH_URL: '/search',
+    busqueda: { q: '', nextOffset: null },
+    PAGINA_LIMITE: 50,
+    paginasMensajes: new Map(),  // convId -> { messages, before, since, hasMore }
+    conversacionesCursor: { before: null, hasMore: false },
+    cargandoPagina: false,
     TEMAS_DISPONIBLES: [],
     userId: null  // Identificador único del usuario persistente
 };
@@ -50,6 +59,35 @@ const debounce = (func, wait) => {
     };
 };
 
+// Lee un cuerpo text/event-stream y llama a onEvento(evento, datos) por cada evento recibido
+const leerEventosSSE = async (res, onEvento) => {
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let separador;
+        while ((separador = buffer.indexOf('\n\n')) !== -1) {
+            const bloque = buffer.slice(0, separador);
+            buffer = buffer.slice(separador + 2);
+            let evento = 'message';
+            let datos = '';
+            bloque.split('\n').forEach(linea => {
+                if (linea.startsWith('event:')) evento = linea.slice(6).trim();
+                else if (linea.startsWith('data:')) datos += linea.slice(5).trim();
+            });
+            if (datos) onEvento(evento, JSON.parse(datos));
+        }
+    }
+};
+
+// Id de mensaje generado en el cliente para que los reintentos sean idempotentes en el servidor
+const generarClientId = () => (window.crypto?.randomUUID
+    ? crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`);
+
 const getElement = selector => {
     const element = document.querySelector(selector);
     if (!element) console.warn(`Elemento ${selector} no encontrado en el DOM`);
@@ -121,6 +159,42 @@ const hideLoading = (loadingDiv) => {
 const isMobile = () => window.innerWidth <= 768;
 
 // --- Lógica de Audio y Voz ---
+// Reproduce /tts/stream con MediaSource: el audio empieza con la primera oración sintetizada.
+// Devuelve null si el navegador no admite MP3 en MediaSource (se usa /tts completo).
+const obtenerAudioEnStream = async (texto) => {
+    if (!window.MediaSource || !MediaSource.isTypeSupported('audio/mpeg')) return null;
+    const res = await fetch(config.TTS_STREAM_URL, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ text: texto, usuario: config.userId })
+    });
+    if (!res.ok || !res.body) {
+        const err = await res.json().catch(() => ({}));
+        throw new Error(err.error || `Error en /tts/stream: ${res.status}`);
+    }
+    const clave = res.headers.get('X-TTS-Clave');
+    const mediaSource = new MediaSource();
+    const audio = new Audio(URL.createObjectURL(mediaSource));
+    mediaSource.addEventListener('sourceopen', async () => {
+        const buffer = mediaSource.addSourceBuffer('audio/mpeg');
+        const reader = res.body.getReader();
+        try {
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer.appendBuffer(value);
+                await new Promise(resolve => buffer.addEventListener('updateend', resolve, { once: true }));
+            }
+            mediaSource.endOfStream();
+            if (clave) config.ttsAudioUrls.set(texto, `${config.TTS_URL}/audio/${clave}`);
+        } catch (error) {
+            console.error('Error al recibir audio en stream:', error);
+            if (mediaSource.readyState === 'open') mediaSource.endOfStream('network');
+        }
+    }, { once: true });
+    return audio;
+};
+
 const speakText = async (text) => {
     if (!config.vozActiva || !text) {
         mostrarNotificacion('Audio desactivado o texto vacío', 'error');
@@ -164,17 +238,26 @@ const speakText = async (text) => {
         config.currentAudio = null;
     }
     try {
-        const res = await fetch(config.TTS_URL, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ text: textoParaVoz, usuario: config.userId })  // Incluir userId persistente
-        });
-        if (!res.ok) {
-            const err = await res.json();
-            throw new Error(err.error || `Error en /tts: ${res.status}`);
+        // Audio ya sintetizado: se reproduce directo desde su URL (caché HTTP, sin POST ni límite de /tts)
+        const audioUrl = config.ttsAudioUrls.get(textoParaVoz);
+        let audio = audioUrl ? new Audio(audioUrl) : await obtenerAudioEnStream(textoParaVoz);
+        if (!audio) {
+            const res = await fetch(config.TTS_URL, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ text: textoParaVoz, usuario: config.userId })  // Incluir userId persistente
+            });
+            if (!res.ok) {
+                const err = await res.json();
+                throw new Error(err.error || `Error en /tts: ${res.status}`);
+            }
+            const clave = res.headers.get('X-TTS-Clave');
+            if (clave) config.ttsAudioUrls.set(textoParaVoz, `${config.TTS_URL}/audio/${clave}`);
+            const blob = await res.blob();
+            audio = new Audio(URL.createObjectURL(blob));
         }
-        const blob = await res.blob();
-        config.currentAudio = new Audio(URL.createObjectURL(blob));
+        config.currentAudio = audio;
+        config.currentAudio.onerror = () => config.ttsAudioUrls.delete(textoParaVoz);
         config.currentAudio.play().catch(error => {
             mostrarNotificacion('Error al reproducir audio: ' + error.message, 'error');
             if (botMessage) botMessage.classList.remove('speaking');
@@ -322,15 +405,7 @@ const toggleVoiceRecognition = () => {
 };
 
 // --- Lógica del Chat ---
-const getHistorial = () => {
-    try {
-        const historial = JSON.parse(localStorage.getItem('historial') || '[]');
-        return Array.isArray(historial) ? historial : [];
-    } catch (error) {
-        return [];
-    }
-};
-
+// El historial para el prompt lo arma el servidor desde la conversación guardada.
 const mostrarMensajeBienvenida = async () => {
     const chatbox = getElement('#chatbox');
     const container = chatbox?.querySelector('.message-container');
@@ -404,53 +479,92 @@ const sendMessage = async () => {
     }
 
     try {
-        await fetch(`${config.MESSAGES_URL}/${config.currentConvId}`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ role: 'user', content: pregunta, usuario: config.userId })  // Incluir userId persistente
-        });
-
+        // El servidor guarda pregunta y respuesta; el client_id evita duplicarlas si se reintenta
         const payload = {
             pregunta,
-            historial: getHistorial(),
             nivel_explicacion: config.nivelExplicacion,
             conv_id: config.currentConvId,
-            usuario: config.userId  // Incluir userId persistente
+            usuario: config.userId,  // Incluir userId persistente
+            client_id: generarClientId()
         };
-        const res = await fetch(config.API_URL, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(payload)
-        });
-        if (!res.ok) throw new Error(`Error al procesar la solicitud: ${res.status} - ${await res.text()}`);
-        const data = await res.json();
+        const data = await obtenerRespuestaEnStream(payload, container, loadingDiv);
         if (!data.respuesta) throw new Error('Respuesta vacía desde el servidor');
         config.currentConvId = data.conv_id;
         localStorage.setItem('lastConvId', config.currentConvId);
         hideLoading(loadingDiv);
-
-        const botDiv = document.createElement('div');
-        botDiv.classList.add('bot');
-        botDiv.innerHTML = (typeof marked !== 'undefined' ? marked.parse(data.respuesta) : data.respuesta) +
-            `<button class="copy-btn" data-text="${data.respuesta.replace(/"/g, '&quot;')}" aria-label="Copiar mensaje"><i class="fas fa-copy"></i></button>`;
-        container.appendChild(botDiv);
-        scrollToBottom();
         if (window.Prism) Prism.highlightAll();
         speakText(data.respuesta);
+    } catch (error) {
+        handleFetchError(error, 'Envío de mensaje');
+        hideLoading(loadingDiv);
+    }
+};
 
-        await fetch(`${config.MESSAGES_URL}/${config.currentConvId}`, {
+// Pide la respuesta por SSE y pinta los tokens según llegan; sin soporte de streams usa el endpoint JSON
+const obtenerRespuestaEnStream = async (payload, container, loadingDiv) => {
+    const botDiv = document.createElement('div');
+    botDiv.classList.add('bot');
+    const pintar = (texto) => {
+        botDiv.innerHTML = (typeof marked !== 'undefined' ? marked.parse(texto) : texto) +
+            `<button class="copy-btn" data-text="${texto.replace(/"/g, '&quot;')}" aria-label="Copiar mensaje"><i class="fas fa-copy"></i></button>`;
+    };
+
+    const streamRes = window.ReadableStream ? await fetch(config.API_STREAM_URL, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
+        body: JSON.stringify(payload)
+    }) : null;
+
+    if (!streamRes || !streamRes.ok || !streamRes.body) {
+        const res = await fetch(config.API_URL, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ role: 'bot', content: data.respuesta, usuario: config.userId })  // Incluir userId persistente
+            body: JSON.stringify(payload)
         });
+        if (!res.ok) throw new Error(`Error al procesar la solicitud: ${res.status} - ${await res.text()}`);
+        const data = await res.json();
+        if (data.respuesta) {
+            pintar(data.respuesta);
+            container.appendChild(botDiv);
+            scrollToBottom();
+        }
+        return data;
+    }
 
-        config.historial.push({ pregunta, respuesta: data.respuesta });
-        if (config.historial.length > 10) config.historial.shift();
-        localStorage.setItem('historial', JSON.stringify(config.historial));
-    } catch (error) {
-        handleFetchError(error, 'Envío de mensaje');
-        hideLoading(loadingDiv);
+    let texto = '';
+    let resultado = { respuesta: '', conv_id: payload.conv_id };
+    let pintado = false;
+    let pendiente = false;
+    await leerEventosSSE(streamRes, (evento, datos) => {
+        if (evento === 'inicio') {
+            resultado.conv_id = datos.conv_id;
+        } else if (evento === 'token') {
+            texto += datos.t;
+            if (!pintado) {
+                hideLoading(loadingDiv);
+                container.appendChild(botDiv);
+                pintado = true;
+            }
+            // Agrupa los repintados por frame para no re-parsear Markdown en cada token
+            if (!pendiente) {
+                pendiente = true;
+                requestAnimationFrame(() => {
+                    pendiente = false;
+                    if (resultado.respuesta) return;
+                    pintar(texto);
+                    scrollToBottom();
+                });
+            }
+        } else if (evento === 'fin') {
+            resultado = { respuesta: datos.respuesta, conv_id: datos.conv_id };
+        }
+    });
+    if (resultado.respuesta) {
+        if (!pintado) container.appendChild(botDiv);
+        pintar(resultado.respuesta);
+        scrollToBottom();
     }
+    return resultado;
 };
 
 const nuevaConversacion = async () => {
@@ -483,7 +597,6 @@ const cerrarSesion = async () => {
         if (!res.ok) throw new Error(`Error al cerrar sesión: ${res.status}`);
         const data = await res.json();
         config.currentConvId = null;
-        config.historial = [];
         config.quizHistory = [];
         localStorage.removeItem('lastConvId');
         localStorage.removeItem('historial');
@@ -505,10 +618,8 @@ const vaciarChat = async () => {
 
 // --- Comunicación con el Servidor ---
 const cargarAvatares = async () => {
-    const avatarContainer = getElement('.avatar-options');
-    if (!avatarContainer) return;
     try {
-        const response = await fetch(config.AVATARS_URL, { cache: 'no-store' });
+        const response = await fetch(config.AVATARS_URL);
         let avatares = [];
         if (response.ok) {
             const data = await response.json();
@@ -516,72 +627,50 @@ const cargarAvatares = async () => {
         } else {
             avatares = [{ avatar_id: 'default', nombre: 'Default', url: '/static/favicon.ico', animation_url: '' }];
         }
-        localStorage.setItem('avatars', JSON.stringify(avatares));
-        avatarContainer.innerHTML = '';
-        avatares.forEach(avatar => {
-            const img = document.createElement('img');
-            img.src = avatar.url;
-            img.classList.add('avatar-option');
-            img.dataset.avatar = avatar.avatar_id;
-            img.alt = `Avatar ${avatar.nombre}`;
-            img.title = avatar.nombre;
-            if (avatar.avatar_id === config.selectedAvatar) img.classList.add('selected');
-            avatarContainer.appendChild(img);
-            img.addEventListener('click', () => {
-                getElements('.avatar-option').forEach(opt => opt.classList.remove('selected'));
-                img.classList.add('selected');
-                config.selectedAvatar = avatar.avatar_id;
-                localStorage.setItem('selectedAvatar', config.selectedAvatar);
-                updateAvatarDisplay();
-                mostrarNotificacion(`Avatar seleccionado: ${avatar.nombre}`, 'success');
-            });
-        });
-        updateAvatarDisplay();
+        renderAvatares(avatares);
     } catch (error) {
         handleFetchError(error, 'Carga de avatares');
     }
 };
 
+const renderAvatares = (avatares) => {
+    const avatarContainer = getElement('.avatar-options');
+    if (!avatarContainer) return;
+    localStorage.setItem('avatars', JSON.stringify(avatares));
+    avatarContainer.innerHTML = '';
+    avatares.forEach(avatar => {
+        const img = document.createElement('img');
+        img.src = avatar.url;
+        img.classList.add('avatar-option');
+        img.dataset.avatar = avatar.avatar_id;
+        img.alt = `Avatar ${avatar.nombre}`;
+        img.title = avatar.nombre;
+        if (avatar.avatar_id === config.selectedAvatar) img.classList.add('selected');
+        avatarContainer.appendChild(img);
+        img.addEventListener('click', () => {
+            getElements('.avatar-option').forEach(opt => opt.classList.remove('selected'));
+            img.classList.add('selected');
+            config.selectedAvatar = avatar.avatar_id;
+            localStorage.setItem('selectedAvatar', config.selectedAvatar);
+            updateAvatarDisplay();
+            mostrarNotificacion(`Avatar seleccionado: ${avatar.nombre}`, 'success');
+        });
+    });
+    updateAvatarDisplay();
+};
+
 const cargarConversaciones = async () => {
     try {
-        const res = await fetch(config.CONVERSATIONS_URL, {
+        const res = await fetch(`${config.CONVERSATIONS_URL}?limit=${config.PAGINA_LIMITE}`, {
             method: 'GET', // Cambiado a GET para alinearse con app.py
             headers: { 'Content-Type': 'application/json' }
         });
         if (!res.ok) throw new Error(`Error HTTP ${res.status}: ${await res.text()}`);
         const data = await res.json();
-        const chatList = getElement('#chat-list');
-        if (!chatList) return;
-
-        chatList.innerHTML = '';
         // Verificar si data.conversations existe y es un arreglo
         const conversations = Array.isArray(data.conversations) ? data.conversations : [];
-        conversations.forEach(conv => {
-            const li = document.createElement('li');
-            li.dataset.id = conv.id;
-            li.innerHTML = `
-                <span class="chat-name">${conv.nombre || 'Nuevo Chat'}</span>
-                <div class="chat-actions">
-                    <button class="rename-btn" data-tooltip="Renombrar"><i class="fas fa-edit"></i></button>
-                    <button class="delete-btn" data-tooltip="Eliminar"><i class="fas fa-trash"></i></button>
-                </div>
-            `;
-            li.addEventListener('click', () => {
-                config.currentConvId = conv.id;
-                localStorage.setItem('lastConvId', config.currentConvId);
-                cargarMensajes(conv.id);
-            });
-            chatList.appendChild(li);
-
-            li.querySelector('.delete-btn').addEventListener('click', (e) => {
-                e.stopPropagation();
-                eliminarConversacion(conv.id);
-            });
-            li.querySelector('.rename-btn').addEventListener('click', (e) => {
-                e.stopPropagation();
-                renombrarConversacion(conv.id);
-            });
-        });
+        config.conversacionesCursor = { before: data.before, hasMore: data.has_more };
+        if (!renderConversaciones(conversations)) return;
 
         if (conversations.length > 0 && !config.currentConvId) {
             config.currentConvId = conversations[0].id;
@@ -595,36 +684,226 @@ const cargarConversaciones = async () => {
     }
 };
 
+// Siguiente página de conversaciones más antiguas, al llegar al final de la barra lateral
+const cargarMasConversaciones = async () => {
+    const { before, hasMore } = config.conversacionesCursor;
+    if (!hasMore || !before || config.cargandoPagina) return;
+    config.cargandoPagina = true;
+    try {
+        const params = new URLSearchParams({ limit: config.PAGINA_LIMITE, before });
+        const res = await fetch(`${config.CONVERSATIONS_URL}?${params}`);
+        if (!res.ok) throw new Error(`Error HTTP ${res.status}: ${await res.text()}`);
+        const data = await res.json();
+        config.conversacionesCursor = { before: data.before, hasMore: data.has_more };
+        renderConversaciones(data.conversations || [], true);
+    } catch (error) {
+        handleFetchError(error, 'Carga de conversaciones');
+    } finally {
+        config.cargandoPagina = false;
+    }
+};
+
+// Búsqueda de texto completo en el historial del usuario (resultados ordenados por relevancia)
+const buscarEnHistorial = async (q, offset = 0) => {
+    const resultados = getElement('#search-results');
+    const chatList = getElement('#chat-list');
+    if (!resultados || !chatList) return;
+    if (!q) {
+        config.busqueda = { q: '', nextOffset: null };
+        resultados.innerHTML = '';
+        resultados.classList.add('hidden');
+        chatList.classList.remove('hidden');
+        return;
+    }
+    if (config.cargandoPagina) return;
+    config.cargandoPagina = true;
+    try {
+        const params = new URLSearchParams({ q, offset });
+        const res = await fetch(`${config.SEARCH_URL}?${params}`);
+        if (!res.ok) throw new Error(`Error HTTP ${res.status}: ${await res.text()}`);
+        const data = await res.json();
+        if (q !== getElement('#search-input')?.value.trim()) return;  // respuesta de una búsqueda anterior
+        config.busqueda = { q, nextOffset: data.next_offset };
+        renderResultadosBusqueda(data.results || [], offset > 0);
+        chatList.classList.add('hidden');
+        resultados.classList.remove('hidden');
+    } catch (error) {
+        handleFetchError(error, 'Búsqueda en historial');
+    } finally {
+        config.cargandoPagina = false;
+    }
+};
+
+// Pinta un fragmento con las coincidencias marcadas «así» usando nodos de texto (sin innerHTML)
+const crearFragmentoResaltado = (snippet) => {
+    const p = document.createElement('p');
+    p.className = 'search-snippet';
+    (snippet || '').split(/(«[^»]*»)/).forEach(parte => {
+        if (parte.startsWith('«') && parte.endsWith('»')) {
+            const mark = document.createElement('mark');
+            mark.textContent = parte.slice(1, -1);
+            p.appendChild(mark);
+        } else if (parte) {
+            p.appendChild(document.createTextNode(parte));
+        }
+    });
+    return p;
+};
+
+const renderResultadosBusqueda = (results, agregar = false) => {
+    const lista = getElement('#search-results');
+    if (!lista) return;
+    if (!agregar) lista.innerHTML = '';
+    if (!agregar && results.length === 0) {
+        const li = document.createElement('li');
+        li.className = 'search-empty';
+        li.textContent = 'Sin resultados';
+        lista.appendChild(li);
+        return;
+    }
+    results.forEach(r => {
+        const li = document.createElement('li');
+        li.dataset.id = r.conv_id;
+        const titulo = document.createElement('span');
+        titulo.className = 'chat-name';
+        titulo.textContent = `${r.conversacion} · ${r.role === 'user' ? 'Tú' : 'YELIA'}`;
+        li.append(titulo, crearFragmentoResaltado(r.snippet));
+        li.addEventListener('click', () => cargarMensajes(r.conv_id));
+        lista.appendChild(li);
+    });
+};
+
+const renderConversaciones = (conversations, agregar = false) => {
+    const chatList = getElement('#chat-list');
+    if (!chatList) return false;
+
+    if (!agregar) chatList.innerHTML = '';
+    conversations.forEach(conv => {
+        const li = document.createElement('li');
+        li.dataset.id = conv.id;
+        li.innerHTML = `
+            <span class="chat-name">${conv.nombre || 'Nuevo Chat'}</span>
+            <div class="chat-actions">
+                <button class="rename-btn" data-tooltip="Renombrar"><i class="fas fa-edit"></i></button>
+                <button class="delete-btn" data-tooltip="Eliminar"><i class="fas fa-trash"></i></button>
+            </div>
+        `;
+        li.addEventListener('click', () => {
+            config.currentConvId = conv.id;
+            localStorage.setItem('lastConvId', config.currentConvId);
+            cargarMensajes(conv.id);
+        });
+        chatList.appendChild(li);
+
+        li.querySelector('.delete-btn').addEventListener('click', (e) => {
+            e.stopPropagation();
+            eliminarConversacion(conv.id);
+        });
+        li.querySelector('.rename-btn').addEventListener('click', (e) => {
+            e.stopPropagation();
+            renombrarConversacion(conv.id);
+        });
+    });
+    return true;
+};
+
 const cargarMensajes = async (convId) => {
     if (!convId) return;
     config.currentConvId = convId;
     localStorage.setItem('lastConvId', convId);
+    // Si la conversación ya se cargó antes, se pinta al instante y sólo se piden los mensajes nuevos
+    const previa = config.paginasMensajes.get(String(convId));
+    if (previa) renderMensajes(previa.messages);
     try {
-        const res = await fetch(`${config.MESSAGES_URL}/${convId}`, {
+        const params = new URLSearchParams({ limit: config.PAGINA_LIMITE });
+        if (previa?.since) params.set('since', previa.since);
+        const res = await fetch(`${config.MESSAGES_URL}/${convId}?${params}`, {
             method: 'GET', // Usar GET para obtener mensajes
             headers: { 'Content-Type': 'application/json' }
         });
         if (!res.ok) throw new Error(`Error HTTP ${res.status}: ${await res.text()}`);
         const data = await res.json();
-        const container = getElement('#chatbox')?.querySelector('.message-container');
-        if (!container) return;
-        container.innerHTML = '';
-
-        data.messages.forEach(msg => {
-            const div = document.createElement('div');
-            div.classList.add(msg.role === 'user' ? 'user' : 'bot');
-            div.innerHTML = (typeof marked !== 'undefined' ? marked.parse(msg.content) : msg.content) +
-                `<button class="copy-btn" data-text="${msg.content.replace(/"/g, '&quot;')}" aria-label="Copiar mensaje"><i class="fas fa-copy"></i></button>`;
-            container.appendChild(div);
-        });
+        if (previa?.since && data.conv_id === Number(convId)) {
+            if (data.has_more) {
+                // Demasiados mensajes nuevos: se recarga la última página completa
+                config.paginasMensajes.delete(String(convId));
+                return cargarMensajes(convId);
+            }
+            previa.messages.push(...data.messages);
+            if (data.since) previa.since = data.since;
+            if (data.messages.length) renderMensajes(previa.messages);
+            return;
+        }
+        if (data.conv_id && data.conv_id !== Number(convId)) {
+            config.currentConvId = data.conv_id;
+            localStorage.setItem('lastConvId', data.conv_id);
+        }
+        guardarPaginaMensajes(config.currentConvId, data.messages, data);
+        renderMensajes(data.messages);
+    } catch (error) {
+        handleFetchError(error, 'Carga de mensajes');
+    }
+};
 
-        scrollToBottom();
+const guardarPaginaMensajes = (convId, messages, cursor) => {
+    config.paginasMensajes.set(String(convId), {
+        messages: [...messages],
+        before: cursor.before,
+        since: cursor.since,
+        hasMore: cursor.has_more
+    });
+};
+
+// Historial anterior bajo demanda al hacer scroll hasta arriba del chat
+const cargarMensajesAnteriores = async () => {
+    const convId = config.currentConvId;
+    const pagina = config.paginasMensajes.get(String(convId));
+    if (!pagina?.hasMore || !pagina.before || config.cargandoPagina) return;
+    config.cargandoPagina = true;
+    try {
+        const params = new URLSearchParams({ limit: config.PAGINA_LIMITE, before: pagina.before });
+        const res = await fetch(`${config.MESSAGES_URL}/${convId}?${params}`);
+        if (!res.ok) throw new Error(`Error HTTP ${res.status}: ${await res.text()}`);
+        const data = await res.json();
+        if (String(config.currentConvId) !== String(convId)) return;
+        pagina.messages.unshift(...data.messages);
+        pagina.before = data.before || pagina.before;
+        pagina.hasMore = data.has_more;
+
+        const chatbox = getElement('#chatbox');
+        const container = chatbox?.querySelector('.message-container');
+        if (!container) return;
+        const alturaPrevia = chatbox.scrollHeight;
+        const fragmento = document.createDocumentFragment();
+        data.messages.forEach(msg => fragmento.appendChild(crearNodoMensaje(msg)));
+        container.prepend(fragmento);
+        chatbox.scrollTop += chatbox.scrollHeight - alturaPrevia;  // mantener la posición de lectura
         if (window.Prism) Prism.highlightAll();
     } catch (error) {
-        handleFetchError(error, 'Carga de mensajes');
+        handleFetchError(error, 'Carga de mensajes anteriores');
+    } finally {
+        config.cargandoPagina = false;
     }
 };
 
+const crearNodoMensaje = (msg) => {
+    const div = document.createElement('div');
+    div.classList.add(msg.role === 'user' ? 'user' : 'bot');
+    div.innerHTML = (typeof marked !== 'undefined' ? marked.parse(msg.content) : msg.content) +
+        `<button class="copy-btn" data-text="${msg.content.replace(/"/g, '&quot;')}" aria-label="Copiar mensaje"><i class="fas fa-copy"></i></button>`;
+    return div;
+};
+
+const renderMensajes = (messages) => {
+    const container = getElement('#chatbox')?.querySelector('.message-container');
+    if (!container) return;
+    container.innerHTML = '';
+    messages.forEach(msg => container.appendChild(crearNodoMensaje(msg)));
+
+    scrollToBottom();
+    if (window.Prism) Prism.highlightAll();
+};
+
 const eliminarConversacion = async (convId) => {
     if (!confirm("¿Estás seguro de que quieres eliminar esta conversación?")) return;
     try {
@@ -688,17 +967,50 @@ const cargarTemas = async () => {
         const res = await fetch(config.TEMAS_URL, { method: 'GET' });
         if (!res.ok) throw new Error(`Error al cargar temas: ${res.status}`);
         const data = await res.json();
-        if (data.temas && Array.isArray(data.temas)) {
-            config.TEMAS_DISPONIBLES = data.temas;
-            localStorage.setItem(cacheKey, JSON.stringify(config.TEMAS_DISPONIBLES));
-            localStorage.setItem(cacheTimeKey, Date.now().toString());
-            actualizarSelectTemas();
-        }
+        if (data.temas && Array.isArray(data.temas)) aplicarTemas(data.temas);
     } catch (error) {
         handleFetchError(error, 'Carga de temas');
     }
 };
 
+const aplicarTemas = (temas) => {
+    config.TEMAS_DISPONIBLES = temas;
+    localStorage.setItem('temasCache', JSON.stringify(temas));
+    localStorage.setItem('temasCacheTime', Date.now().toString());
+    actualizarSelectTemas();
+};
+
+// Estado inicial de la página en una sola petición; si falla, se cargan las partes por separado
+const cargarBootstrap = async () => {
+    try {
+        const params = new URLSearchParams({ usuario: config.userId });
+        if (config.currentConvId) params.set('conv_id', config.currentConvId);
+        const res = await fetch(`${config.BOOTSTRAP_URL}?${params}`);
+        if (!res.ok) throw new Error(`Error HTTP ${res.status}: ${await res.text()}`);
+        const data = await res.json();
+        aplicarTemas(data.temas || []);
+        renderAvatares(data.avatars || []);
+        renderConversaciones(Array.isArray(data.conversations) ? data.conversations : []);
+        const cursorConv = data.conversations_cursor || {};
+        config.conversacionesCursor = { before: cursorConv.before, hasMore: cursorConv.has_more };
+        config.currentConvId = data.conv_id;
+        if (data.conv_id) {
+            localStorage.setItem('lastConvId', data.conv_id);
+            guardarPaginaMensajes(data.conv_id, data.messages || [], data.messages_cursor || {});
+            renderMensajes(data.messages || []);
+        } else {
+            localStorage.removeItem('lastConvId');
+            mostrarMensajeBienvenida();
+        }
+    } catch (error) {
+        console.error('Fallo en /bootstrap, cargando por partes:', error);
+        cargarTemas();
+        cargarAvatares();
+        await cargarConversaciones();
+        if (config.currentConvId) cargarMensajes(config.currentConvId);
+    }
+};
+
 const actualizarSelectTemas = () => {
     const temaSelect = getElement('#temaSelect');
     if (!temaSelect) return;
@@ -723,8 +1035,7 @@ const obtenerQuiz = async () => {
             body: JSON.stringify({
                 usuario: config.userId,  // Incluir userId persistente
                 nivel: config.nivelExplicacion,
-                tema: config.temaSeleccionado,
-                historial: getHistorial()
+                tema: config.temaSeleccionado
             })
         });
         if (!res.ok) throw new Error(`Error al obtener quiz: ${res.status} - ${await res.text()}`);
@@ -758,6 +1069,7 @@ const mostrarQuizEnChat = async (quizData) => {
         <button class="copy-btn" data-text="${quizData.pregunta}" aria-label="Copiar pregunta"><i class="fas fa-copy"></i></button>
     `;
     quizDiv.dataset.respuestaCorrecta = quizData.respuesta_correcta || '';
+    quizDiv.dataset.quizId = quizData.quiz_id || '';
     quizDiv.dataset.tema = quizData.tema || 'General';
     container.appendChild(quizDiv);
     scrollToBottom();
@@ -782,6 +1094,7 @@ const handleQuizOption = async (event) => {
         pregunta: quizContainer.querySelector('p').textContent,
         respuesta: selectedOption,
         respuesta_correcta: quizContainer.dataset.respuestaCorrecta || '',
+        quiz_id: quizContainer.dataset.quizId ? Number(quizContainer.dataset.quizId) : null,
         tema: quizContainer.dataset.tema || 'General',
         usuario: config.userId  // Incluir userId persistente
     };
@@ -802,6 +1115,7 @@ const handleQuizOption = async (event) => {
         config.currentConvId = data.conv_id;
         localStorage.setItem('lastConvId', config.currentConvId);
         const isCorrect = data.es_correcta;
+        quizData.respuesta_correcta = data.respuesta_correcta || quizData.respuesta_correcta;
         option.classList.add(isCorrect ? 'correct' : 'incorrect');
         if (!isCorrect) {
             const correctOption = quizContainer.querySelector(`.quiz-option[data-option="${quizData.respuesta_correcta}"]`);
@@ -827,24 +1141,6 @@ const handleQuizOption = async (event) => {
         scrollToBottom();
         if (window.Prism) Prism.highlightAll();
         speakText(feedbackMessage);
-
-        config.historial.push({
-            pregunta: quizData.pregunta,
-            respuesta: feedbackMessage,
-            tema: quizData.tema,
-            es_correcta: isCorrect,
-            opcion_seleccionada: selectedOption
-        });
-        if (config.historial.length > 10) config.historial.shift();
-        localStorage.setItem('historial', JSON.stringify(config.historial));
-
-        if (config.currentConvId) {
-            await fetch(`${config.MESSAGES_URL}/${config.currentConvId}`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ role: 'bot', content: feedbackMessage, tema: quizData.tema, usuario: config.userId })  // Incluir userId persistente
-            });
-        }
     } catch (error) {
         handleFetchError(error, 'Respuesta de quiz');
         hideLoading(loadingDiv);
@@ -857,7 +1153,7 @@ const obtenerRecomendacion = async () => {
         const res = await fetch(config.RECOMMEND_URL, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ usuario: config.userId, historial: getHistorial() })  // Incluir userId persistente
+            body: JSON.stringify({ usuario: config.userId })  // Incluir userId persistente
         });
         if (!res.ok) throw new Error(`Error al obtener recomendación: ${res.status} - ${await res.text()}`);
         const data = await res.json();
@@ -1003,18 +1299,6 @@ const handleRecommendClick = async () => {
     if (window.Prism) Prism.highlightAll();
     speakText(mensaje);
     addCopyButtonListeners();
-
-    config.historial.push({ pregunta: 'Recomendar tema', respuesta: mensaje, tema });
-    if (config.historial.length > 10) config.historial.shift();
-    localStorage.setItem('historial', JSON.stringify(config.historial));
-
-    if (config.currentConvId) {
-        await fetch(`${config.MESSAGES_URL}/${config.currentConvId}`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ role: 'bot', content: mensaje, tema, usuario: config.userId })  // Incluir userId persistente
-        });
-    }
 };
 
 const handleInputKeydown = (event) => {
@@ -1179,11 +1463,35 @@ const init = () => {
     document.addEventListener('click', handleFirstInteraction, { once: true });
     document.addEventListener('touchstart', handleFirstInteraction, { once: true });
 
-    cargarTemas();
-    cargarAvatares();
-    cargarConversaciones();
+    cargarBootstrap();
     addCopyButtonListeners();
 
+    const chatbox = getElement('#chatbox');
+    if (chatbox) {
+        chatbox.addEventListener('scroll', debounce(() => {
+            if (chatbox.scrollTop < 80) cargarMensajesAnteriores();
+        }, 150));
+    }
+    const chatList = getElement('#chat-list');
+    if (chatList) {
+        chatList.addEventListener('scroll', debounce(() => {
+            if (chatList.scrollTop + chatList.clientHeight >= chatList.scrollHeight - 40) cargarMasConversaciones();
+        }, 150));
+    }
+    const searchInput = getElement('#search-input');
+    if (searchInput) {
+        searchInput.addEventListener('input', debounce(() => buscarEnHistorial(searchInput.value.trim()), 300));
+    }
+    const searchResults = getElement('#search-results');
+    if (searchResults) {
+        searchResults.addEventListener('scroll', debounce(() => {
+            const { q, nextOffset } = config.busqueda;
+            if (nextOffset !== null && searchResults.scrollTop + searchResults.clientHeight >= searchResults.scrollHeight - 40) {
+                buscarEnHistorial(q, nextOffset);
+            }
+        }, 150));
+    }
+
     window.addEventListener('resize', debounce(() => {
         if (!isMobile()) {
             const leftSection = getElement('.left-section');
@@ -1194,11 +1502,6 @@ const init = () => {
     }, 250));
 
     setTimeout(() => {
-        if (config.currentConvId) {
-            cargarMensajes(config.currentConvId);
-        } else {
-            mostrarMensajeBienvenida();
-        }
         if (config.vozActiva && !config.userHasInteracted) toggleVoiceHint(true);
     }, 100);
 